@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmark nd2toarbt, plcloud, plcloud_warm, plcloud_tiled, fcssm and
+run_FMask on synthetic scenes.
+
+Scenes are generated with synthetic_scene.make_scene into a data directory
+and reused by later runs with the same parameters. Every measurement runs in
+a fresh process, so the peak resident set size (RSS) it reports belongs to
+that one call. The inputs of a benchmarked function (e.g. the plcloud output
+for fcssm) are computed in the same process before the timed call; the
+reported 'peak_rss_increase' is how much the timed call raised the peak
+above that setup. The per stage timings of fmask_profile are included.
+
+Results are written as JSON and can be compared with a stored baseline:
+
+    python bench_fmask.py --sizes 1k 4k --save baseline.json
+    ... optimize ...
+    python bench_fmask.py --sizes 1k 4k --compare baseline.json
+
+--compare prints the ratio of each case to the baseline and exits with
+status 1 if any case got slower (or used more memory) than --tolerance.
+
+The output of plcloud_tiled is also compared with that of plcloud, outside
+the timed call; a difference is reported and exits with status 1 too.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src', 'external'))
+
+import numpy
+
+import fmask_cloud_masking_edit as fmask
+import fmask_profile
+from synthetic_scene import make_scene
+
+SIZES = {'1k': 1024, '4k': 4096, '8k': 8192}
+FUNCTIONS = ('nd2toarbt', 'plcloud', 'plcloud_warm', 'plcloud_tiled', 'fcssm',
+             'run_FMask')
+
+
+def scene_dir(data, size, lnum, params):
+    """ Directory of a generated scene, named after its parameters """
+    name = 'L{l}_{s}_c{c}_n{n}_w{w}_s{sn}_seed{seed}'.format(
+        l=lnum, s=size, c=params['cloud_fraction'], n=params['clouds'],
+        w=params['water_fraction'], sn=params['snow_fraction'],
+        seed=params['seed'])
+    return os.path.join(data, name)
+
+
+def get_scene(data, size, lnum, params):
+    """ Returns MTL of the scene, generating the scene if needed """
+    directory = scene_dir(data, size, lnum, params)
+    if os.path.isfile(os.path.join(directory, 'scene.json')):
+        for f in os.listdir(directory):
+            if f.endswith('_MTL.txt'):
+                return os.path.join(directory, f)
+    print('Generating {d}'.format(d=directory))
+    return make_scene(directory, size, lnum, **params)
+
+
+def same_result(a, b):
+    """ True if the plcloud outputs a and b are identical """
+    for x, y in zip(a, b):
+        if isinstance(x, numpy.ndarray) or isinstance(y, numpy.ndarray):
+            if not (isinstance(x, numpy.ndarray) and
+                    isinstance(y, numpy.ndarray) and x.dtype == y.dtype and
+                    numpy.array_equal(x, y)):
+                return False
+        elif x != y and not (x is not None and y is not None and
+                             numpy.isnan(x) and numpy.isnan(y)):
+            return False
+    return True
+
+
+def _measure(case):
+    """ Run one benchmark case; called in a fresh pool worker """
+    mtl, lnum, function = case['mtl'], case['lnum'], case['function']
+    outdir = None
+
+    # Untimed setup
+    if function == 'nd2toarbt':
+        call = lambda: fmask.nd2toarbt(mtl)
+    elif function == 'plcloud':
+        call = lambda: fmask.plcloud(mtl, num_Lst=lnum, shadow_prob=True)
+    elif function == 'plcloud_warm':
+        toa_bt = fmask.nd2toarbt(mtl)
+        call = lambda: fmask.plcloud_warm(toa_bt, num_Lst=lnum,
+                                          shadow_prob=True)
+    elif function == 'plcloud_tiled':
+        call = lambda: fmask.plcloud_tiled(mtl, num_Lst=lnum,
+                                           shadow_prob=True)
+    elif function == 'fcssm':
+        r = fmask.plcloud(mtl, num_Lst=lnum, shadow_prob=True)
+        call = lambda: fmask.fcssm(r[0], r[1], r[2], r[3], r[4], r[5], r[6],
+                                   r[7], r[8], r[9], r[10], r[12], r[13],
+                                   3, 3, 3, search=case['search'])
+    elif function == 'run_FMask':
+        outdir = tempfile.mkdtemp(prefix='bench_fmask_')
+        call = lambda: fmask.run_FMask(mtl, outdir, search=case['search'])
+    else:
+        raise ValueError('Unknown function {f}'.format(f=function))
+
+    peak_setup = fmask_profile.peak_rss()
+    try:
+        with fmask_profile.Profiler(scene=mtl) as profiler:
+            start = time.time()
+            output = call()
+            seconds = time.time() - start
+    finally:
+        if outdir is not None:
+            shutil.rmtree(outdir, ignore_errors=True)
+    peak = fmask_profile.peak_rss()
+
+    # Untimed check of the tiled output
+    matches = None
+    if function == 'plcloud_tiled':
+        matches = same_result(output, fmask.plcloud(mtl, num_Lst=lnum,
+                                                    shadow_prob=True))
+    del output
+
+    # Total seconds per stage path
+    stages = {}
+    for stage in profiler.stages:
+        stages[stage['name']] = stages.get(stage['name'], 0) + \
+            stage['seconds']
+
+    return {'seconds': seconds, 'peak_rss': peak,
+            'peak_rss_increase': None if peak is None else peak - peak_setup,
+            'stages': stages, 'matches_plcloud': matches}
+
+
+def run_case(case, repeat):
+    """ Measure case repeat times, each in a fresh process
+
+    Returns the fastest run, with the smallest peak RSS increase of all runs
+    """
+    runs = []
+    for _ in range(repeat):
+        pool = multiprocessing.Pool(1)
+        try:
+            runs.append(pool.apply(_measure, (case, )))
+        finally:
+            pool.close()
+            pool.join()
+    best = min(runs, key=lambda r: r['seconds'])
+    increases = [r['peak_rss_increase'] for r in runs
+                 if r['peak_rss_increase'] is not None]
+    if increases:
+        best['peak_rss_increase'] = min(increases)
+    best['repeats'] = [r['seconds'] for r in runs]
+    if best['matches_plcloud'] is not None:
+        best['matches_plcloud'] = all(r['matches_plcloud'] for r in runs)
+    return best
+
+
+def case_name(case):
+    return '{f}/L{l}/{s}'.format(f=case['function'], l=case['lnum'],
+                                 s=case['size'])
+
+
+def compare(results, baseline, tolerance):
+    """ Print ratios to baseline; returns names of regressed cases """
+    base = dict((r['name'], r) for r in baseline['results'])
+    regressed = []
+    print('{n:<28s} {t:>9s} {b:>9s} {r:>7s} {m:>7s}'.format(
+        n='case', t='seconds', b='baseline', r='time', m='memory'))
+    for result in results:
+        ref = base.get(result['name'])
+        if ref is None:
+            print('{n:<28s} {t:9.3f} {b:>9s}'.format(
+                n=result['name'], t=result['seconds'], b='-'))
+            continue
+        ratio = result['seconds'] / max(ref['seconds'], 1e-9)
+        mem_ratio = None
+        if result.get('peak_rss_increase') and ref.get('peak_rss_increase'):
+            mem_ratio = float(result['peak_rss_increase']) / \
+                ref['peak_rss_increase']
+        print('{n:<28s} {t:9.3f} {b:9.3f} {r:7.2f} {m:>7s}'.format(
+            n=result['name'], t=result['seconds'], b=ref['seconds'],
+            r=ratio, m='-' if mem_ratio is None else '%.2f' % mem_ratio))
+        if ratio > 1 + tolerance or \
+                (mem_ratio is not None and mem_ratio > 1 + tolerance):
+            regressed.append(result['name'])
+    return regressed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks the Fmask functions on synthetic Landsat scenes.')
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['1k'], help='The scene sizes (1k = 1024 x 1024, 4k = 4096 x 4096, 8k = 8192 x 8192). Default is 1k.')
+    parser.add_argument('--lnum', nargs='+', type=int, choices=[4, 5, 7, 8], default=[5, 7, 8], help='The Landsat numbers. Default is 5 7 8.')
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=list(FUNCTIONS), help='The functions to benchmark. Default is all.')
+    parser.add_argument('--cloud_fraction', type=float, default=0.3, help='The approximate fraction of each scene covered by clouds. Default is 0.3.')
+    parser.add_argument('--clouds', type=int, default=None, help='The number of cloud objects. Default is 100 per 1024 x 1024 pixels.')
+    parser.add_argument('--water_fraction', type=float, default=0.1, help='The fraction of each scene covered by water. Default is 0.1.')
+    parser.add_argument('--snow_fraction', type=float, default=0.05, help='The fraction of each scene covered by snow. Default is 0.05.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed of the scenes. Default is 0.')
+    parser.add_argument('--search', default='exhaustive', help='The cloud height search of fcssm. Default is exhaustive.')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each case; the fastest is kept. Default is 3.')
+    parser.add_argument('--data', default=os.path.join(HERE, 'data'), help='The directory holding the generated scenes. Default is benchmarks/data.')
+    parser.add_argument('--save', default=None, help='Write the results to this JSON file (e.g. to store a baseline).')
+    parser.add_argument('--compare', default=None, help='Compare the results with this baseline JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='The allowed relative slow down / memory increase over the baseline. Default is 0.1.')
+
+    args = parser.parse_args()
+
+    results = []
+    for size_name in args.sizes:
+        size = SIZES[size_name]
+        params = {'cloud_fraction': args.cloud_fraction,
+                  'clouds': args.clouds if args.clouds is not None else
+                  max(1, 100 * size * size // (1024 * 1024)),
+                  'water_fraction': args.water_fraction,
+                  'snow_fraction': args.snow_fraction,
+                  'seed': args.seed}
+        for lnum in args.lnum:
+            mtl = get_scene(args.data, size, lnum, params)
+            for function in args.functions:
+                case = {'function': function, 'lnum': lnum,
+                        'size': size_name, 'mtl': mtl,
+                        'search': args.search}
+                result = run_case(case, args.repeat)
+                result.update({'name': case_name(case), 'function': function,
+                               'lnum': lnum, 'size': size_name,
+                               'scene': params})
+                results.append(result)
+                print('{n:<28s} {t:9.3f}s  peak RSS +{m} MiB{d}'.format(
+                    n=result['name'], t=result['seconds'],
+                    m='?' if result['peak_rss_increase'] is None else
+                    result['peak_rss_increase'] // 1024 ** 2,
+                    d='  DIFFERS FROM plcloud'
+                    if result['matches_plcloud'] is False else ''))
+
+    output = {'python': platform.python_version(),
+              'numpy': numpy.__version__,
+              'machine': platform.machine(),
+              'processor': platform.processor(),
+              'cpus': multiprocessing.cpu_count(),
+              'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    differ = [r['name'] for r in results if r['matches_plcloud'] is False]
+    if differ:
+        print('Differ from plcloud: ' + ', '.join(differ))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.tolerance)
+        if regressed:
+            print('Regressed: ' + ', '.join(regressed))
+            sys.exit(1)
+    if differ:
+        sys.exit(1)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Validate and time the flood fill engines of the shadow probability (see
+fmask_imfill) on synthetic scenes.
+
+For each scene the Band 4 and Band 5 reflectance returned by nd2toarbt are
+filled by every engine, and plcloud_warm is run once per engine. Reported
+per engine and scene:
+
+'seconds'           the time of the two fills
+'max_diff'          the largest difference to the imfill_skimage fill, in
+                    reflectance * 10000 (at most half a quantization step for
+                    uint16)
+'shadow_agreement'  the fraction of pixels where the potential shadow layer
+                    of plcloud_warm equals the one computed with skimage
+
+The scenes are those of bench_fmask and are shared with it:
+
+    python bench_imfill.py --sizes 1k 4k
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src', 'external'))
+
+import numpy
+
+import fmask_cloud_masking_edit as fmask
+from fmask_imfill import FILLS
+from bench_fmask import SIZES, get_scene
+
+
+def validate(mtl, lnum, fills=FILLS):
+    """ Fill Band 4 & 5 of the scene with each engine and compare """
+    toa_bt = fmask.nd2toarbt(mtl)
+    bands = [toa_bt[1][3], toa_bt[1][4]]
+
+    results = {}
+    reference = None
+    reference_shadow = None
+    for fill in ('skimage', ) + tuple(f for f in fills if f != 'skimage'):
+        start = time.time()
+        filled = [fmask.imfill(band.copy(), fill) for band in bands]
+        seconds = time.time() - start
+
+        # plcloud_warm modifies the bands it fills
+        warm_bt = list(toa_bt)
+        warm_bt[1] = toa_bt[1].copy()
+        shadow = fmask.plcloud_warm(warm_bt, num_Lst=lnum, shadow_prob=True,
+                                    fill=fill)[9]
+        if reference is None:
+            reference, reference_shadow = filled, shadow
+        results[fill] = {
+            'seconds': seconds,
+            'max_diff': max(float(numpy.abs(f - r).max())
+                            for f, r in zip(filled, reference)),
+            'shadow_agreement': float(numpy.mean(shadow == reference_shadow))
+        }
+    return dict((f, results[f]) for f in fills)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Validates and times the flood fill engines of the cloud shadow probability on synthetic Landsat scenes.')
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['1k'], help='The scene sizes (1k = 1024 x 1024, 4k = 4096 x 4096, 8k = 8192 x 8192). Default is 1k.')
+    parser.add_argument('--lnum', nargs='+', type=int, choices=[4, 5, 7, 8], default=[5, 7, 8], help='The Landsat numbers. Default is 5 7 8.')
+    parser.add_argument('--fills', nargs='+', choices=FILLS, default=list(FILLS), help='The flood fill engines. Default is all.')
+    parser.add_argument('--cloud_fraction', type=float, default=0.3, help='The approximate fraction of each scene covered by clouds. Default is 0.3.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed of the scenes. Default is 0.')
+    parser.add_argument('--data', default=os.path.join(HERE, 'data'), help='The directory holding the generated scenes. Default is benchmarks/data.')
+    parser.add_argument('--save', default=None, help='Write the results to this JSON file.')
+
+    args = parser.parse_args()
+
+    results = []
+    print('{n:<16s} {f:<8s} {t:>9s} {d:>9s} {a:>9s}'.format(
+        n='scene', f='fill', t='seconds', d='max_diff', a='shadow'))
+    for size_name in args.sizes:
+        size = SIZES[size_name]
+        params = {'cloud_fraction': args.cloud_fraction,
+                  'clouds': max(1, 100 * size * size // (1024 * 1024)),
+                  'water_fraction': 0.1,
+                  'snow_fraction': 0.05,
+                  'seed': args.seed}
+        for lnum in args.lnum:
+            mtl = get_scene(args.data, size, lnum, params)
+            name = 'L{l}/{s}'.format(l=lnum, s=size_name)
+            for fill, result in sorted(validate(mtl, lnum,
+                                                args.fills).items()):
+                result.update({'name': name, 'fill': fill})
+                results.append(result)
+                print('{n:<16s} {f:<8s} {t:9.3f} {d:9.3f} {a:9.6f}'.format(
+                    n=name, f=fill, t=result['seconds'],
+                    d=result['max_diff'], a=result['shadow_agreement']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Synthetic Landsat 4-7 and 8 scenes for benchmarking Fmask.
+
+make_scene writes one GeoTIFF per band plus an MTL file, laid out like an
+extracted USGS Level 1 product, so the scene runs through lndhdrread,
+nd2toarbt, plcloud and fcssm like real data. The scene is built in TOA
+reflectance (x 10000) and brightness temperature (degrees C x 100) and then
+converted back to DNs with the MTL calibration, so nd2toarbt recovers
+approximately the modelled values.
+
+The scene is vegetated land inside a slanted no-data frame, with smooth
+blobs of water and snow covering a given fraction of the scene, and a given
+number of round cloud objects covering roughly a given cloud fraction. Every
+cloud casts a darkened shadow displaced away from the sun by a random cloud
+height. The fractions actually generated are written to scene.json next to
+the MTL.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+import numpy
+import scipy.ndimage
+from osgeo import gdal
+from osgeo import osr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'external'))
+from fmask_cloud_masking_edit import sun_earth_distance
+
+# Surface classes in TOA reflectance x 10000, bands blue, green, red, NIR,
+#   SWIR1, SWIR2 (Landsat 4-7 bands 1, 2, 3, 4, 5, 7)
+LAND = (600, 700, 600, 2500, 1800, 1000)
+LAND_RANGE = (400, 400, 500, 1000, 600, 400)
+WATER = (700, 600, 400, 300, 100, 50)
+SNOW = (6000, 6000, 5800, 5000, 800, 500)
+CLOUD = (4500, 4400, 4300, 4200, 3500, 2500)
+# Shadows keep this fraction of the reflectance
+SHADOW = 0.4
+
+# Temperature in degrees C x 100
+LAND_TEMP = 2000
+WATER_TEMP = 1500
+SNOW_TEMP = -500
+CLOUD_TEMP = 500
+
+# Calibration: (band name, LMAX, LMIN) of Landsat 5 TM and Landsat 7 ETM+
+#   (low gain) and the solar irradiance of the reflective bands (Chander
+#   et al. 2009)
+CALIBRATION = {
+    4: [('1', 193.0, -1.52), ('2', 365.0, -2.84), ('3', 264.0, -1.17),
+        ('4', 221.0, -1.51), ('5', 30.2, -0.37), ('6', 15.303, 1.238),
+        ('7', 16.5, -0.15)],
+    5: [('1', 193.0, -1.52), ('2', 365.0, -2.84), ('3', 264.0, -1.17),
+        ('4', 221.0, -1.51), ('5', 30.2, -0.37), ('6', 15.303, 1.238),
+        ('7', 16.5, -0.15)],
+    7: [('1', 293.7, -6.2), ('2', 300.9, -6.4), ('3', 234.4, -5.0),
+        ('4', 241.1, -5.1), ('5', 47.57, -1.0), ('6_VCID_1', 17.04, 0.0),
+        ('7', 16.54, -0.35)],
+}
+ESUN = {
+    4: [1983.0, 1795.0, 1539.0, 1028.0, 219.8, 83.49],
+    5: [1983.0, 1796.0, 1536.0, 1031.0, 220.0, 83.44],
+    7: [1997.0, 1812.0, 1533.0, 1039.0, 230.8, 84.90],
+}
+THERMAL_K = {4: (671.62, 1284.30), 5: (607.76, 1260.56),
+             7: (666.09, 1282.71), 8: (774.89, 1321.08)}
+# Landsat 8 OLI reflectance and TIRS band 10 radiance scaling
+L8_REFLECTANCE = (1.2107, -0.09998)
+L8_RADIANCE_B10 = (22.0018, 0.10033)
+
+SENSOR = {4: 'LT4', 5: 'LT5', 7: 'LE7', 8: 'LC8'}
+
+
+def smooth_field(shape, scale, rs):
+    """ Random field in [0, 1] varying over roughly scale pixels """
+    coarse = (max(2, shape[0] // scale + 2), max(2, shape[1] // scale + 2))
+    field = scipy.ndimage.zoom(rs.rand(*coarse),
+                               (float(shape[0]) / coarse[0],
+                                float(shape[1]) / coarse[1]),
+                               order=3)[:shape[0], :shape[1]]
+    field -= field.min()
+    field /= max(field.max(), 1e-6)
+    return field.astype('float32')
+
+
+def cloud_objects(shape, clouds, cloud_fraction, rs):
+    """ Returns list of (row, col, radius) cloud objects """
+    if clouds <= 0 or cloud_fraction <= 0:
+        return []
+    area = cloud_fraction * shape[0] * shape[1] / clouds
+    radii = numpy.sqrt(area / math.pi) * rs.lognormal(0, 0.3, clouds)
+    # Rescale so the (non overlapping) areas add up to the cloud fraction
+    radii *= math.sqrt(cloud_fraction * shape[0] * shape[1] /
+                       (math.pi * (radii ** 2).sum()))
+    rows = rs.randint(0, shape[0], clouds)
+    cols = rs.randint(0, shape[1], clouds)
+    return [(r, c, max(2.0, rad)) for r, c, rad in zip(rows, cols, radii)]
+
+
+def paint_disk(mask, row, col, radius, drow=0, dcol=0):
+    """ Set pixels within radius of (row + drow, col + dcol) in mask """
+    row, col = row + drow, col + dcol
+    r0, r1 = int(max(0, row - radius)), int(min(mask.shape[0], row + radius + 1))
+    c0, c1 = int(max(0, col - radius)), int(min(mask.shape[1], col + radius + 1))
+    if r0 >= r1 or c0 >= c1:
+        return
+    yy, xx = numpy.ogrid[r0:r1, c0:c1]
+    mask[r0:r1, c0:c1] |= (yy - row) ** 2 + (xx - col) ** 2 <= radius ** 2
+
+
+def scene_layers(size, cloud_fraction=0.3, clouds=100, water_fraction=0.1,
+                 snow_fraction=0.05, sun_azimuth=140.0, sun_elevation=55.0,
+                 resolution=30.0, seed=0):
+    """ Class layers of a synthetic scene
+
+    Returns:
+    dict of boolean layers 'fill', 'water', 'snow', 'cloud', 'shadow' and the
+    float32 land variation 'land' in [0, 1]
+    """
+    rs = numpy.random.RandomState(seed)
+    shape = (size, size)
+
+    yy, xx = numpy.ogrid[:size, :size]
+    # Slanted no-data frame, like the footprint of a Level 1 product
+    fill = (xx + yy * 0.2 < size * 0.05) | (xx - yy * 0.2 > size * 0.95)
+
+    land = smooth_field(shape, max(8, size // 50), rs)
+
+    water = numpy.zeros(shape, bool)
+    if water_fraction > 0:
+        field = smooth_field(shape, max(16, size // 8), rs)
+        water = field < numpy.percentile(field, 100.0 * water_fraction)
+    snow = numpy.zeros(shape, bool)
+    if snow_fraction > 0:
+        field = smooth_field(shape, max(16, size // 8), rs)
+        field[water] = 0
+        snow = field > numpy.percentile(field, 100.0 * (1 - snow_fraction))
+
+    # Clouds and their shadows, displaced away from the sun
+    cloud = numpy.zeros(shape, bool)
+    shadow = numpy.zeros(shape, bool)
+    zen = math.radians(90.0 - sun_elevation)
+    azi = math.radians(sun_azimuth)
+    for row, col, radius in cloud_objects(shape, clouds, cloud_fraction, rs):
+        paint_disk(cloud, row, col, radius)
+        height = rs.uniform(1000.0, 5000.0)
+        distance = height * math.tan(zen) / resolution
+        paint_disk(shadow, row, col, radius,
+                   drow=distance * math.cos(azi),
+                   dcol=-distance * math.sin(azi))
+    shadow &= ~cloud
+
+    return {'fill': fill, 'land': land, 'water': water, 'snow': snow,
+            'cloud': cloud, 'shadow': shadow}
+
+
+def band_values(layers, i, rs):
+    """ TOA reflectance x 10000 of reflective band i (0-5) """
+    shape = layers['land'].shape
+    band = LAND[i] + LAND_RANGE[i] * layers['land']
+    band += rs.randn(*shape).astype('float32') * (LAND_RANGE[i] * 0.05)
+    band[layers['water']] = WATER[i]
+    band[layers['snow']] = SNOW[i]
+    band[layers['shadow']] *= SHADOW
+    band[layers['cloud']] = CLOUD[i]
+    return band
+
+
+def temperature(layers, rs):
+    """ Brightness temperature in degrees C x 100 """
+    shape = layers['land'].shape
+    temp = LAND_TEMP + 500 * layers['land']
+    temp += rs.randn(*shape).astype('float32') * 50
+    temp[layers['water']] = WATER_TEMP
+    temp[layers['snow']] = SNOW_TEMP
+    temp[layers['cloud']] = CLOUD_TEMP
+    return temp
+
+
+def to_dn(value, vmax, vmin, qmax, qmin, dtype):
+    """ Invert the linear DN calibration, leaving 0 for no data """
+    dn = (value - vmin) * ((qmax - qmin) / (vmax - vmin)) + qmin
+    return numpy.clip(numpy.round(dn), qmin, qmax).astype(dtype)
+
+
+def write_band(filename, dn, fill, geoT, prj):
+    dn[fill] = 0
+    ds = gdal.GetDriverByName('GTiff').Create(
+        filename, dn.shape[1], dn.shape[0], 1,
+        gdal.GDT_Byte if dn.dtype == numpy.uint8 else gdal.GDT_UInt16)
+    ds.SetGeoTransform(geoT)
+    ds.SetProjection(prj)
+    ds.GetRasterBand(1).WriteArray(dn)
+    ds = None
+
+
+def make_scene(directory, size=1024, lnum=5, cloud_fraction=0.3, clouds=100,
+               water_fraction=0.1, snow_fraction=0.05, sun_azimuth=140.0,
+               sun_elevation=55.0, doy=180, seed=0):
+    """ Write a synthetic Landsat scene and return the MTL filename
+
+    Arguments:
+    'directory'         output directory, created if needed
+    'size'              number of rows and columns
+    'lnum'              Landsat number (4, 5, 7 or 8)
+    'cloud_fraction'    approximate fraction of the scene covered by clouds
+    'clouds'            number of cloud objects
+    'water_fraction'    fraction of the scene covered by water
+    'snow_fraction'     fraction of the scene covered by snow
+    'sun_azimuth'       solar azimuth (degrees)
+    'sun_elevation'     solar elevation (degrees)
+    'doy'               day of year of the acquisition
+    'seed'              random seed
+    """
+    if lnum not in SENSOR:
+        raise ValueError('Landsat number must be one of 4, 5, 7 or 8')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    resolution = 30.0
+    rs = numpy.random.RandomState(seed)
+    layers = scene_layers(size, cloud_fraction, clouds, water_fraction,
+                          snow_fraction, sun_azimuth, sun_elevation,
+                          resolution, seed)
+    fill = layers['fill']
+
+    scene_id = '{s}{p:03d}{r:03d}{y}{d:03d}LGN00'.format(
+        s=SENSOR[lnum], p=12, r=31, y=2011, d=doy)
+    path = lambda band: os.path.join(directory,
+                                     '{i}_B{b}.TIF'.format(i=scene_id, b=band))
+
+    ul = (300000.0, 4700000.0)
+    geoT = (ul[0], resolution, 0, ul[1], 0, -resolution)
+    srs = osr.SpatialReference()
+    srs.SetWellKnownGeogCS('WGS84')
+    srs.SetUTM(18, True)
+    prj = srs.ExportToWkt()
+
+    zen = math.radians(90.0 - sun_elevation)
+    dsun = sun_earth_distance[doy]
+    K1, K2 = THERMAL_K[lnum]
+    # Brightness temperature to radiance
+    radiance = K1 / (numpy.exp(K2 / (temperature(layers, rs) / 100.0 +
+                                     273.15)) - 1)
+
+    mtl = [('SPACECRAFT_ID', '"LANDSAT_%d"' % lnum),
+           ('LANDSAT_SCENE_ID', '"%s"' % scene_id)]
+    if lnum < 8:
+        qmax, qmin = 255.0, 1.0
+        bands = CALIBRATION[lnum]
+        reflective = [b for b in bands if not b[0].startswith('6')]
+        for i, (name, lmax, lmin) in enumerate(reflective):
+            # Reflectance to radiance (inverse of nd2toarbt)
+            band = band_values(layers, i, rs)
+            band *= ESUN[lnum][i] * math.cos(zen) / (
+                10000.0 * math.pi * dsun * dsun)
+            write_band(path(name), to_dn(band, lmax, lmin, qmax, qmin,
+                                         numpy.uint8), fill, geoT, prj)
+        name, lmax, lmin = bands[5]
+        write_band(path(name), to_dn(radiance, lmax, lmin, qmax, qmin,
+                                     numpy.uint8), fill, geoT, prj)
+        for name, lmax, lmin in bands:
+            mtl += [('RADIANCE_MAXIMUM_BAND_' + name, lmax),
+                    ('RADIANCE_MINIMUM_BAND_' + name, lmin),
+                    ('QUANTIZE_CAL_MAX_BAND_' + name, int(qmax)),
+                    ('QUANTIZE_CAL_MIN_BAND_' + name, int(qmin))]
+    else:
+        qmax, qmin = 65535.0, 1.0
+        rmax, rmin = L8_REFLECTANCE
+        # Bands 2-7, then cirrus band 9 with a little thin cirrus signal
+        for i, name in enumerate(['2', '3', '4', '5', '6', '7', '9']):
+            if name == '9':
+                band = 20 + 30 * layers['land']
+                band[layers['cloud']] = 60
+            else:
+                band = band_values(layers, i, rs)
+            band *= math.cos(zen) / 10000.0
+            write_band(path(name), to_dn(band, rmax, rmin, qmax, qmin,
+                                         numpy.uint16), fill, geoT, prj)
+            mtl += [('REFLECTANCE_MAXIMUM_BAND_' + name, rmax),
+                    ('REFLECTANCE_MINIMUM_BAND_' + name, rmin)]
+        lmax, lmin = L8_RADIANCE_B10
+        write_band(path('10'), to_dn(radiance, lmax, lmin, qmax, qmin,
+                                     numpy.uint16), fill, geoT, prj)
+        for name in ['2', '3', '4', '5', '6', '7', '9', '10']:
+            mtl += [('RADIANCE_MAXIMUM_BAND_' + name, lmax),
+                    ('RADIANCE_MINIMUM_BAND_' + name, lmin),
+                    ('QUANTIZE_CAL_MAX_BAND_' + name, int(qmax)),
+                    ('QUANTIZE_CAL_MIN_BAND_' + name, int(qmin))]
+    del radiance
+
+    mtl += [('REFLECTIVE_LINES', size), ('REFLECTIVE_SAMPLES', size),
+            ('THERMAL_LINES', size), ('THERMAL_SAMPLES', size),
+            ('GRID_CELL_SIZE_REFLECTIVE', resolution),
+            ('GRID_CELL_SIZE_THERMAL', resolution),
+            ('UTM_ZONE', 18),
+            ('SUN_AZIMUTH', sun_azimuth), ('SUN_ELEVATION', sun_elevation),
+            ('CORNER_UL_PROJECTION_X_PRODUCT', ul[0]),
+            ('CORNER_UL_PROJECTION_Y_PRODUCT', ul[1])]
+    mtl_fname = os.path.join(directory, scene_id + '_MTL.txt')
+    with open(mtl_fname, 'w') as f:
+        f.write('GROUP = L1_METADATA_FILE\n')
+        for key, value in mtl:
+            f.write('    {k} = {v}\n'.format(k=key, v=value))
+        f.write('END_GROUP = L1_METADATA_FILE\nEND\n')
+
+    valid = float((~fill).sum())
+    info = {'size': size, 'lnum': lnum, 'clouds': clouds, 'seed': seed,
+            'cloud_fraction': (layers['cloud'] & ~fill).sum() / valid,
+            'shadow_fraction': (layers['shadow'] & ~fill).sum() / valid,
+            'water_fraction': (layers['water'] & ~fill).sum() / valid,
+            'snow_fraction': (layers['snow'] & ~fill).sum() / valid}
+    with open(os.path.join(directory, 'scene.json'), 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+    return mtl_fname
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Writes a synthetic Landsat scene (band GeoTIFFs and MTL file) for benchmarking Fmask.')
+    parser.add_argument('directory', help='The output directory.')
+    parser.add_argument('--size', type=int, default=1024, help='The number of rows and columns. Default is 1024.')
+    parser.add_argument('--lnum', type=int, choices=sorted(SENSOR), default=5, help='The Landsat number. Default is 5.')
+    parser.add_argument('--cloud_fraction', type=float, default=0.3, help='The approximate fraction of the scene covered by clouds. Default is 0.3.')
+    parser.add_argument('--clouds', type=int, default=100, help='The number of cloud objects. Default is 100.')
+    parser.add_argument('--water_fraction', type=float, default=0.1, help='The fraction of the scene covered by water. Default is 0.1.')
+    parser.add_argument('--snow_fraction', type=float, default=0.05, help='The fraction of the scene covered by snow. Default is 0.05.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed. Default is 0.')
+
+    args = parser.parse_args()
+    print(make_scene(args.directory, args.size, args.lnum,
+                     args.cloud_fraction, args.clouds, args.water_fraction,
+                     args.snow_fraction, seed=args.seed))
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Run Fmask over many scenes with a pool of worker processes.
+
+Scenes are given as directories (searched recursively for ``*_MTL.txt`` and
+scene archives), MTL files, scene archives (.tar.gz, .tgz or .tar, read in
+place through GDAL's /vsitar/), or manifests listing one MTL or archive path
+per line. Each scene is written to ``<outdir>/<scene id>`` by run_FMask.
+
+The number of scenes running at once is limited both by ``processes`` and by a
+memory budget. The peak memory of a scene is estimated from the dimension of
+its reflectance bands (``ijdim_ref`` from the MTL) times ``bytes_per_pixel``,
+less what an int16 or tiled run does not hold (see pixel_bytes).
+Pending scenes are admitted first-fit, in the order given, while the estimates
+of the running scenes fit the budget. A scene larger than the whole budget is
+run on its own.
+
+A scene is skipped if its output directory already holds a summary record
+from a successful run (use ``overwrite`` to rerun it). The record, a JSON
+file written once all outputs are on disk, holds the run_FMask summary plus
+timing, memory estimate and peak RSS of the worker. Every record, including
+skipped and failed scenes, is also appended as one JSON line to the batch log.
+
+With a scene catalog (see fmask_catalog), the memory estimate, MTL fields and
+band files of the cataloged scenes come from the catalog, so neither the
+batch nor its workers parse their MTL files or list their directories.
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from fmask_catalog import Catalog, register
+from fmask_cloud_masking_edit import TOA_DTYPES, lndhdrread, run_FMask
+from fmask_imfill import FILLS
+from fmask_io import find_mtls, scene_id, scene_mtl
+from fmask_match import SEARCHES
+from fmask_output import PROFILES
+from fmask_profile import peak_rss
+
+logger = logging.getLogger('root.' + __name__)
+
+# Rough peak bytes per reflectance band pixel of plcloud + fcssm: six float32
+#   reflectance bands and float32 BT (28 bytes) plus the float probability
+#   layers, uint8 masks and temporaries
+BYTES_PER_PIXEL = 64
+# Of which the float32 reflectance stack and BT
+STACK_BYTES_PER_PIXEL = 28
+
+# Seconds a task is waited for after its worker exited before it is
+#   recorded as failed
+WORKER_GRACE = 5
+
+# Set in pool workers by _init_worker
+_started = None
+
+# Written to each scene's output directory after a successful run
+SUMMARY_FNAME = 'fmask_summary.json'
+# Per stage timing & memory use, written when profiling (see fmask_profile)
+PROFILE_FNAME = 'fmask_profile.json'
+
+
+def pixel_bytes(bytes_per_pixel=BYTES_PER_PIXEL, dtype='float32',
+                tiled=False):
+    """ Estimated peak bytes per pixel of run_FMask with dtype and tiled
+
+    Arguments:
+    'bytes_per_pixel'   estimate for the whole scene held as float32
+    'dtype'             type of the reflectance and BT (see nd2toarbt)
+    'tiled'             the scene is read and tested block by block (see
+                        plcloud_tiled)
+    """
+    if tiled:
+        # The stack is read window by window; Band 4 & 5 are kept (float32)
+        #   and Temp in dtype
+        saved = STACK_BYTES_PER_PIXEL - 8 - (2 if dtype == 'int16' else 4)
+    elif dtype == 'int16':
+        saved = STACK_BYTES_PER_PIXEL // 2
+    else:
+        saved = 0
+    return bytes_per_pixel - saved
+
+
+def scene_memory(mtl, bytes_per_pixel=BYTES_PER_PIXEL, dtype='float32',
+                 tiled=False):
+    """ Estimated peak memory in bytes for running Fmask on MTL """
+    lines, samples = lndhdrread(scene_mtl(mtl))[6] # ijdim_ref
+    return int(lines) * int(samples) * pixel_bytes(bytes_per_pixel, dtype,
+                                                   tiled)
+
+
+def read_summary(scene_outdir):
+    """ Returns summary record of a finished scene, or None """
+    fname = os.path.join(scene_outdir, SUMMARY_FNAME)
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            record = json.load(f)
+    except ValueError:
+        return None
+    if record.get('status') != 'done':
+        return None
+    return record
+
+
+def _init_worker(started):
+    # Queue the workers report the scenes they start on
+    global _started
+    _started = started
+
+
+def _run_scene(job):
+    """ Run Fmask for one scene in a pool worker and return its record """
+    if _started is not None:
+        # Sent before the scene starts (each worker runs one scene)
+        _started.put((job['outdir'], os.getpid()))
+        _started.close()
+        _started.join_thread()
+    record = {'mtl': job['mtl'], 'outdir': job['outdir'],
+              'memory_estimate': job['memory_estimate'],
+              'pid': os.getpid(),
+              'start': datetime.datetime.now().isoformat()}
+    st = time.time()
+    mtl = job['mtl']
+    try:
+        if job['scene'] is not None:
+            # MTL fields & band files from the catalog
+            register(job['scene'])
+            mtl = job['scene']['mtl']
+        summary = run_FMask(mtl, job['outdir'], **job['kwargs'])
+        record.update(summary)
+        record['status'] = 'done'
+        record['seconds'] = time.time() - st
+        record['peak_rss'] = peak_rss()
+        with open(os.path.join(job['outdir'], SUMMARY_FNAME), 'w') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+    except Exception:
+        record['status'] = 'failed'
+        record['error'] = traceback.format_exc()
+        record['seconds'] = time.time() - st
+        record['peak_rss'] = peak_rss()
+    return record
+
+
+def _failed(job, error):
+    """ Record of a scene whose worker raised or died """
+    return {'mtl': job['mtl'], 'outdir': job['outdir'],
+            'memory_estimate': job['memory_estimate'], 'status': 'failed',
+            'error': error}
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _finished(task):
+    """ Record of a running task (dict of its job, AsyncResult & worker
+    pid) if it finished, failed or its worker died, else None
+    """
+    if task['result'].ready():
+        try:
+            return task['result'].get()
+        except Exception:
+            # Raised in the worker, or its record could not be pickled
+            return _failed(task['job'], traceback.format_exc())
+    if task['pid'] is not None and not _alive(task['pid']):
+        # The result of a worker that just exited may still be on its way
+        if task['dead'] is None:
+            task['dead'] = time.time()
+        elif time.time() - task['dead'] > WORKER_GRACE:
+            return _failed(task['job'], 'Worker {p} died without a result '
+                           '(killed, e.g. by the out of memory killer)'.format(
+                               p=task['pid']))
+    return None
+
+
+def run_batch(mtls, outdir, memory, processes=None,
+              bytes_per_pixel=BYTES_PER_PIXEL, overwrite=False, log=None,
+              profile=False, catalog=None, **kwargs):
+    """ Run Fmask for each MTL within a memory budget
+
+    Arguments:
+    'mtls'              list of MTL files or scene archives
+    'outdir'            output directory; scene results go in subdirectories
+    'memory'            memory budget in bytes shared by running scenes
+    'processes'         maximum number of scenes run at once (default: CPUs)
+    'bytes_per_pixel'   estimated peak bytes per reflectance band pixel,
+                        for a float32 whole scene run (see pixel_bytes)
+    'overwrite'         rerun scenes that already finished
+    'log'               file the records are appended to as JSON lines
+                        (default: <outdir>/fmask_batch.jsonl)
+    'profile'           write the stages of each scene to PROFILE_FNAME in
+                        the scene output directory
+    'catalog'           optional Catalog the metadata of the scenes is
+                        taken from, for the scenes it holds up to date
+    'kwargs'            passed to run_FMask
+
+    Returns:
+    list of records (dicts), one per scene, in order of completion
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if log is None:
+        log = os.path.join(outdir, 'fmask_batch.jsonl')
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    records = []
+    log_file = open(log, 'a')
+
+    def finish(record):
+        records.append(record)
+        log_file.write(json.dumps(record, sort_keys=True) + '\n')
+        log_file.flush()
+        logger.info('{s} {m} ({n}/{t})'.format(
+            s=record['status'], m=record['mtl'], n=len(records),
+            t=len(mtls)))
+
+    per_pixel = pixel_bytes(bytes_per_pixel, kwargs.get('dtype', 'float32'),
+                            kwargs.get('tiled', False))
+    pending = []
+    for mtl in mtls:
+        scene_outdir = os.path.join(outdir, scene_id(mtl))
+        if not overwrite and read_summary(scene_outdir) is not None:
+            finish({'mtl': mtl, 'outdir': scene_outdir, 'status': 'skipped'})
+            continue
+        scene = None
+        if catalog is not None:
+            scene = catalog.scene(mtl, register_io=False)
+        try:
+            if scene is not None:
+                estimate = scene['lines'] * scene['samples'] * per_pixel
+            else:
+                estimate = scene_memory(mtl, bytes_per_pixel,
+                                        kwargs.get('dtype', 'float32'),
+                                        kwargs.get('tiled', False))
+        except Exception:
+            finish({'mtl': mtl, 'outdir': scene_outdir, 'status': 'failed',
+                    'error': traceback.format_exc()})
+            continue
+        if estimate > memory:
+            logger.warning('{m} needs an estimated {e} bytes, more than the '
+                           'memory budget. It will be run on its own.'.format(
+                               m=mtl, e=estimate))
+        scene_kwargs = dict(kwargs)
+        if profile:
+            scene_kwargs['profile'] = os.path.join(scene_outdir,
+                                                   PROFILE_FNAME)
+        pending.append({'mtl': mtl, 'outdir': scene_outdir,
+                        'memory_estimate': estimate, 'scene': scene,
+                        'kwargs': scene_kwargs})
+
+    # Fresh worker per scene so each scene's memory is returned to the OS and
+    #   ru_maxrss is the peak of that scene alone
+    #   The workers report the pid running each scene, so a scene whose
+    #   worker is killed is recorded as failed instead of waited for forever
+    started = multiprocessing.Queue()
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(started, ), maxtasksperchild=1)
+    running = []
+    used = 0
+    try:
+        while pending or running:
+            # Admit pending scenes, first fit, while they fit the budget
+            i = 0
+            while i < len(pending) and len(running) < processes:
+                job = pending[i]
+                if not running or used + job['memory_estimate'] <= memory:
+                    pending.pop(i)
+                    running.append({
+                        'job': job, 'pid': None, 'dead': None,
+                        'result': pool.apply_async(_run_scene, (job, ))})
+                    used += job['memory_estimate']
+                else:
+                    i += 1
+
+            # Wait for a scene to finish (with timeout so ^C is delivered)
+            record = None
+            while record is None:
+                for task in running:
+                    record = _finished(task)
+                    if record is not None:
+                        running.remove(task)
+                        break
+                else:
+                    try:
+                        outdir, pid = started.get(True, 1)
+                    except queue.Empty:
+                        continue
+                    for task in running:
+                        if task['job']['outdir'] == outdir:
+                            task['pid'] = pid
+            used -= task['job']['memory_estimate']
+            finish(record)
+    finally:
+        pool.terminate()
+        pool.join()
+        log_file.close()
+
+    return records
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Computes the Fmask algorithm for many scenes using a pool of processes. Scenes are run concurrently as long as their estimated memory use fits the memory budget.')
+    parser.add_argument('paths', nargs='+', help='Directories searched for *_MTL.txt files and scene archives, MTL files, scene archives (.tar.gz, .tgz or .tar, read without extracting them), or manifests listing one MTL file or archive per line.')
+    parser.add_argument('--outdir', required=True, help='The output directory. The results of each scene are written to a subdirectory named after the scene.')
+    parser.add_argument('--memory', type=float, default=16, help='The memory budget shared by the running scenes, in GiB. Default is 16.')
+    parser.add_argument('--processes', type=int, default=None, help='The maximum number of scenes run at once. Default is the number of CPUs.')
+    parser.add_argument('--bytes_per_pixel', type=int, default=BYTES_PER_PIXEL, help='The estimated peak memory use per pixel of a scene run as float32 without --tiled, in bytes; --dtype int16 and --tiled scenes are estimated to need less. Default is %d.' % BYTES_PER_PIXEL)
+    parser.add_argument('--overwrite', action='store_true', help='Rerun scenes that already have results.')
+    parser.add_argument('--log', default=None, help='The file scene records are appended to as JSON lines. Default is fmask_batch.jsonl in the output directory.')
+    parser.add_argument('--cldprob', type=float, default=22.5, help='The cloud probability for the scene. Default is 22.5 percent.')
+    parser.add_argument('--cldpix', type=int, default=3, help='The number of pixels to be dilated for the cloud mask. Default is 3.')
+    parser.add_argument('--sdpix', type=int, default=3, help='The number of pixels to be dilated for the cloud shadow mask. Default is 3.')
+    parser.add_argument('--snpix', type=int, default=3, help='The number of pixels to be dilated for the snow mask. Default is 3.')
+    parser.add_argument('--tiled', action='store_true', help='Read and test each scene block by block to reduce peak memory use.')
+    parser.add_argument('--block_lines', type=int, default=512, help='The number of lines in each block when --tiled is used. Default is 512.')
+    parser.add_argument('--search', choices=SEARCHES, default='exhaustive', help='The cloud height search used for cloud shadow matching. Default is exhaustive.')
+    parser.add_argument('--fill', choices=FILLS, default='skimage', help='The flood fill of the cloud shadow probability: skimage, or uint16 (faster, on the reflectance quantized to 16 bit levels). Default is skimage.')
+    parser.add_argument('--dtype', choices=TOA_DTYPES, default='float32', help='The type the reflectance and temperature of each scene are held in: float32, or int16 (half the memory, values rounded to 0.0001 reflectance and 0.01 degrees). Default is float32.')
+    parser.add_argument('--output', choices=PROFILES, default='envi', help='The output profile: envi (uncompressed ENVI), gtiff (uncompressed GeoTIFF), deflate or zstd (tiled, compressed GeoTIFF) or cog (Cloud Optimized GeoTIFF with overviews). Default is envi.')
+    parser.add_argument('--multiband', action='store_true', help='Write the cloud, cloud shadow and Fmask rasters of each scene as the bands of a single file.')
+    parser.add_argument('--profile', action='store_true', help='Write the wall time and memory use of each processing stage of each scene to %s in its output directory.' % PROFILE_FNAME)
+    parser.add_argument('--catalog', default=None, help='A SQLite scene catalog (see fmask_catalog.py). New and changed scenes are indexed in it, and the metadata of all scenes is read from it.')
+
+    parsed_args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    logging.basicConfig()
+
+    mtls = find_mtls(parsed_args.paths)
+    logger.info('Found {n} scenes'.format(n=len(mtls)))
+
+    catalog = None
+    if parsed_args.catalog:
+        catalog = Catalog(parsed_args.catalog)
+        catalog.index(mtls)
+
+    # Scenes run in daemonic pool workers, which cannot start their own
+    #   matching pool, so each scene matches with n_jobs=1
+    records = run_batch(mtls, parsed_args.outdir,
+                        int(parsed_args.memory * 1024 ** 3),
+                        processes=parsed_args.processes,
+                        bytes_per_pixel=parsed_args.bytes_per_pixel,
+                        overwrite=parsed_args.overwrite,
+                        log=parsed_args.log,
+                        profile=parsed_args.profile,
+                        catalog=catalog,
+                        cldprob=parsed_args.cldprob,
+                        cldpix=parsed_args.cldpix,
+                        sdpix=parsed_args.sdpix,
+                        snpix=parsed_args.snpix,
+                        tiled=parsed_args.tiled,
+                        block_lines=parsed_args.block_lines,
+                        search=parsed_args.search,
+                        fill=parsed_args.fill,
+                        dtype=parsed_args.dtype,
+                        output=parsed_args.output,
+                        multiband=parsed_args.multiband)
+
+    failed = [r for r in records if r['status'] == 'failed']
+    if failed:
+        logger.error('{n} scenes failed'.format(n=len(failed)))
+        raise SystemExit(1)
@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+Packed class layers for plcloud and fcssm.
+
+plcloud returns the water, snow, cloud and cloud shadow layers as four full
+scene uint8 rasters, and fcssm turned them into five more (cloud_test,
+shadow_test, boundary_test, cloud_cal, shadow_cal) before composing the final
+mask. Each of these holds one bit of information per pixel, so they are kept
+instead as bit planes of a single uint8 raster:
+
+VALID           inside the scene footprint (plcloud's mask, the boundary
+                layer of fcssm)
+CLOUD           potential cloud (plcloud's Cloud == 1)
+SHADOW          potential cloud shadow (plcloud's Shadow == 1)
+WATER           water (plcloud's WT == 1)
+SNOW            snow (plcloud's Snow == 1)
+MATCHED_SHADOW  cloud shadow matched to a cloud by fcssm, before dilation
+
+Layers are tested with ``masks & BIT``. Class rasters such as the final
+Fmask are one lookup of the packed raster in a 256 entry table (classes), and
+the pixel count of every bit combination is one bincount (counts).
+"""
+import numpy
+
+VALID = 1
+CLOUD = 2
+SHADOW = 4
+WATER = 8
+SNOW = 16
+MATCHED_SHADOW = 32
+
+# Class values of the final Fmask, lowest priority first (see fcssm_dilate)
+FMASK_CODES = ((WATER, 1), (SNOW, 3), (MATCHED_SHADOW, 2), (CLOUD, 4))
+FMASK_OUTSIDE = 255
+
+
+def pack(WT, Snow, Cloud, Shadow, out=None):
+    """ Pack the water, snow, cloud and shadow layers of plcloud
+
+    Arguments:
+    'WT'            water layer (1 is water)
+    'Snow'          snow layer (1 is snow)
+    'Cloud'         cloud layer (1 is cloud, 255 outside the scene)
+    'Shadow'        cloud shadow layer (1 is potential shadow)
+    'out'           optional uint8 array to pack into
+
+    Returns:
+    packed uint8 mask raster
+    """
+    if out is None:
+        out = numpy.empty(Cloud.shape, numpy.uint8)
+    numpy.less(Cloud, 255, out=out.view(numpy.bool_))
+    for layer, bit in ((Cloud, CLOUD), (Shadow, SHADOW), (WT, WATER),
+                       (Snow, SNOW)):
+        numpy.bitwise_or(out, bit, out=out, where=(layer == 1))
+    return out
+
+
+def layer(masks, bits):
+    """ Boolean raster of the pixels with any of bits set """
+    return numpy.bitwise_and(masks, bits) != 0
+
+
+def lookup(codes, outside=0):
+    """ 256 entry uint8 table of the class of each packed value
+
+    Arguments:
+    'codes'         sequence of (bits, value): pixels with any of bits set
+                    are value, later entries taking precedence; other pixels
+                    inside the scene are 0
+    'outside'       value of the pixels outside the scene (VALID unset), or
+                    None to classify them like the others
+    """
+    packed = numpy.arange(256)
+    table = numpy.zeros(256, numpy.uint8)
+    for bits, value in codes:
+        table[(packed & bits) != 0] = value
+    if outside is not None:
+        table[(packed & VALID) == 0] = outside
+    return table
+
+
+def classes(masks, codes, outside=0):
+    """ Class raster of the packed masks (see lookup) """
+    return lookup(codes, outside)[masks]
+
+
+def counts(masks):
+    """ Number of pixels of each of the 256 packed values """
+    return numpy.bincount(masks.ravel(), minlength=256)
+
+
+def count(hist, bits):
+    """ Number of pixels with all of bits set, given counts(masks) """
+    return hist[(numpy.arange(256) & bits) == bits].sum()
+
+
+def unpack(masks):
+    """ The (WT, Snow, Cloud, Shadow) uint8 layers as returned by plcloud """
+    return (classes(masks, ((WATER, 1), ), outside=255),
+            classes(masks, ((SNOW, 1), ), outside=None),
+            classes(masks, ((CLOUD, 1), ), outside=255),
+            classes(masks, ((SHADOW, 1), ), outside=255))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+SQLite catalog of Landsat scenes, built from their MTL files.
+
+index reads each scene once: its MTL file, parsed by the parser shared with
+lndhdrread (fmask_io.read_mtl), and the names of the files of its directory
+or archive. Both are stored with the scene, along with the metadata used to
+select and plan runs as columns:
+
+'source'            the scene as given: MTL file or archive (absolute path)
+'mtl'               its MTL file (a /vsitar/ path for archives)
+'scene_id'          scene identifier (see fmask_io.scene_id)
+'lnum'              Landsat number
+'acquired'          acquisition date (YYYY-MM-DD)
+'doy'               day of year
+'zen', 'azi'        solar zenith and azimuth angles (degrees)
+'lines', 'samples'  dimension of the reflective bands
+'mtime'             modification time of the MTL file (of the archive)
+'dir_mtime'         modification time of the scene directory (None for
+                    archives)
+
+Indexing is incremental: a scene is read again only if one of its
+modification times changed. A scene looked up in the catalog (scene) is
+registered with fmask_io, so processing it parses no MTL file and lists no
+directory or archive again. The calibration constants and other lndhdrread
+outputs are derived from the stored MTL fields.
+
+    python fmask_catalog.py catalog.sqlite index /data/landsat
+    python fmask_catalog.py catalog.sqlite query --lnum 5 7 --max_zen 60 > scenes.txt
+    python fmask_batch.py scenes.txt --outdir out --catalog catalog.sqlite
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+
+from fmask_cloud_masking_edit import lndhdrread
+from fmask_io import (cache_directory, find_mtls, is_archive, is_virtual,
+                      listdir, mtime, read_mtl, register_scene, scene_id,
+                      scene_mtl, unregister_scene)
+
+logger = logging.getLogger('root.' + __name__)
+
+# Bump when the columns or the stored fields change
+CATALOG_VERSION = 1
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    source TEXT PRIMARY KEY,
+    mtl TEXT NOT NULL,
+    scene_id TEXT,
+    lnum INTEGER,
+    acquired TEXT,
+    doy INTEGER,
+    zen REAL,
+    azi REAL,
+    lines INTEGER,
+    samples INTEGER,
+    mtime REAL,
+    dir_mtime REAL,
+    fields TEXT,
+    files TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_acquired ON scenes (acquired);
+'''
+
+_COLUMNS = ('source', 'mtl', 'scene_id', 'lnum', 'acquired', 'doy', 'zen',
+            'azi', 'lines', 'samples', 'mtime', 'dir_mtime', 'fields',
+            'files')
+
+
+def _source(path):
+    return path if is_virtual(path) else os.path.abspath(path)
+
+
+def _stamps(source):
+    """ (mtime, dir_mtime) of a scene given as MTL file or archive """
+    if is_archive(source) or is_virtual(source):
+        return mtime(source), None
+    return (os.path.getmtime(source),
+            os.path.getmtime(os.path.dirname(source)))
+
+
+def scene_record(source):
+    """ Read the catalog record of a scene (a dict of the columns, with the
+    MTL fields and file names as dict and list)
+    """
+    source = _source(source)
+    stamps = _stamps(source)
+    mtl = scene_mtl(source)
+    # What was registered for the scene may be out of date
+    unregister_scene(mtl)
+
+    fields = read_mtl(mtl)
+    header = lndhdrread(mtl)
+    lines, samples = header[6]
+    return {'source': source, 'mtl': mtl, 'scene_id': scene_id(source),
+            'lnum': header[14],
+            'acquired': fields.get('DATE_ACQUIRED',
+                                   fields.get('ACQUISITION_DATE')),
+            'doy': header[15], 'zen': float(header[11]),
+            'azi': float(header[12]), 'lines': lines, 'samples': samples,
+            'mtime': stamps[0], 'dir_mtime': stamps[1], 'fields': fields,
+            'files': sorted(listdir(os.path.dirname(mtl)))}
+
+
+def register(record):
+    """ Register a catalog record with fmask_io (see register_scene) """
+    register_scene(record['mtl'], record['mtime'], record['fields'],
+                   record['files'])
+
+
+class Catalog(object):
+    """ SQLite catalog of scenes
+
+    Arguments:
+    'filename'          catalog file, created if needed (default:
+                        catalog.sqlite in the per user directory of
+                        fmask_io.cache_directory)
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            # Another user could plant the MTL fields registered by scene
+            #   in a shared catalog
+            directory = cache_directory()
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            filename = os.path.join(directory, 'catalog.sqlite')
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        # Native str paths on Python 2
+        self.db.text_factory = str
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != \
+                CATALOG_VERSION:
+            self.db.executescript('DROP TABLE IF EXISTS scenes;' + _SCHEMA)
+            self.db.execute('PRAGMA user_version = {v}'.format(
+                v=CATALOG_VERSION))
+            self.db.commit()
+
+    def index(self, mtls):
+        """ Add new and changed scenes to the catalog
+
+        Arguments:
+        'mtls'          list of MTL files or scene archives (see
+                        fmask_io.find_mtls)
+
+        Returns:
+        number of scenes read
+        """
+        indexed = 0
+        for source in mtls:
+            source = _source(source)
+            row = self.db.execute(
+                'SELECT mtime, dir_mtime FROM scenes WHERE source = ?',
+                (source, )).fetchone()
+            try:
+                if row is not None and \
+                        (row['mtime'], row['dir_mtime']) == _stamps(source):
+                    continue
+                record = scene_record(source)
+            except Exception as e:
+                logger.warning('Could not index {s}: {e}'.format(s=source,
+                                                                 e=e))
+                continue
+            record = dict(record, fields=json.dumps(record['fields']),
+                          files=json.dumps(record['files']))
+            self.db.execute(
+                'INSERT OR REPLACE INTO scenes ({c}) VALUES ({v})'.format(
+                    c=', '.join(_COLUMNS), v=', '.join('?' * len(_COLUMNS))),
+                [record[c] for c in _COLUMNS])
+            indexed += 1
+        self.db.commit()
+        logger.info('Indexed {n} of {t} scenes'.format(n=indexed,
+                                                       t=len(mtls)))
+        return indexed
+
+    def scene(self, source, register_io=True):
+        """ Catalog record of a scene, or None if not cataloged or changed
+        since
+
+        The record is registered with fmask_io unless register_io is False.
+        """
+        source = _source(source)
+        row = self.db.execute('SELECT * FROM scenes WHERE source = ?',
+                              (source, )).fetchone()
+        if row is None:
+            return None
+        record = dict(zip(row.keys(), row))
+        try:
+            if (record['mtime'], record['dir_mtime']) != _stamps(source):
+                return None
+        except OSError:
+            return None
+        record['fields'] = json.loads(record['fields'])
+        record['files'] = json.loads(record['files'])
+        if register_io:
+            register(record)
+        return record
+
+    def query(self, lnum=None, start=None, end=None, min_zen=None,
+              max_zen=None, max_pixels=None):
+        """ Sources of the cataloged scenes matching all the given criteria,
+        by acquisition date
+
+        Arguments:
+        'lnum'          sequence of Landsat numbers
+        'start', 'end'  first and last acquisition dates (YYYY-MM-DD)
+        'min_zen'       minimum solar zenith angle (degrees)
+        'max_zen'       maximum solar zenith angle (degrees)
+        'max_pixels'    maximum number of reflective band pixels
+        """
+        clauses = []
+        args = []
+        if lnum:
+            clauses.append('lnum IN ({q})'.format(q=', '.join('?' *
+                                                             len(lnum))))
+            args.extend(lnum)
+        for clause, value in (('acquired >= ?', start),
+                              ('acquired <= ?', end),
+                              ('zen >= ?', min_zen),
+                              ('zen <= ?', max_zen),
+                              ('lines * samples <= ?', max_pixels)):
+            if value is not None:
+                clauses.append(clause)
+                args.append(value)
+        sql = 'SELECT source FROM scenes'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY acquired, scene_id'
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Builds and queries a SQLite catalog of Landsat scenes from their MTL files.')
+    parser.add_argument('catalog', help='The catalog file. It is created if it does not exist.')
+    commands = parser.add_subparsers(dest='command')
+    index_parser = commands.add_parser('index', help='Add new and changed scenes to the catalog.')
+    index_parser.add_argument('paths', nargs='+', help='Directories searched for *_MTL.txt files and scene archives, MTL files, scene archives (.tar.gz, .tgz or .tar), or manifests listing one MTL file or archive per line.')
+    query_parser = commands.add_parser('query', help='Print the cataloged scenes matching all the criteria, one per line, by acquisition date. The output is a manifest for fmask_batch.py.')
+    query_parser.add_argument('--lnum', nargs='+', type=int, choices=[4, 5, 7, 8], default=None, help='The Landsat numbers.')
+    query_parser.add_argument('--start', default=None, help='The first acquisition date, as YYYY-MM-DD.')
+    query_parser.add_argument('--end', default=None, help='The last acquisition date, as YYYY-MM-DD.')
+    query_parser.add_argument('--min_zen', type=float, default=None, help='The minimum solar zenith angle, in degrees.')
+    query_parser.add_argument('--max_zen', type=float, default=None, help='The maximum solar zenith angle, in degrees.')
+    query_parser.add_argument('--max_pixels', type=int, default=None, help='The maximum number of pixels of the reflective bands.')
+
+    parsed_args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    logging.basicConfig()
+
+    catalog = Catalog(parsed_args.catalog)
+    if parsed_args.command == 'index':
+        catalog.index(find_mtls(parsed_args.paths))
+    else:
+        for source in catalog.query(lnum=parsed_args.lnum,
+                                    start=parsed_args.start,
+                                    end=parsed_args.end,
+                                    min_zen=parsed_args.min_zen,
+                                    max_zen=parsed_args.max_zen,
+                                    max_pixels=parsed_args.max_pixels):
+            print(source)
+    catalog.close()
@@ -13,7 +13,6 @@
 import sys, re, gc, math, logging
 import datetime
 import os.path
-from glob import glob
 import argparse
 import numpy, numexpr
 import scipy.stats
@@ -22,9 +21,17 @@ import scipy.ndimage.morphology
 from osgeo import gdal
 import skimage
 from skimage import morphology
-from skimage import measure
 from skimage import segmentation
 
+from fmask_io import band_vrt, exists, glob, read_bands, read_mtl, scene_mtl
+from fmask_percentile import StreamingPercentile, masked_percentile
+from fmask_match import SEARCHES, SegmentTable, ShadowMatcher
+from fmask_imfill import FILLS, imfill_uint16
+import fmask_bitmask
+import fmask_morphology
+from fmask_output import PROFILES, extension, write_bands
+import fmask_profile
+
 skimage_version = [int(n) for n in skimage.__version__.split('.') if n != '']
 
 logger = logging.getLogger('root.' + __name__)
@@ -32,8 +39,19 @@ logger = logging.getLogger('root.' + __name__)
 # Sun earth distance look up table
 sun_earth_distance = { 1: 0.98331, 2: 0.98330, 3: 0.98330, 4: 0.98330, 5: 0.98330, 6: 0.98332, 7: 0.98333, 8: 0.98335, 9: 0.98338, 10: 0.98341, 11: 0.98345, 12: 0.98349, 13: 0.98354, 14: 0.98359, 15: 0.98365, 16: 0.98371, 17: 0.98378, 18: 0.98385, 19: 0.98393, 20: 0.98401, 21: 0.98410, 22: 0.98419, 23: 0.98428, 24: 0.98439, 25: 0.98449, 26: 0.98460, 27: 0.98472, 28: 0.98484, 29: 0.98496, 30: 0.98509, 31: 0.98523, 32: 0.98536, 33: 0.98551, 34: 0.98565, 35: 0.98580, 36: 0.98596, 37: 0.98612, 38: 0.98628, 39: 0.98645, 40: 0.98662, 41: 0.98680, 42: 0.98698, 43: 0.98717, 44: 0.98735, 45: 0.98755, 46: 0.98774, 47: 0.98794, 48: 0.98814, 49: 0.98835, 50: 0.98856, 51: 0.98877, 52: 0.98899, 53: 0.98921, 54: 0.98944, 55: 0.98966, 56: 0.98989, 57: 0.99012, 58: 0.99036, 59: 0.99060, 60: 0.99084, 61: 0.99108, 62: 0.99133, 63: 0.99158, 64: 0.99183, 65: 0.99208, 66: 0.99234, 67: 0.99260, 68: 0.99286, 69: 0.99312, 70: 0.99339, 71: 0.99365, 72: 0.99392, 73: 0.99419, 74: 0.99446, 75: 0.99474, 76: 0.99501, 77: 0.99529, 78: 0.99556, 79: 0.99584, 80: 0.99612, 81: 0.99640, 82: 0.99669, 83: 0.99697, 84: 0.99725, 85: 0.99754, 86: 0.99782, 87: 0.99811, 88: 0.99840, 89: 0.99868, 90: 0.99897, 91: 0.99926, 92: 0.99954, 93: 0.99983, 94: 1.00012, 95: 1.00041, 96: 1.00069, 97: 1.00098, 98: 1.00127, 99: 1.00155, 100: 1.00184, 101: 1.00212, 102: 1.00240, 103: 1.00269, 104: 1.00297, 105: 1.00325, 106: 1.00353, 107: 1.00381, 108: 1.00409, 109: 1.00437, 110: 1.00464, 111: 1.00492, 112: 1.00519, 113: 1.00546, 114: 1.00573, 115: 1.00600, 116: 1.00626, 117: 1.00653, 118: 1.00679, 119: 1.00705, 120: 1.00731, 121: 1.00756, 122: 1.00781, 123: 1.00806, 124: 1.00831, 125: 1.00856, 126: 1.00880, 127: 1.00904, 128: 1.00928, 129: 1.00952, 130: 1.00975, 131: 1.00998, 132: 1.01020, 133: 1.01043, 134: 1.01065, 135: 1.01087, 136: 1.01108, 137: 1.01129, 138: 1.01150, 139: 1.01170, 140: 1.01191, 141: 1.01210, 142: 1.01230, 143: 1.01249, 144: 1.01267, 145: 1.01286, 146: 1.01304, 147: 1.01321, 148: 1.01338, 149: 1.01355, 150: 1.01371, 151: 1.01387, 152: 1.01403, 153: 1.01418, 154: 1.01433, 155: 1.01447, 156: 1.01461, 157: 1.01475, 158: 1.01488, 159: 1.01500, 160: 1.01513, 161: 1.01524, 162: 1.01536, 163: 1.01547, 164: 1.01557, 165: 1.01567, 166: 1.01577, 167: 1.01586, 168: 1.01595, 169: 1.01603, 170: 1.01610, 171: 1.01618, 172: 1.01625, 173: 1.01631, 174: 1.01637, 175: 1.01642, 176: 1.01647, 177: 1.01652, 178: 1.01656, 179: 1.01659, 180: 1.01662, 181: 1.01665, 182: 1.01667, 183: 1.01668, 184: 1.01670, 185: 1.01670, 186: 1.01670, 187: 1.01670, 188: 1.01669, 189: 1.01668, 190: 1.01666, 191: 1.01664, 192: 1.01661, 193: 1.01658, 194: 1.01655, 195: 1.01650, 196: 1.01646, 197: 1.01641, 198: 1.01635, 199: 1.01629, 200: 1.01623, 201: 1.01616, 202: 1.01609, 203: 1.01601, 204: 1.01592, 205: 1.01584, 206: 1.01575, 207: 1.01565, 208: 1.01555, 209: 1.01544, 210: 1.01533, 211: 1.01522, 212: 1.01510, 213: 1.01497, 214: 1.01485, 215: 1.01471, 216: 1.01458, 217: 1.01444, 218: 1.01429, 219: 1.01414, 220: 1.01399, 221: 1.01383, 222: 1.01367, 223: 1.01351, 224: 1.01334, 225: 1.01317, 226: 1.01299, 227: 1.01281, 228: 1.01263, 229: 1.01244, 230: 1.01225, 231: 1.01205, 232: 1.01186, 233: 1.01165, 234: 1.01145, 235: 1.01124, 236: 1.01103, 237: 1.01081, 238: 1.01060, 239: 1.01037, 240: 1.01015, 241: 1.00992, 242: 1.00969, 243: 1.00946, 244: 1.00922, 245: 1.00898, 246: 1.00874, 247: 1.00850, 248: 1.00825, 249: 1.00800, 250: 1.00775, 251: 1.00750, 252: 1.00724, 253: 1.00698, 254: 1.00672, 255: 1.00646, 256: 1.00620, 257: 1.00593, 258: 1.00566, 259: 1.00539, 260: 1.00512, 261: 1.00485, 262: 1.00457, 263: 1.00430, 264: 1.00402, 265: 1.00374, 266: 1.00346, 267: 1.00318, 268: 1.00290, 269: 1.00262, 270: 1.00234, 271: 1.00205, 272: 1.00177, 273: 1.00148, 274: 1.00119, 275: 1.00091, 276: 1.00062, 277: 1.00033, 278: 1.00005, 279: 0.99976, 280: 0.99947, 281: 0.99918, 282: 0.99890, 283: 0.99861, 284: 0.99832, 285: 0.99804, 286: 0.99775, 287: 0.99747, 288: 0.99718, 289: 0.99690, 290: 0.99662, 291: 0.99634, 292: 0.99605, 293: 0.99577, 294: 0.99550, 295: 0.99522, 296: 0.99494, 297: 0.99467, 298: 0.99440, 299: 0.99412, 300: 0.99385, 301: 0.99359, 302: 0.99332, 303: 0.99306, 304: 0.99279, 305: 0.99253, 306: 0.99228, 307: 0.99202, 308: 0.99177, 309: 0.99152, 310: 0.99127, 311: 0.99102, 312: 0.99078, 313: 0.99054, 314: 0.99030, 315: 0.99007, 316: 0.98983, 317: 0.98961, 318: 0.98938, 319: 0.98916, 320: 0.98894, 321: 0.98872, 322: 0.98851, 323: 0.98830, 324: 0.98809, 325: 0.98789, 326: 0.98769, 327: 0.98750, 328: 0.98731, 329: 0.98712, 330: 0.98694, 331: 0.98676, 332: 0.98658, 333: 0.98641, 334: 0.98624, 335: 0.98608, 336: 0.98592, 337: 0.98577, 338: 0.98562, 339: 0.98547, 340: 0.98533, 341: 0.98519, 342: 0.98506, 343: 0.98493, 344: 0.98481, 345: 0.98469, 346: 0.98457, 347: 0.98446, 348: 0.98436, 349: 0.98426, 350: 0.98416, 351: 0.98407, 352: 0.98399, 353: 0.98391, 354: 0.98383, 355: 0.98376, 356: 0.98370, 357: 0.98363, 358: 0.98358, 359: 0.98353, 360: 0.98348, 361: 0.98344, 362: 0.98340, 363: 0.98337, 364: 0.98335, 365: 0.98333, 366: 0.98331 }
 
+def report(progress, stage, fraction=0.0):
+    """
+    Reports progress to a callback.
+
+    :param progress:
+        None, or a callable taking (stage name, fraction of the stage done). It may raise an exception to cancel the computation.
+    """
+    if progress is not None:
+        progress(stage, fraction)
+
 # Replacement for original dir() function in this module.
 # Renamed to avoid name collision with builtin.
+# dir_path may be a directory inside an archive (see fmask_io.glob)
 def match_file(dir_path, pattern):
     res = glob(os.path.join(dir_path, pattern))
 
@@ -43,25 +61,77 @@ def match_file(dir_path, pattern):
         return res[0]
 
 
-def im_info(filename):
+def im_info(filename, window=None, scale=1):
     """
     A function to retrieve the geotransform and projection details using GDAL.
     The original MATLAB code handles it differently, we'll just implement something unique here
     and let GDAL automatically handle the read/write of the projection info.
     Less messy than the MATLAB code which assumes that everything is in UTM.
     Some products may come as Lat/Lon geographic projections.
+
+    If a window (xoff, yoff, xsize, ysize) is given, the geotransform, size
+    and upper left coordinate describe that window rather than the whole file.
+    With a scale above 1 they describe the window (or file) decimated by that
+    factor, as read by read_bands into arrays of that size.
     """
 
     img  = gdal.Open(filename)
     geoT = img.GetGeoTransform()
     prj  = img.GetProjection()
     size = (img.RasterYSize, img.RasterXSize)
+    if window is not None:
+        xoff, yoff, xsize, ysize = window
+        geoT = (geoT[0] + xoff * geoT[1] + yoff * geoT[2], geoT[1], geoT[2],
+                geoT[3] + xoff * geoT[4] + yoff * geoT[5], geoT[4], geoT[5])
+        size = (ysize, xsize)
+    if scale != 1:
+        ysize, xsize = size
+        size = (-(-ysize // scale), -(-xsize // scale))
+        fx = float(xsize) / size[1]
+        fy = float(ysize) / size[0]
+        geoT = (geoT[0], geoT[1] * fx, geoT[2] * fy,
+                geoT[3], geoT[4] * fx, geoT[5] * fy)
     ul_coord = (geoT[3], geoT[0])
     return (geoT, prj, size, ul_coord)
 
-def imread(filename, resample=False, samples=None, lines=None):
+@fmask_profile.stage('imread')
+def imread(filename, resample=False, samples=None, lines=None, window=None, buf_size=None):
+    """
+    Read the first band of filename.
+
+    :param resample:
+        Resample the band to (lines, samples), e.g. a thermal band delivered at a coarser resolution than the reflective bands.
+
+    :param window:
+        An optional (xoff, yoff, xsize, ysize) tuple, in reflective band pixel coordinates, restricting the read to one block/window of the image.
+
+    :param buf_size:
+        An optional (lines, samples) size of the returned array, smaller than the window (or band) to read it decimated (from the overviews of the file if it has some).
+    """
     img = gdal.Open(filename)
     band = img.GetRasterBand(1)
+    if buf_size is not None and window is None:
+        if resample:
+            window = (0, 0, samples, lines)
+        else:
+            window = (0, 0, img.RasterXSize, img.RasterYSize)
+    if window is not None:
+        xoff, yoff, xsize, ysize = window
+        buf_ysize, buf_xsize = buf_size if buf_size is not None else (ysize, xsize)
+        if resample:
+            # Window is given in reflective band coordinates - scale it to this band
+            sx = float(img.RasterXSize) / samples
+            sy = float(img.RasterYSize) / lines
+            txoff = min(int(xoff * sx), img.RasterXSize - 1)
+            tyoff = min(int(yoff * sy), img.RasterYSize - 1)
+            txsize = max(1, min(int(round(xsize * sx)), img.RasterXSize - txoff))
+            tysize = max(1, min(int(round(ysize * sy)), img.RasterYSize - tyoff))
+            return band.ReadAsArray(txoff, tyoff, txsize, tysize,
+                                    buf_xsize=buf_xsize, buf_ysize=buf_ysize)
+        if buf_size is not None:
+            return band.ReadAsArray(xoff, yoff, xsize, ysize,
+                                    buf_xsize=buf_xsize, buf_ysize=buf_ysize)
+        return band.ReadAsArray(xoff, yoff, xsize, ysize)
     if resample:
         driver = gdal.GetDriverByName('MEM')
         outds  = driver.Create("", samples, lines, 1, band.DataType)
@@ -72,6 +142,33 @@ def imread(filename, resample=False, samples=None, lines=None):
     else:
         return band.ReadAsArray()
 
+def reference_band(filename):
+    """
+    The file of the band giving the dimension & geotransform of the scene (Band 1, or Band 2 for Landsat 8).
+    """
+    Lnum = lndhdrread(filename)[14]
+    base = os.path.dirname(filename)
+    if Lnum == 8:
+        return match_file(base, '*B2.*')
+    return match_file(base, '*B1.*')
+
+def iter_windows(dim, block_lines=512):
+    """
+    Yield (xoff, yoff, xsize, ysize) windows of full width row stripes that cover a raster of dimension dim (nrows, ncols).
+    """
+    nrow, ncol = dim
+    for yoff in range(0, nrow, block_lines):
+        yield (0, yoff, ncol, min(block_lines, nrow - yoff))
+
+def align_block_lines(filename, block_lines=512):
+    """
+    Round block_lines down to a whole number of GDAL blocks of filename so that each window read touches complete blocks only.
+    """
+    img = gdal.Open(filename)
+    block_y = img.GetRasterBand(1).GetBlockSize()[1]
+    return max(block_y, (block_lines // block_y) * block_y)
+
+@fmask_profile.stage('imfill_skimage')
 def imfill_skimage(img):
     """
     Replicates the imfill function available within MATLAB.
@@ -92,12 +189,50 @@ def imfill_skimage(img):
 
     return filled
 
+def imfill(img, fill='skimage'):
+    """
+    Fills the regional minima of img with the engine fill (see fmask_imfill).
+
+    :param fill:
+        'skimage' for imfill_skimage (default), 'uint16' for imfill_uint16, which quantizes img to 16 bit levels and differs from imfill_skimage by at most half a level.
+    """
+    if fill == 'skimage':
+        return imfill_skimage(img)
+    elif fill == 'uint16':
+        return imfill_uint16(img)
+    raise ValueError('Unknown fill {f}, use one of {c}'.format(
+        f=fill, c=', '.join(FILLS)))
+
+# Representations of the TOA reflectance (*10000) & BT (Celcius*100) of nd2toarbt
+TOA_DTYPES = ('float32', 'int16')
+
+def as_float(a):
+    """
+    Returns a as float32 for the kernels doing arithmetic on the bands of nd2toarbt, or a itself if it is already floating point (see the dtype of nd2toarbt).
+    """
+    if a.dtype.kind == 'f':
+        return a
+    return a.astype(numpy.float32)
+
+def quantize_int16(a, out=None):
+    """
+    Rounds the float32 reflectance or temperature a (one band or a stack of bands) to int16, band by band, into out if given. NaN temperatures are -9999, outside the scene like them, and values beyond the int16 range are clipped.
+    """
+    if out is None:
+        out = numpy.empty(a.shape, numpy.int16)
+    bands = zip(a, out) if a.ndim == 3 else [(a, out)]
+    for band, q in bands:
+        band = numexpr.evaluate("where(band != band, -9999, where(band < -32768, -32768, where(band > 32767, 32767, band)))")
+        numpy.rint(band, out=q, casting='unsafe')
+    return out
+
+@fmask_profile.stage('lndhdrread')
 def lndhdrread(filename):
     """
     Load Landsat scene MTL file metadata.
 
     :param filename:
-        A string containing the full path the scene's MTL file.
+        A string containing the full path the scene's MTL file, which may be inside an archive (see fmask_io.scene_mtl).
     """
     # Read in Landsat TM/ETM+ MTL header for Fmask
     # [Lmax,Lmin,Qcalmax,Qcalmin,ijdim_ref,ijdim_thm,reso_ref,reso_thm,ul,zen,azi,zc,Lnum,doy]=lndhdrread(filename)
@@ -121,18 +256,8 @@ def lndhdrread(filename):
     # 14) doy = day of year (1,2,3,...,356)
     #
     ##
-    # open and read hdr file
-    data = {}
-    fl=open(filename,'r')
-    file_lines=fl.readlines()
-    for line in file_lines:
-        values = line.split(' = ')
-        if len(values) != 2:
-            continue
-
-        data[values[0].strip()] = values[1].strip().strip('"')
-
-    fl.close()
+    # open and read hdr file (parsed once, see fmask_io.read_mtl)
+    data = read_mtl(filename)
 
     # Identify Landsat Number (Lnum = 4, 5 or 7)
     LID=data['SPACECRAFT_ID']
@@ -423,7 +548,47 @@ def lndhdrread(filename):
     #return (Lmax,Lmin,Qcalmax,Qcalmin,ijdim_ref,ijdim_thm,reso_ref,reso_thm,ul,zen,azi,zc,Lnum,doy)
     return (Lmax,Lmin,Qcalmax,Qcalmin,Refmax,Refmin,ijdim_ref,ijdim_thm,reso_ref,reso_thm,ul,zen,azi,zc,Lnum,doy)
 
-def nd2toarbt(filename, images=None):
+def _toa_scene(filename):
+    """
+    Per scene setup of nd2toarbt: the MTL header, the band files and whether the thermal band is resampled. The VRT of the bands ('vrt') is built by the first nd2toarbt call given the setup, so a scene read window by window (see plcloud_tiled) parses, globs and opens its files once.
+    """
+    header = lndhdrread(filename)
+    ijdim_ref, ijdim_thm, Lnum = header[6], header[7], header[14]
+    base = os.path.dirname(filename)
+    if ((Lnum >= 4) & (Lnum <= 7)):
+        bands = (1, 2, 3, 4, 5, 7)
+        # Band6
+        if Lnum == 7:
+            n_thermal = match_file(base, '*B6*1.*')
+        else:
+            n_thermal = match_file(base, '*B6.*')
+    elif (Lnum == 8):
+        bands = (2, 3, 4, 5, 6, 7, 9)
+        n_thermal = match_file(base, '*B10.*')
+    else:
+        raise Exception('This sensor is not Landsat 4, 5, 7, or 8!')
+
+    # Check that the thermal band resolution matches the reflectance bands.
+    ref_lines, ref_samples = ijdim_ref
+    thm_lines, thm_samples = ijdim_thm
+    return {'header': header, 'bands': bands,
+            'n_bands': [match_file(base, '*B{b}.*'.format(b=b)) for b in bands],
+            'n_thermal': n_thermal,
+            'resample': (thm_lines != ref_lines) | (thm_samples != ref_samples),
+            'vrt': None}
+
+def _read_toa_bands(scene, images, im_thermal, window=None, progress=None):
+    """ Read the bands of the stack (and the thermal band unless it is resampled) with the VRT of the scene setup """
+    if scene['resample']:
+        n_bands, out = scene['n_bands'], list(images)
+    else:
+        n_bands, out = scene['n_bands'] + [scene['n_thermal']], list(images) + [im_thermal]
+    if scene['vrt'] is None:
+        scene['vrt'] = band_vrt(n_bands)
+    read_bands(n_bands, out, window=window, progress=lambda f: report(progress, 'read', f), vrt=scene['vrt'])
+
+@fmask_profile.stage('nd2toarbt')
+def nd2toarbt(filename, images=None, window=None, progress=None, scale=1, dtype='float32', scene=None):
     """
     Load metadata from MTL file & calculate reflectance values for scene bands.
 
@@ -432,31 +597,44 @@ def nd2toarbt(filename, images=None):
 
     :param images:
         A numpy.ndarray of pre-calculated reflectance values for each landsat band, to be used instead of calculating our own.
-    """
-    Lmax,Lmin,Qcalmax,Qcalmin,Refmax,Refmin,ijdim_ref,ijdim_thm,reso_ref,reso_thm,ul,zen,azi,zc,Lnum,doy=lndhdrread(filename)
 
-    base = os.path.dirname(filename)
+    :param window:
+        An optional (xoff, yoff, xsize, ysize) tuple. Only this window of the scene is read and converted, and the returned dimension & geotransform describe the window.
+
+    :param progress:
+        An optional callable taking (stage, fraction), called as the bands are read ('read') and converted ('toa').
+
+    :param scale:
+        An integer decimation factor. Above 1 the bands are read decimated by that factor (from their overviews if they have some), for a fast preview of the scene: the returned dimension, geotransform and resolution describe the decimated bands. Cannot be used with images.
+
+    :param dtype:
+        The type of the returned reflectance and temperature, 'float32' (default) or 'int16'. The int16 values are the float32 ones rounded, in the same units (reflectance * 10000, Celcius * 100, -9999 outside the scene), at half the size. plcloud, plcloud_warm and fcssm take them as they are and convert to float only inside the kernels that need it.
+
+    :param scene:
+        An optional per scene setup from _toa_scene, reused by the calls reading the scene window by window.
+    """
+    if scale != 1 and images is not None:
+        raise ValueError('Pre-loaded images cannot be decimated')
+    if dtype not in TOA_DTYPES:
+        raise ValueError('Unknown dtype {d}, use one of {c}'.format(
+            d=dtype, c=', '.join(TOA_DTYPES)))
+    report(progress, 'read', 0.0)
+    fmask_profile.step('read')
+    if scene is None:
+        scene = _toa_scene(filename)
+    Lmax,Lmin,Qcalmax,Qcalmin,Refmax,Refmin,ijdim_ref,ijdim_thm,reso_ref,reso_thm,ul,zen,azi,zc,Lnum,doy=scene['header']
 
     # LPGS Upper left corner alignment (see Landsat handbook for detail)
     # Changed from (ul[0]-15,ul[1]+15), GA products are 25m, this should also allow for other resolutions as well
     ul = (ul[0] - float(reso_ref) / 2, ul[1] + float(reso_ref) / 2)
-    resolu = (reso_ref,reso_ref)
+    resolu = (reso_ref * scale, reso_ref * scale)
 
     if ((Lnum >= 4) & (Lnum <= 7)):
 
         # Band6
-        if Lnum == 7:
-            n_B6 = match_file(base, '*B6*1.*')
-        else:
-            n_B6 = match_file(base, '*B6.*')
-
-        # Check that the thermal band resolution matches the reflectance bands.
+        n_B6 = scene['n_thermal']
         ref_lines, ref_samples = ijdim_ref
-        thm_lines, thm_samples = ijdim_thm
-        if ((thm_lines != ref_lines) | (thm_samples != ref_samples)):
-            im_B6 = imread(n_B6, resample=True, samples=ref_samples, lines=ref_lines).astype(numpy.float32)
-        else:
-            im_B6 = imread(n_B6).astype(numpy.float32)
+        resample_B6 = scene['resample']
 
         # convert Band6 from radiance to BT
         # fprintf('From Band 6 Radiance to Brightness Temperature\n')
@@ -480,6 +658,15 @@ def nd2toarbt(filename, images=None):
 
 
         if images != None:
+            if resample_B6:
+                im_B6 = imread(n_B6, resample=True, samples=ref_samples, lines=ref_lines, window=window).astype(numpy.float32)
+            else:
+                im_B6 = imread(n_B6, window=window).astype(numpy.float32)
+            report(progress, 'read', 1.0)
+
+            if window is not None:
+                xoff, yoff, xsize, ysize = window
+                images = images[:, yoff:yoff + ysize, xoff:xoff + xsize]
             im_B1 = images[0,:,:].astype(numpy.float32)
             im_B2 = images[1,:,:].astype(numpy.float32)
             im_B3 = images[2,:,:].astype(numpy.float32)
@@ -496,28 +683,42 @@ def nd2toarbt(filename, images=None):
             # only processing pixesl where all bands have values (id_mssing)
             id_missing = numexpr.evaluate("(im_B1 == 0.0) | (im_B2 == 0.0) | (im_B3 == 0.0) | (im_B4 == 0.0) |(im_B5 == 0.0) | (im_B6 == 0.0) | (im_B7 == 0.0)")
 
+            # convert from Kelvin to Celcius with 0.01 scale_facor
+            im_B6 = numexpr.evaluate("a * ((K2 / log((K1 / im_B6) + one)) - b)", { 'a': numpy.float32(100), 'b': numpy.float32(273.15), 'one': numpy.float32(1.0) }, locals())
+
+            # get data ready for Fmask
+            im_B1[id_missing] = -9999
+            im_B2[id_missing] = -9999
+            im_B3[id_missing] = -9999
+            im_B4[id_missing] = -9999
+            im_B5[id_missing] = -9999
+            im_B6[id_missing] = -9999
+            im_B7[id_missing] = -9999
+            del id_missing
+
+            images = numpy.array([im_B1, im_B2, im_B3, im_B4, im_B5, im_B7], 'float32')
+            del im_B1, im_B2, im_B3, im_B4, im_B5, im_B7
+            if dtype == 'int16':
+                images = quantize_int16(images)
+
         else:
-            # Band1
-            n_B1 = match_file(base, '*B1.*')
-            im_B1 = imread(n_B1).astype(numpy.float32)
-            # Band2
-            n_B2 = match_file(base, '*B2.*')
-            im_B2 = imread(n_B2).astype(numpy.float32)
-            # Band3
-            n_B3 = match_file(base, '*B3.*')
-            im_B3 = imread(n_B3).astype(numpy.float32)
-            # Band4
-            n_B4 = match_file(base, '*B4.*')
-            im_B4 = imread(n_B4).astype(numpy.float32)
-            # Band5
-            n_B5 = match_file(base, '*B5.*')
-            im_B5 = imread(n_B5).astype(numpy.float32)
-            # Band7
-            n_B7 = match_file(base, '*B7.*')
-            im_B7 = imread(n_B7).astype(numpy.float32)
+            # Band1, 2, 3, 4, 5 & 7 are read straight into the returned stack,
+            #   together with Band6 unless it has to be resampled
+            bands = scene['bands']
+            n_bands = scene['n_bands']
 
             # Retrieve the projection and geotransform info from the blue band (B1 LS 4,5,7)
-            geoT, prj, sz, ul_coord = im_info(n_B1)
+            geoT, prj, sz, ul_coord = im_info(n_bands[0], window=window, scale=scale)
+
+            # The DN fit uint16, so an int16 stack is read as uint16 and each
+            #   band converted in place (see the TOA loop)
+            images = numpy.empty((len(bands), ) + tuple(sz), 'uint16' if dtype == 'int16' else 'float32')
+            if resample_B6:
+                im_B6 = imread(n_B6, resample=True, samples=ref_samples, lines=ref_lines, window=window, buf_size=sz if scale != 1 else None).astype(numpy.float32)
+            else:
+                im_B6 = numpy.empty(sz, 'float32')
+            _read_toa_bands(scene, images, im_B6, window=window, progress=progress)
+            im_B1, im_B2, im_B3, im_B4, im_B5, im_B7 = images
 
             # find pixels that are saturated in the visible bands
             B1Satu = im_B1 == 255.0
@@ -526,17 +727,10 @@ def nd2toarbt(filename, images=None):
 
             # only processing pixesl where all bands have values (id_mssing)
             id_missing = numexpr.evaluate("(im_B1 == 0.0) | (im_B2 == 0.0) | (im_B3 == 0.0) | (im_B4 == 0.0) | (im_B5 == 0.0) | (im_B6 == 0.0) | (im_B7 == 0.0)")
+            del im_B1, im_B2, im_B3, im_B4, im_B5, im_B7
 
-            # ND to radiance first
-            im_B1 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B1 - Qmi) + Lmi", { 'Lma': Lmax[0], 'Lmi': Lmin[0], 'Qma': Qcalmax[0], 'Qmi': Qcalmin[0] }, locals())
-            im_B2 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B2 - Qmi) + Lmi", { 'Lma': Lmax[1], 'Lmi': Lmin[1], 'Qma': Qcalmax[1], 'Qmi': Qcalmin[1] }, locals())
-            im_B3 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B3 - Qmi) + Lmi", { 'Lma': Lmax[2], 'Lmi': Lmin[2], 'Qma': Qcalmax[2], 'Qmi': Qcalmin[2] }, locals())
-            im_B4 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B4 - Qmi) + Lmi", { 'Lma': Lmax[3], 'Lmi': Lmin[3], 'Qma': Qcalmax[3], 'Qmi': Qcalmin[3] }, locals())
-            im_B5 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B5 - Qmi) + Lmi", { 'Lma': Lmax[4], 'Lmi': Lmin[4], 'Qma': Qcalmax[4], 'Qmi': Qcalmin[4] }, locals())
-            im_B6 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B6 - Qmi) + Lmi", { 'Lma': Lmax[5], 'Lmi': Lmin[5], 'Qma': Qcalmax[5], 'Qmi': Qcalmin[5] }, locals())
-            im_B7 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B7 - Qmi) + Lmi", { 'Lma': Lmax[6], 'Lmi': Lmin[6], 'Qma': Qcalmax[6], 'Qmi': Qcalmin[6] }, locals())
-
-
+            report(progress, 'toa', 0.0)
+            fmask_profile.step('toa')
             # radiance to TOA reflectances
             # fprintf('From Radiances to TOA ref\n')
             #  # Solar Spectral Irradiances from LEDAPS
@@ -573,7 +767,8 @@ def nd2toarbt(filename, images=None):
             # earth-sun distance see G. Chander et al. RSE 113 (2009) 893-903
             dsun_doy = sun_earth_distance[doy]
 
-            # compute TOA reflectances
+            # ND to radiance, radiance to TOA reflectance & missing pixels
+            #   (-9999) in one kernel per band, written back into the stack
             # converted from degrees to radiance
             s_zen = math.radians(zen)
             stack = {
@@ -582,69 +777,55 @@ def nd2toarbt(filename, images=None):
                 'c': numpy.float32(math.cos(s_zen))
             }
 
-            im_B1 = numexpr.evaluate("a * im_B1 * b / (sun * c)", dict(stack.items() + { 'sun': numpy.float32(ESUN[0]) }.items()), locals())
-            im_B2 = numexpr.evaluate("a * im_B2 * b / (sun * c)", dict(stack.items() + { 'sun': numpy.float32(ESUN[1]) }.items()), locals())
-            im_B3 = numexpr.evaluate("a * im_B3 * b / (sun * c)", dict(stack.items() + { 'sun': numpy.float32(ESUN[2]) }.items()), locals())
-            im_B4 = numexpr.evaluate("a * im_B4 * b / (sun * c)", dict(stack.items() + { 'sun': numpy.float32(ESUN[3]) }.items()), locals())
-            im_B5 = numexpr.evaluate("a * im_B5 * b / (sun * c)", dict(stack.items() + { 'sun': numpy.float32(ESUN[4]) }.items()), locals())
-            im_B7 = numexpr.evaluate("a * im_B7 * b / (sun * c)", dict(stack.items() + { 'sun': numpy.float32(ESUN[6]) }.items()), locals())
-
-
-        # convert from Kelvin to Celcius with 0.01 scale_facor
-        im_B6 = numexpr.evaluate("a * ((K2 / log((K1 / im_B6) + one)) - b)", { 'a': numpy.float32(100), 'b': numpy.float32(273.15), 'one': numpy.float32(1.0) }, locals())
-
-        # get data ready for Fmask
-        im_B1[id_missing] = -9999
-        im_B2[id_missing] = -9999
-        im_B3[id_missing] = -9999
-        im_B4[id_missing] = -9999
-        im_B5[id_missing] = -9999
-        im_B6[id_missing] = -9999
-        im_B7[id_missing] = -9999
-        del id_missing
-
-
-        images = numpy.array([im_B1, im_B2, im_B3, im_B4, im_B5, im_B7], 'float32')
-        del im_B1, im_B2, im_B3, im_B4, im_B5, im_B7
+            for i, band in enumerate(bands):
+                k = band - 1
+                im = images[i]
+                if dtype == 'int16':
+                    # converted as float32 & rounded back over its DN
+                    dn, im = im, im.astype(numpy.float32)
+                numexpr.evaluate("where(id_missing, -9999, a * (((Lma - Lmi) / (Qma - Qmi)) * (im - Qmi) + Lmi) * b / (sun * c))", dict(stack.items() + { 'Lma': Lmax[k], 'Lmi': Lmin[k], 'Qma': Qcalmax[k], 'Qmi': Qcalmin[k], 'sun': numpy.float32(ESUN[k]) }.items()), locals(), out=im, casting='same_kind')
+                if dtype == 'int16':
+                    quantize_int16(im, out=dn.view(numpy.int16))
+                    del dn
+                report(progress, 'toa', float(i + 1) / (len(bands) + 1))
+            del im
+            if dtype == 'int16':
+                images = images.view(numpy.int16)
+
+            # ND to radiance & radiance to BT, converted from Kelvin to Celcius with 0.01 scale_facor
+            im_B6 = numexpr.evaluate("where(id_missing, -9999, a * ((K2 / log((K1 / (((Lma - Lmi) / (Qma - Qmi)) * (im_B6 - Qmi) + Lmi)) + one)) - b))", { 'Lma': Lmax[5], 'Lmi': Lmin[5], 'Qma': Qcalmax[5], 'Qmi': Qcalmin[5], 'a': numpy.float32(100), 'b': numpy.float32(273.15), 'one': numpy.float32(1.0) }, locals())
+            del id_missing
+
+        if dtype == 'int16':
+            im_B6 = quantize_int16(im_B6)
+
+        report(progress, 'toa', 1.0)
+        fmask_profile.note(images=images, Temp=im_B6)
 
         # We'll modify the return argument for the Python implementation (geoT,prj) are added to the list
 #        return [im_B6,images,ijdim_ref,ul,zen,azi,zc,B1Satu,B2Satu,B3Satu,resolu,geoT,prj]
         return [im_B6,images,sz,ul_coord,zen,azi,zc,B1Satu,B2Satu,B3Satu,resolu,geoT,prj]
     elif (Lnum == 8):
-        n_B10 = match_file(base, '*B10.*')
-        # Check that the thermal band resolution matches the reflectance bands.
+        n_B10 = scene['n_thermal']
         ref_lines, ref_samples = ijdim_ref
-        thm_lines, thm_samples = ijdim_thm
 
-        if ((thm_lines != ref_lines) | (thm_samples != ref_samples)):
-            im_B10 = imread(n_B10, resample=True, samples=ref_samples, lines=ref_lines).astype(numpy.float32)
-        else:
-            im_B10 = imread(n_B10).astype(numpy.float32)
-
-        # Band2
-        n_B2 = match_file(base, '*B2.*')
-        im_B2 = imread(n_B2).astype(numpy.float32)
-        # Band3
-        n_B3 = match_file(base, '*B3.*')
-        im_B3 = imread(n_B3).astype(numpy.float32)
-        # Band4
-        n_B4 = match_file(base, '*B4.*')
-        im_B4 = imread(n_B4).astype(numpy.float32)
-        # Band5
-        n_B5 = match_file(base, '*B5.*')
-        im_B5 = imread(n_B5).astype(numpy.float32)
-        # Band6
-        n_B6 = match_file(base, '*B6.*')
-        im_B6 = imread(n_B6).astype(numpy.float32)
-        # Band7
-        n_B7 = match_file(base, '*B7.*')
-        im_B7 = imread(n_B7).astype(numpy.float32)
-        # Band9
-        n_B9 = match_file(base, '*B9.*')
-        im_B9 = imread(n_B9).astype(numpy.float32)
+        # Band2, 3, 4, 5, 6, 7 & 9 are read straight into the returned stack,
+        #   together with Band10 unless it has to be resampled
+        bands = scene['bands']
+        n_bands = scene['n_bands']
 
         # Retrieve the projection and geotransform info from the blue band (B2 in LS8)
-        geoT, prj, sz, ul_coord = im_info(n_B2)
+        geoT, prj, sz, ul_coord = im_info(n_bands[0], window=window, scale=scale)
+
+        # The DN fit uint16, so an int16 stack is read as uint16 and each band
+        #   converted in place (see the TOA loop)
+        images = numpy.empty((len(bands), ) + tuple(sz), 'uint16' if dtype == 'int16' else 'float32')
+        if scene['resample']:
+            im_B10 = imread(n_B10, resample=True, samples=ref_samples, lines=ref_lines, window=window, buf_size=sz if scale != 1 else None).astype(numpy.float32)
+        else:
+            im_B10 = numpy.empty(sz, 'float32')
+        _read_toa_bands(scene, images, im_B10, window=window, progress=progress)
+        im_B2, im_B3, im_B4, im_B5, im_B6, im_B7, im_B9 = images
 
         # only processing pixesl where all bands have values (id_mssing)
         id_missing = numexpr.evaluate("(im_B2 == 0.0) | (im_B3 == 0.0) | (im_B4 == 0.0) | (im_B5 == 0.0) | (im_B6 == 0.0) | (im_B7 == 0.0) | (im_B9 == 0.0) | (im_B10 == 0.0)")
@@ -653,67 +834,61 @@ def nd2toarbt(filename, images=None):
         B1Satu = im_B2 == 65535.0
         B2Satu = im_B3 == 65535.0
         B3Satu = im_B4 == 65535.0
+        del im_B2, im_B3, im_B4, im_B5, im_B6, im_B7, im_B9
 
         # DN to TOA reflectance with 0.0001 scale_factor
         # This formulae is similar to that used for LS 4,5,7. But is different to that given by
         # https://landsat.usgs.gov/Landsat8_Using_Product.php : Noted JS 2013/11/28
+        # DN to TOA reflectance & missing pixels (-9999) in one kernel per
+        #   band, written back into the stack
         logger.info('From DNs to TOA ref & BT')
-        im_B2  = numexpr.evaluate("((Rma - Rmi) / (Qma - Qmi)) * (im_B2 - Qmi) + Rmi", { 'Rma': Refmax[0], 'Rmi': Refmin[0], 'Qma': Qcalmax[0], 'Qmi': Qcalmin[0] }, locals())
-        im_B3  = numexpr.evaluate("((Rma - Rmi) / (Qma - Qmi)) * (im_B3 - Qmi) + Rmi", { 'Rma': Refmax[1], 'Rmi': Refmin[1], 'Qma': Qcalmax[1], 'Qmi': Qcalmin[1] }, locals())
-        im_B4  = numexpr.evaluate("((Rma - Rmi) / (Qma - Qmi)) * (im_B4 - Qmi) + Rmi", { 'Rma': Refmax[2], 'Rmi': Refmin[2], 'Qma': Qcalmax[2], 'Qmi': Qcalmin[2] }, locals())
-        im_B5  = numexpr.evaluate("((Rma - Rmi) / (Qma - Qmi)) * (im_B5 - Qmi) + Rmi", { 'Rma': Refmax[3], 'Rmi': Refmin[3], 'Qma': Qcalmax[3], 'Qmi': Qcalmin[3] }, locals())
-        im_B6  = numexpr.evaluate("((Rma - Rmi) / (Qma - Qmi)) * (im_B6 - Qmi) + Rmi", { 'Rma': Refmax[4], 'Rmi': Refmin[4], 'Qma': Qcalmax[4], 'Qmi': Qcalmin[4] }, locals())
-        im_B7  = numexpr.evaluate("((Rma - Rmi) / (Qma - Qmi)) * (im_B7 - Qmi) + Rmi", { 'Rma': Refmax[5], 'Rmi': Refmin[5], 'Qma': Qcalmax[5], 'Qmi': Qcalmin[5] }, locals())
-        im_B9  = numexpr.evaluate("((Rma - Rmi) / (Qma - Qmi)) * (im_B9 - Qmi) + Rmi", { 'Rma': Refmax[6], 'Rmi': Refmin[6], 'Qma': Qcalmax[6], 'Qmi': Qcalmin[6] }, locals())
-        im_B10 = numexpr.evaluate("((Lma - Lmi) / (Qma - Qmi)) * (im_B10 - Qmi) + Lmi", { 'Lma': Lmax[7], 'Lmi': Lmin[7], 'Qma': Qcalmax[7], 'Qmi': Qcalmin[7] }, locals())
-
+        report(progress, 'toa', 0.0)
+        fmask_profile.step('toa')
         s_zen = numpy.deg2rad(zen)
-        im_B2 = numexpr.evaluate("10000 * im_B2 / cos(s_zen)")
-        im_B3 = numexpr.evaluate("10000 * im_B3 / cos(s_zen)")
-        im_B4 = numexpr.evaluate("10000 * im_B4 / cos(s_zen)")
-        im_B5 = numexpr.evaluate("10000 * im_B5 / cos(s_zen)")
-        im_B6 = numexpr.evaluate("10000 * im_B6 / cos(s_zen)")
-        im_B7 = numexpr.evaluate("10000 * im_B7 / cos(s_zen)")
-        im_B9 = numexpr.evaluate("10000 * im_B9 / cos(s_zen)")
-
-        # convert Band6 from radiance to BT
+        for i in range(len(bands)):
+            im = images[i]
+            if dtype == 'int16':
+                # converted as float32 & rounded back over its DN
+                dn, im = im, im.astype(numpy.float32)
+            numexpr.evaluate("where(id_missing, -9999, 10000 * (((Rma - Rmi) / (Qma - Qmi)) * (im - Qmi) + Rmi) / cos(s_zen))", { 'Rma': Refmax[i], 'Rmi': Refmin[i], 'Qma': Qcalmax[i], 'Qmi': Qcalmin[i] }, locals(), out=im, casting='same_kind')
+            if dtype == 'int16':
+                quantize_int16(im, out=dn.view(numpy.int16))
+                del dn
+            report(progress, 'toa', float(i + 1) / (len(bands) + 1))
+        del im
+        if dtype == 'int16':
+            images = images.view(numpy.int16)
+
+        # convert Band10 from DN to radiance to BT
         # fprintf('From Band 6 Radiance to Brightness Temperature\n');
         K1_B10 = numpy.float32(774.89)
         K2_B10 = numpy.float32(1321.08)
         one    = numpy.float32(1)
 
-        im_B10 = numexpr.evaluate("K2_B10 / log((K1_B10 / im_B10) + one)")
-
         # convert from Kelvin to Celcius with 0.01 scale_factor
         K      = numpy.float32(273.15)
-        im_B10 = numexpr.evaluate("100 * (im_B10 - K)")
-
-        # get data ready for Fmask
-        im_B2[id_missing]  = -9999
-        im_B3[id_missing]  = -9999
-        im_B4[id_missing]  = -9999
-        im_B5[id_missing]  = -9999
-        im_B6[id_missing]  = -9999
-        im_B7[id_missing]  = -9999
-        im_B9[id_missing]  = -9999
-        im_B10[id_missing] = -9999
+        im_B10 = numexpr.evaluate("where(id_missing, -9999, 100 * (K2_B10 / log((K1_B10 / (((Lma - Lmi) / (Qma - Qmi)) * (im_B10 - Qmi) + Lmi)) + one) - K))", { 'Lma': Lmax[7], 'Lmi': Lmin[7], 'Qma': Qcalmax[7], 'Qmi': Qcalmin[7] }, locals())
         del id_missing
 
-        images = numpy.array([im_B2, im_B3, im_B4, im_B5, im_B6, im_B7, im_B9], 'float32')
-        del im_B2, im_B3, im_B4, im_B5, im_B6, im_B7, im_B9
+        if dtype == 'int16':
+            im_B10 = quantize_int16(im_B10)
+
+        report(progress, 'toa', 1.0)
+        fmask_profile.note(images=images, Temp=im_B10)
 
         # We'll modify the return argument for the Python implementation (geoT,prj) are added to the list
 #        return [im_B10,images,ijdim_ref,ul,zen,azi,zc,B1Satu,B2Satu,B3Satu,resolu,geoT,prj]
         return [im_B10,images,sz,ul_coord,zen,azi,zc,B1Satu,B2Satu,B3Satu,resolu,geoT,prj]
 
-    else:
-        raise Exception('This sensor is not Landsat 4, 5, 7, or 8!')
-
+@fmask_profile.stage('plcloud')
 def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
-                   shadow_prob=False, mask=None):
+                   shadow_prob=False, mask=None, fill='skimage', packed=False,
+                   dtype='float32'):
     """
     Calculates a cloud mask for a landsat 5/7 scene.
 
+    Runs nd2toarbt, plcloud_probs and plcloud_threshold, as plcloud_warm.
+
     :param filename:
         A string containing the file path of the landsat scene MTL file.
 
@@ -732,15 +907,106 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
     :param shadow_prob:
         A flag indicating if the shadow probability should be calculated or not (required by FMask cloud shadow). Type Bool.
 
+    :param fill:
+        The flood fill of the shadow probability, 'skimage' (default) or 'uint16', see imfill.
+
+    :param packed:
+        If True, the water, snow, cloud and shadow masks are returned as one packed mask raster (see fmask_bitmask) in place of the water mask, and None for the others. fcssm accepts this raster.
+
+    :param dtype:
+        The type of the reflectance and temperature, 'float32' (default) or 'int16', see nd2toarbt. The returned temperature band has this type.
+
+    :return:
+        Tuple (zen,azi,ptm, temperature band (celcius*100),t_templ,t_temph, water mask, snow mask, cloud mask , shadow probability,dim,ul,resolu,zc).
+    """
+    state = plcloud_probs(nd2toarbt(filename, images, dtype=dtype),
+                          num_Lst=num_Lst, shadow_prob=shadow_prob, mask=mask,
+                          fill=fill)
+    return plcloud_threshold(state, cldprob=cldprob, packed=packed)
+
+def plcloud_warm(toa_bt, cldprob=22.5, num_Lst=None,
+                   shadow_prob=False, mask=None, progress=None,
+                   fill='skimage', packed=False):
+    """
+    Calculates a cloud mask for a landsat 5/7 scene.
+
+    Runs plcloud_probs followed by plcloud_threshold. Keep the output of
+    plcloud_probs and call plcloud_threshold directly to test several cloud
+    probabilities without recomputing the cloud probabilities.
+
+    :param toa_bt:
+        The list returned by nd2toarbt.
+
+    :param cldprob:
+        The cloud probability for the scene (defaults to 22.5%).
+
+    :param num_Lst:
+        The Landsat satellite number.
+
+    :param shadow_prob:
+        A flag indicating if the shadow probability should be calculated or not (required by FMask cloud shadow). Type Bool.
+
+    :param mask:
+        A numpy.ndarray of the pixels to process (defaults to all pixels with valid temperature).
+
+    :param progress:
+        An optional callable taking (stage, fraction), see plcloud_probs.
+
+    :param fill:
+        The flood fill of the shadow probability, 'skimage' (default) or 'uint16', see imfill.
+
+    :param packed:
+        If True, the masks are returned as one packed mask raster, see plcloud.
+
     :return:
         Tuple (zen,azi,ptm, temperature band (celcius*100),t_templ,t_temph, water mask, snow mask, cloud mask , shadow probability,dim,ul,resolu,zc).
     """
-    Temp,data,dim,ul,zen,azi,zc,satu_B1,satu_B2,satu_B3,resolu,geoT,prj = nd2toarbt(filename, images)
+    state = plcloud_probs(toa_bt, num_Lst=num_Lst, shadow_prob=shadow_prob,
+                          mask=mask, progress=progress, fill=fill)
+    return plcloud_threshold(state, cldprob=cldprob, packed=packed)
 
+@fmask_profile.stage('plcloud_probs')
+def plcloud_probs(toa_bt, num_Lst=None, shadow_prob=False, mask=None,
+                  progress=None, fill='skimage', baseline=None):
+    """
+    Calculates the cloud probabilities for a landsat scene, i.e. everything in
+    plcloud_warm that does not depend on the cloud probability threshold.
+
+    :param toa_bt:
+        The list returned by nd2toarbt.
+
+    :param num_Lst:
+        The Landsat satellite number.
+
+    :param shadow_prob:
+        A flag indicating if the shadow probability should be calculated or not (required by FMask cloud shadow). Type Bool.
+
+    :param mask:
+        A numpy.ndarray of the pixels to process (defaults to all pixels with valid temperature).
+
+    :param progress:
+        An optional callable taking (stage, fraction), called through the spectral tests ('tests'), the percentiles ('percentiles') and the shadow flood fill ('shadow').
+
+    :param fill:
+        The flood fill of the shadow probability, 'skimage' (default) or 'uint16', see imfill.
+
+    :param baseline:
+        An optional dict of scene-wide statistics from plcloud_baseline. When toa_bt is a window of the scene (see nd2toarbt), the clear pixel percentages, background temperatures and reflectances and clear sky probability percentiles are taken from it instead of from the pixels of the window, so the window is thresholded as in the whole scene run.
+
+    :return:
+        A dict holding the potential cloud layer (idplcd), the land and water cloud probabilities (final_prob, wfinal_prob), the percentiles of the clear sky probabilities (clr_pct, wclr_pct) and the cloud probability independent plcloud_warm outputs. Pass it to plcloud_threshold.
+    """
+    Temp, data, \
+        dim, ul, zen, azi, zc, \
+        satu_B1, satu_B2, satu_B3, \
+        resolu, geoT, prj = toa_bt
+
+    report(progress, 'tests', 0.0)
+    fmask_profile.step('setup')
     if num_Lst < 8: # Landsat 4~7
         Thin_prob = 0 #  there is no contribution from the new bands
     else:
-        Thin_prob = numexpr.evaluate("cirrus / 400", {'cirrus' : data[-1]}, locals())
+        Thin_prob = numexpr.evaluate("cirrus / 400", {'cirrus' : as_float(data[-1])}, locals())
 
     Cloud = numpy.zeros(dim,'uint8') # cloud mask
     Snow  = numpy.zeros(dim,'uint8') # Snow mask
@@ -753,65 +1019,36 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
         mask = mask.astype('bool')
 
     Shadow = numpy.zeros(dim,'uint8') # shadow mask
+    fmask_profile.note(Cloud=Cloud, Snow=Snow, WT=WT, Shadow=Shadow, mask=mask)
 
-    data1 = data[0,:,:]
-    data2 = data[1,:,:]
-    data3 = data[2,:,:]
-    data4 = data[3,:,:]
-    data5 = data[4,:,:]
-    data6 = data[5,:,:]
-
-    NDVI = numexpr.evaluate("(data4 - data3) / (data4 + data3)")
-    NDSI = numexpr.evaluate("(data2 - data5) / (data2 + data5)")
-
-    NDVI[numexpr.evaluate("(data4 + data3) == 0")] = 0.01
-    NDSI[numexpr.evaluate("(data2 + data5) == 0")] = 0.01
-
-    ##############################################saturation in the three visible bands
-    satu_Bv = numexpr.evaluate("(satu_B1 | satu_B2 | satu_B3)")
+    fmask_profile.step('spectral tests')
+    # Basic, whiteness, haze, ratio & cirrus tests (idplcd), snow test (into
+    #   Snow) & Zhe's water test (into WT), fused by _spectral_tests
+    idplcd, NDVI, NDSI, whiteness = _spectral_tests(data, Temp, satu_B1, satu_B2, satu_B3, Thin_prob, Snow, WT)
     del satu_B1
-    ################################################## Basic cloud test
-    idplcd = numexpr.evaluate("(NDSI < 0.8) & (NDVI < 0.8) & (data6 > 300) & (Temp < 2700)")
-
-    ################################################## Snow test
-    # It takes every snow pixels including snow pixel under thin clouds or icy clouds
-    Snow[numexpr.evaluate("(NDSI > 0.15) & (Temp < 1000) & (data4 > 1100) & (data2 > 1000)")] = 1
     #Snow[mask == 0] = 255
-    ################################################## Water test
-    # Zhe's water test (works over thin cloud)
-    WT[numexpr.evaluate("((NDVI < 0.01) & (data4 < 1100)) | ((NDVI < 0.1) & (NDVI > 0) & (data4 < 500))")] = 1
     WT[mask == 0] = 255
-    # ################################################ Whiteness test
-    # visible bands flatness (sum(abs)/mean < 0.6 => brigt and dark cloud )
-    visimean = numexpr.evaluate("(data1 + data2 + data3) / 3 ")
-    whiteness = numexpr.evaluate("(abs(data1 - visimean) + abs(data2 - visimean)+ abs(data3 - visimean)) / visimean")
-    del visimean
-
-    # update idplcd
-    whiteness[satu_Bv] = 0# If one visible is saturated whiteness == 0
-    idplcd &= whiteness < 0.7
-
-    ################################################## Haze test
-    HOT = numexpr.evaluate("data1 - 0.5 * data3 - 800") # Haze test
-    idplcd &= numexpr.evaluate("(HOT > 0) | satu_Bv")
-    del HOT # need to find thick warm cloud
+    fmask_profile.note(NDVI=NDVI, NDSI=NDSI, whiteness=whiteness, idplcd=idplcd)
 
-    ######################################### Ratio4/5>0.75 cloud test
-    idplcd &= numexpr.evaluate("(data4 / data5) > 0.75")
-
-    ############################### Cirrus tests from Landsat 8
-    idplcd |= numexpr.evaluate("Thin_prob > 0.25")
+    data4 = data[3,:,:]
+    data5 = data[4,:,:]
 
+    report(progress, 'tests', 1.0)
+    fmask_profile.step('clear pixels')
     ####################################constants##########################
     l_pt = 0.175 # low percent
     h_pt = 1 - l_pt # high percent
     ################################################(temperature & snow test )
     # test whether use thermal or not
-    idclr = numexpr.evaluate("(idplcd == False) & (mask == 1)")
-    ptm = 100 * idclr.sum() / mask.sum() # percent of del pixel
-    idlnd = numexpr.evaluate("idclr & (WT == False)")
-    idwt = numexpr.evaluate("idclr & (WT == True)") # &data(:,:,6)<=300;
-    lndptm= 100 * idlnd.sum() / mask.sum()
+    # clear pixels (idclr) are the clear land & clear water pixels
+    idlnd = numexpr.evaluate("(idplcd == False) & (mask == 1) & (WT == False)")
+    idwt = numexpr.evaluate("(idplcd == False) & (mask == 1) & (WT == True)") # &data(:,:,6)<=300;
+    if baseline is None:
+        ptm = 100 * (idlnd.sum() + idwt.sum()) / mask.sum() # percent of del pixel
+        lndptm= 100 * idlnd.sum() / mask.sum()
+    else:
+        ptm = baseline['ptm']
+        lndptm = baseline['lndptm']
 
     logger.debug('idlnd: %s', idlnd)
     logger.debug('idlnd.sum(): %s', idlnd.sum())
@@ -837,49 +1074,53 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
         Temp = -1
         t_templ = -1
         t_temph = -1
+        final_prob = wfinal_prob = None
+        clr_pct = wclr_pct = None
+        t_wtemp = backg_B4 = backg_B5 = None
     else:
         # fprintf('Clear pixel EXIST in this scene (del prct = #.2f)\n',ptm)
         #################################################(temperature test )
         if lndptm >= 0.1:
-            F_temp = Temp[idlnd] # get land temperature
+            id_temp = idlnd # get land temperature
             #       fprintf('Land temperature\n')
         else:
-            F_temp = Temp[idclr] # get del temperature
+            id_temp = idlnd | idwt # get del temperature
             #        fprintf('Clear temperature\n')
 
+        report(progress, 'percentiles', 0.0)
+        fmask_profile.step('water probability')
         # Get cloud prob over water
         ## temperature test (over water)
         #F_wtemp = Temp[numexpr.evaluate("(WT == 1) & (data6 <= 300)")] # get del water temperature
-        F_wtemp = Temp[idwt]
-        if len(F_wtemp) == 0:
+        if baseline is not None:
+            t_wtemp = baseline['t_wtemp']
+        elif not idwt.any():
             t_wtemp = 0
         else:
-            t_wtemp = scipy.stats.scoreatpercentile(F_wtemp, 100 * h_pt)
-        wTemp_prob = numexpr.evaluate('(t_wtemp - Temp) / 400')
-        wTemp_prob[numexpr.evaluate('wTemp_prob < 0')] = 0
-
+            t_wtemp, = masked_percentile(Temp, idwt, [100 * h_pt])
         ## Brightness test (over water)
-        t_bright = 1100
-        Brightness_prob = data5 / t_bright
-        Brightness_prob[Brightness_prob > 1] = 1
-        Brightness_prob[Brightness_prob < 0] = 0
+        Brightness_prob = _brightness_prob(data5)
 
         ## Final prob mask (water)
-        wfinal_prob = numexpr.evaluate('100 * wTemp_prob * Brightness_prob + 100 * Thin_prob') # cloud over water probability
-        wclr_max    = scipy.stats.scoreatpercentile(wfinal_prob[idwt], 100 * h_pt) + cldprob # dynamic threshold (land)
-        #wclr_max=50;% fixed threshold (water)
-
-        # release memory
-        del wTemp_prob
+        wfinal_prob = _water_prob(Temp, Brightness_prob, Thin_prob, t_wtemp) # cloud over water probability
         del Brightness_prob
+        fmask_profile.note(wfinal_prob=wfinal_prob)
+        if baseline is not None:
+            wclr_pct = baseline['wclr_pct']
+        else:
+            wclr_pct    = masked_percentile(wfinal_prob, idwt, [100 * h_pt], bin_width=0.01)[0] # dynamic threshold (water) without cldprob
+        #wclr_max=50;% fixed threshold (water)
 
+        report(progress, 'percentiles', 0.33)
+        fmask_profile.step('temperature probability')
         ## Temperature test
         t_buffer = 4 * 100
-        if len(F_temp) != 0:
+        if baseline is not None:
+            t_templ, t_temph = baseline['t_templ'], baseline['t_temph']
+        elif id_temp.any():
             # 0.175 percentile background temperature (low)
-            t_templ = scipy.stats.scoreatpercentile(F_temp, 100 * l_pt)
             # 0.825 percentile background temperature (high)
-            t_temph = scipy.stats.scoreatpercentile(F_temp, 100 * h_pt)
+            t_templ, t_temph = masked_percentile(Temp, id_temp, [100 * l_pt, 100 * h_pt])
         else:
             t_templ = 0
             t_temph = 0
@@ -887,16 +1128,9 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
         t_tempL = t_templ - t_buffer
         t_tempH = t_temph + t_buffer
         Temp_l = t_tempH - t_tempL
-        Temp_prob = (t_tempH - Temp) / Temp_l
-        # Temperature can have prob > 1
-        Temp_prob[Temp_prob < 0] = 0
-        #Temp_prob(Temp_prob > 1) = 1
-
-        NDSI[numexpr.evaluate('satu_B2 & (NDSI < 0)')] = 0
-        NDVI[numexpr.evaluate('satu_B3 & (NDVI > 0)')] = 0
-
-        Vari_prob= 1 - numpy.maximum(numpy.maximum(numpy.absolute(NDSI), numpy.absolute(NDVI)), whiteness)
 
+        # NDSI is overwritten, Vari_prob is written into the NDVI buffer
+        Vari_prob = _variability_prob(NDVI, NDSI, whiteness, satu_B2, satu_B3, out=NDVI)
 
         # release memory
         del satu_B2
@@ -905,56 +1139,50 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
         del NDVI
         del whiteness
 
+        report(progress, 'percentiles', 0.67)
+        fmask_profile.step('land probability')
         ## Final prob mask (land)
-        final_prob = 100 * Temp_prob * Vari_prob + 100 * Thin_prob # cloud over land probability
-        clr_max = scipy.stats.scoreatpercentile(final_prob[idlnd], 100 * h_pt) + cldprob # dynamic threshold (land)
+        final_prob = _land_prob(Temp, Vari_prob, Thin_prob, t_tempH, Temp_l) # cloud over land probability
+        fmask_profile.note(final_prob=final_prob)
+        if baseline is not None:
+            clr_pct = baseline['clr_pct']
+        else:
+            clr_pct = masked_percentile(final_prob, idlnd, [100 * h_pt], bin_width=0.01)[0] # dynamic threshold (land) without cldprob
 
 
         # release memory
         del Vari_prob
-        del Temp_prob
         del Thin_prob
+        report(progress, 'percentiles', 1.0)
 
-        logger.debug('cldprob: %s', cldprob)
-        logger.debug('clr_max: %s', clr_max)
-        logger.debug('t_templ: %s', t_templ)
-        sys.stdout.flush()
-
-        # fprintf('pcloud probability threshold (land) = .2f#\n',clr_max)
-        # cloud over land : (idplcd & (final_prob > clr_max) & (WT == 0))
-        # thin cloud over water : (idplcd & (wfinal_prob > wclr_max) & (WT == 1))
-        # high prob cloud (land) : (final_prob > 99.0) & (WT == 0)
-        # extremly cold cloud : (Temp < t_templ - 3500)
-        id_final_cld = numexpr.evaluate('(idplcd & (final_prob > clr_max) & (WT == 0)) | (idplcd & (wfinal_prob > wclr_max) & (WT == 1)) | (Temp < t_templ - 3500)')
-
-        ## Star with potential cloud mask
-        # # potential cloud mask
-        Cloud[id_final_cld] = 1
-
-        # release memory
-        del final_prob
-        del wfinal_prob
-        del id_final_cld
-
+        fmask_profile.step('shadow probability')
+        backg_B4 = backg_B5 = None
         ## Start with potential cloud shadow mask
         if shadow_prob:
-
+            report(progress, 'shadow', 0.0)
             # band 4 flood fill
             nir = data4.astype('float32')
             # estimating background (land) Band 4 ref
-            backg_B4 = scipy.stats.scoreatpercentile(nir[idlnd], 100.0 * l_pt)
+            if baseline is not None and baseline['backg_B4'] is not None:
+                backg_B4 = baseline['backg_B4']
+            else:
+                backg_B4 = masked_percentile(nir, idlnd, [100.0 * l_pt])[0]
             nir[mask == 0] = backg_B4
             # fill in regional minimum Band 4 ref
-            nir = imfill_skimage(nir)
+            nir = imfill(nir, fill)
             nir = nir - data4
 
+            report(progress, 'shadow', 0.5)
             # band 5 flood fill
-            swir = data5
+            swir = as_float(data5)
             # estimating background (land) Band 4 ref
-            backg_B5 = scipy.stats.scoreatpercentile(swir[idlnd], 100.0 * l_pt)
+            if baseline is not None and baseline['backg_B5'] is not None:
+                backg_B5 = baseline['backg_B5']
+            else:
+                backg_B5 = masked_percentile(swir, idlnd, [100.0 * l_pt])[0]
             swir[mask == 0] = backg_B5
             # fill in regional minimum Band 5 ref
-            swir = imfill_skimage(swir)
+            swir = imfill(swir, fill)
             swir = swir - data5
 
             # compute shadow probability
@@ -966,6 +1194,98 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
             Shadow[shadow_prob > 200] = 1
             # release remory
             del shadow_prob
+            report(progress, 'shadow', 1.0)
+
+
+    fmask_profile.step(None)
+    del data
+    images = None
+    gc.collect()
+
+    return {'zen' : zen, 'azi' : azi, 'ptm' : ptm, 'lndptm' : lndptm,
+            'Temp' : Temp, 't_templ' : t_templ, 't_temph' : t_temph,
+            't_wtemp' : t_wtemp, 'backg_B4' : backg_B4, 'backg_B5' : backg_B5,
+            'WT' : WT,
+            'Snow' : Snow, 'Cloud' : Cloud, 'Shadow' : Shadow, 'mask' : mask,
+            'idplcd' : idplcd, 'final_prob' : final_prob,
+            'wfinal_prob' : wfinal_prob, 'clr_pct' : clr_pct,
+            'wclr_pct' : wclr_pct, 'dim' : dim, 'ul' : ul, 'resolu' : resolu,
+            'zc' : zc, 'geoT' : geoT, 'prj' : prj}
+
+# Decimation factor of the whole scene pass giving the baselines of windows
+#   (at least the preview scale, see plcloud_baseline)
+BASELINE_SCALE = 4
+
+def plcloud_baseline(state):
+    """
+    Scene-wide statistics of a plcloud_probs state, to process windows of the scene consistently with it (see the baseline argument of plcloud_probs).
+
+    The state may come from a decimated run (see nd2toarbt), whose percentiles approximate those of the full resolution scene.
+
+    :param state:
+        The dict returned by plcloud_probs for the whole scene.
+
+    :return:
+        A dict of the clear pixel percentages (ptm, lndptm), the background temperatures (t_templ, t_temph, t_wtemp), the background Band 4 & 5 reflectances (backg_B4, backg_B5, None unless the shadow probability was calculated) and the clear sky probability percentiles (clr_pct, wclr_pct).
+    """
+    return dict((key, state[key]) for key in
+                ('ptm', 'lndptm', 't_templ', 't_temph', 't_wtemp',
+                 'backg_B4', 'backg_B5', 'clr_pct', 'wclr_pct'))
+
+@fmask_profile.stage('plcloud_threshold')
+def plcloud_threshold(state, cldprob=22.5, packed=False):
+    """
+    Thresholds the cloud probabilities from plcloud_probs into a cloud mask.
+
+    The state is not modified, so it can be thresholded again with another cloud probability.
+
+    :param state:
+        The dict returned by plcloud_probs.
+
+    :param cldprob:
+        The cloud probability for the scene (defaults to 22.5%).
+
+    :param packed:
+        If True, the masks are returned as one packed mask raster, see plcloud.
+
+    :return:
+        Tuple (zen,azi,ptm, temperature band (celcius*100),t_templ,t_temph, water mask, snow mask, cloud mask , shadow probability,dim,ul,resolu,zc), as plcloud_warm.
+    """
+    ptm = state['ptm']
+    Temp = state['Temp']
+    t_templ = state['t_templ']
+    t_temph = state['t_temph']
+    mask = state['mask']
+    idplcd = state['idplcd']
+    WT = state['WT'].copy()
+    Snow = state['Snow'].copy()
+    Cloud = state['Cloud'].copy()
+    Shadow = state['Shadow'].copy()
+
+    if ptm > 0.1:
+        final_prob = state['final_prob']
+        wfinal_prob = state['wfinal_prob']
+        clr_max = state['clr_pct'] + cldprob # dynamic threshold (land)
+        wclr_max = state['wclr_pct'] + cldprob # dynamic threshold (water)
+
+        logger.debug('cldprob: %s', cldprob)
+        logger.debug('clr_max: %s', clr_max)
+        logger.debug('t_templ: %s', t_templ)
+        sys.stdout.flush()
+
+        # fprintf('pcloud probability threshold (land) = .2f#\n',clr_max)
+        # cloud over land : (idplcd & (final_prob > clr_max) & (WT == 0))
+        # thin cloud over water : (idplcd & (wfinal_prob > wclr_max) & (WT == 1))
+        # high prob cloud (land) : (final_prob > 99.0) & (WT == 0)
+        # extremly cold cloud : (Temp < t_templ - 3500)
+        id_final_cld = numexpr.evaluate('(idplcd & (final_prob > clr_max) & (WT == 0)) | (idplcd & (wfinal_prob > wclr_max) & (WT == 1)) | (Temp < t_templ - 3500)')
+
+        ## Star with potential cloud mask
+        # # potential cloud mask
+        Cloud[id_final_cld] = 1
+
+        # release memory
+        del id_final_cld
 
         #Cloud[idplcd==True]=1 # all cld
 
@@ -992,10 +1312,6 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
         #*************************************************************************************#
         #*************************************************************************************#
 
-    del data
-    images = None
-    gc.collect()
-
     # refine Water mask - Zhe's water mask (no confusion water/cloud)
     WT[numexpr.evaluate("(WT == 1) & (Cloud == 0)")] = 1
     # bwmorph changed Cloud to Binary
@@ -1009,8 +1325,8 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
     if ptm > 0.1:
         cloud_temp = Temp[cloud_mask]
 
-        logger.info("Snow Percent: %f\n" % ((float(Snow[mask].sum()) / float(mask.sum())) * 100.0))
-        logger.info("Cloud Mean: %f C\n" % (numpy.mean(cloud_temp) / 100.0))
+        logger.debug("Snow Percent: %f\n" % ((float(Snow[mask].sum()) / float(mask.sum())) * 100.0))
+        logger.debug("Cloud Mean: %f C\n" % (numpy.mean(cloud_temp) / 100.0))
 
         if numpy.sum(cloud_mask) > 0:
             cloud_stddev  = numpy.std(cloud_temp, dtype='float64', ddof=1) / 100.0
@@ -1023,19 +1339,28 @@ def plcloud(filename, cldprob=22.5, num_Lst=None, images=None,
             logger.debug("83.5 percentile: %f C\n" % pct_lower)
             logger.debug("98.75 percentile: %f C\n" % pct_upper_max)
 
-    cloud_skew    = 0.0 # TODO
-
     logger.info("Final Cloud Layer Percent: %f\n" % ((float(Cloud[cloud_mask].sum()) / float(mask.sum())) * 100.0))
 
     logger.info("Completed processing FMASK cloud cover...\n")
 
     # We'll modify the return argument for the Python implementation (geoT,prj) are added to the list
-    return (zen,azi,ptm,Temp,t_templ,t_temph,WT,Snow,Cloud,Shadow,dim,ul,resolu,zc,geoT,prj)
+    if packed:
+        # One raster of bit planes in place of the four class layers
+        WT = fmask_bitmask.pack(WT, Snow, Cloud, Shadow)
+        Snow = Cloud = Shadow = None
 
-def plcloud_warm(toa_bt, cldprob=22.5, num_Lst=None,
-                   shadow_prob=False, mask=None):
+    return (state['zen'],state['azi'],ptm,Temp,t_templ,t_temph,WT,Snow,Cloud,Shadow,state['dim'],state['ul'],state['resolu'],state['zc'],state['geoT'],state['prj'])
+
+@fmask_profile.stage('plcloud_tiled')
+def plcloud_tiled(filename, cldprob=22.5, num_Lst=None, shadow_prob=False,
+                  block_lines=512, fill='skimage', packed=False,
+                  dtype='float32'):
     """
-    Calculates a cloud mask for a landsat 5/7 scene.
+    Calculates a cloud mask for a landsat scene block by block.
+
+    Produces the same result as plcloud, but the DN to TOA/BT conversion and the per-pixel spectral tests (NDVI, NDSI, whiteness, HOT, B4/B5 ratio, snow and water) are run on row stripes of the scene read window by window with GDAL, so the band stack (24 - 28 bytes per pixel as float32) and its temporaries are never held for the whole scene.
+
+    The results of the tests are still full-scene planes, kept for the scene-wide percentiles and dynamic thresholds: the temperature (4 bytes per pixel, 2 as int16), the variability, brightness and, for Landsat 8, cirrus probabilities (4 each), the mask, test and land/water masks (1 each) and the four class layers (1 each), about 25 bytes per pixel (29 for Landsat 8). With shadow_prob, Band 4 & 5 (4 bytes each) are kept as well, as the flood fill needs them for the whole scene; the probabilities are freed before the fill, whose own temporaries then set the peak: about 80 bytes per pixel with fill='skimage', 20 with fill='uint16'. A tiled run with fill='uint16' therefore peaks around 45 bytes per pixel, where plcloud with the same fill reaches about 100.
 
     :param filename:
         A string containing the file path of the landsat scene MTL file.
@@ -1046,166 +1371,126 @@ def plcloud_warm(toa_bt, cldprob=22.5, num_Lst=None,
     :param num_Lst:
         The Landsat satellite number.
 
-    :param images:
-        A numpy.ndarray of pre-loaded, scaled, and corrected bands.
-
-    :param log_filename:
-        A string containing the file path of the output log produced by FMask.
-
     :param shadow_prob:
         A flag indicating if the shadow probability should be calculated or not (required by FMask cloud shadow). Type Bool.
+        Band 4 & 5 are kept as full scene arrays for the flood fill when set.
+
+    :param block_lines:
+        Number of lines in each window. Rounded down to a whole number of GDAL blocks.
+
+    :param fill:
+        The flood fill of the shadow probability, 'skimage' (default) or 'uint16', see imfill.
+
+    :param packed:
+        If True, the masks are returned as one packed mask raster, see plcloud.
+
+    :param dtype:
+        The type of the reflectance and temperature, 'float32' (default) or 'int16', see nd2toarbt. The returned temperature band has this type.
 
     :return:
         Tuple (zen,azi,ptm, temperature band (celcius*100),t_templ,t_temph, water mask, snow mask, cloud mask , shadow probability,dim,ul,resolu,zc).
     """
-    Temp, data, \
-        dim, ul, zen, azi, zc, \
-        satu_B1, satu_B2, satu_B3, \
-        resolu, geoT, prj = toa_bt
-
-    if num_Lst < 8: # Landsat 4~7
-        Thin_prob = 0 #  there is no contribution from the new bands
-    else:
-        Thin_prob = numexpr.evaluate("cirrus / 400", {'cirrus' : data[-1]}, locals())
+    n_ref = reference_band(filename)
+    geoT, prj, dim, ul = im_info(n_ref)
+    block_lines = align_block_lines(n_ref, block_lines)
 
     Cloud = numpy.zeros(dim,'uint8') # cloud mask
     Snow  = numpy.zeros(dim,'uint8') # Snow mask
     WT    = numpy.zeros(dim,'uint8') # Water msk
+    Shadow = numpy.zeros(dim,'uint8') # shadow mask
 
-    # process only the overlap area
-    if mask == None:
-        mask = Temp > -9999
+    # Per pixel results of the spectral tests, filled window by window
+    Temp = None
+    mask = numpy.empty(dim, 'bool')
+    idplcd = numpy.empty(dim, 'bool')
+    Vari_prob = numpy.empty(dim, 'float32')
+    Brightness_prob = numpy.empty(dim, 'float32')
+    if num_Lst < 8: # Landsat 4~7
+        Thin_prob = None #  there is no contribution from the new bands
     else:
-        mask = mask.astype('bool')
+        Thin_prob = numpy.empty(dim, 'float32')
+    if shadow_prob:
+        nir = numpy.empty(dim, 'float32')
+        swir = numpy.empty(dim, 'float32')
+
+    ################################################## Pass 1: DN to TOA/BT & spectral tests
+    # The MTL, band files & VRT are read once for all the windows
+    scene = _toa_scene(filename)
+    for window in iter_windows(dim, block_lines):
+        rows = slice(window[1], window[1] + window[3])
+
+        t_Temp, data, _dim, _ul, zen, azi, zc, \
+            satu_B1, satu_B2, satu_B3, \
+            resolu, _geoT, _prj = nd2toarbt(filename, window=window, dtype=dtype, scene=scene)
+        if Temp is None:
+            # Same type as nd2toarbt gives for the whole scene
+            Temp = numpy.empty(dim, t_Temp.dtype)
+        Temp[rows] = t_Temp
+        mask[rows] = t_Temp > -9999
+
+        if Thin_prob is None:
+            thin = 0
+        else:
+            thin = numexpr.evaluate("cirrus / 400", {'cirrus' : as_float(data[-1])}, locals())
+            Thin_prob[rows] = thin
 
-    Shadow = numpy.zeros(dim,'uint8') # shadow mask
+        data4 = data[3,:,:]
+        data5 = data[4,:,:]
 
-    data1 = data[0,:,:]
-    data2 = data[1,:,:]
-    data3 = data[2,:,:]
-    data4 = data[3,:,:]
-    data5 = data[4,:,:]
-    data6 = data[5,:,:]
+        # Basic, whiteness, haze, ratio, cirrus, snow & water tests
+        t_idplcd, NDVI, NDSI, whiteness = _spectral_tests(data, t_Temp, satu_B1, satu_B2, satu_B3, thin, Snow[rows], WT[rows])
+        idplcd[rows] = t_idplcd
 
-    NDVI = numexpr.evaluate("(data4 - data3) / (data4 + data3)")
-    NDSI = numexpr.evaluate("(data2 - data5) / (data2 + data5)")
+        # Variability & brightness probabilities only depend on the pixel itself
+        _variability_prob(NDVI, NDSI, whiteness, satu_B2, satu_B3, out=Vari_prob[rows])
+        _brightness_prob(data5, out=Brightness_prob[rows])
 
-    NDVI[numexpr.evaluate("(data4 + data3) == 0")] = 0.01
-    NDSI[numexpr.evaluate("(data2 + data5) == 0")] = 0.01
+        if shadow_prob:
+            nir[rows] = data4
+            swir[rows] = data5
 
-    ##############################################saturation in the three visible bands
-    satu_Bv = numexpr.evaluate("(satu_B1 | satu_B2 | satu_B3)")
-    del satu_B1
-    ################################################## Basic cloud test
-    idplcd = numexpr.evaluate("(NDSI < 0.8) & (NDVI < 0.8) & (data6 > 300) & (Temp < 2700)")
+        del data, data4, data5
+        del NDVI, NDSI, whiteness, t_idplcd
 
-    ################################################## Snow test
-    # It takes every snow pixels including snow pixel under thin clouds or icy clouds
-    Snow[numexpr.evaluate("(NDSI > 0.15) & (Temp < 1000) & (data4 > 1100) & (data2 > 1000)")] = 1
-    #Snow[mask == 0] = 255
-    ################################################## Water test
-    # Zhe's water test (works over thin cloud)
-    WT[numexpr.evaluate("((NDVI < 0.01) & (data4 < 1100)) | ((NDVI < 0.1) & (NDVI > 0) & (data4 < 500))")] = 1
     WT[mask == 0] = 255
-    # ################################################ Whiteness test
-    # visible bands flatness (sum(abs)/mean < 0.6 => brigt and dark cloud )
-    visimean = numexpr.evaluate("(data1 + data2 + data3) / 3 ")
-    whiteness = numexpr.evaluate("(abs(data1 - visimean) + abs(data2 - visimean)+ abs(data3 - visimean)) / visimean")
-    del visimean
-
-    # update idplcd
-    whiteness[satu_Bv] = 0# If one visible is saturated whiteness == 0
-    idplcd &= whiteness < 0.7
-
-    ################################################## Haze test
-    HOT = numexpr.evaluate("data1 - 0.5 * data3 - 800") # Haze test
-    idplcd &= numexpr.evaluate("(HOT > 0) | satu_Bv")
-    del HOT # need to find thick warm cloud
-
-    ######################################### Ratio4/5>0.75 cloud test
-    idplcd &= numexpr.evaluate("(data4 / data5) > 0.75")
-
-    ############################### Cirrus tests from Landsat 8
-    idplcd |= numexpr.evaluate("Thin_prob > 0.25")
+    resolu = (resolu[0], resolu[1])
 
     ####################################constants##########################
     l_pt = 0.175 # low percent
     h_pt = 1 - l_pt # high percent
-    ################################################(temperature & snow test )
-    # test whether use thermal or not
-    idclr = numexpr.evaluate("(idplcd == False) & (mask == 1)")
-    ptm = 100 * idclr.sum() / mask.sum() # percent of del pixel
-    idlnd = numexpr.evaluate("idclr & (WT == False)")
-    idwt = numexpr.evaluate("idclr & (WT == True)") # &data(:,:,6)<=300;
+    ################################################## Scene-wide statistics
+    idlnd = numexpr.evaluate("(idplcd == False) & (mask == 1) & (WT == False)")
+    idwt = numexpr.evaluate("(idplcd == False) & (mask == 1) & (WT == True)")
+    ptm = 100 * (idlnd.sum() + idwt.sum()) / mask.sum() # percent of del pixel
     lndptm= 100 * idlnd.sum() / mask.sum()
 
-    logger.debug('idlnd: %s', idlnd)
     logger.debug('idlnd.sum(): %s', idlnd.sum())
     logger.debug('lndptm: %s', lndptm)
-    sys.stdout.flush()
 
     if ptm <= 0.1: # no thermal test => meanless for snow detection (0~1)
-        #     fprintf('Clear pixel NOT exist in this scene (del prct = #.2f)\n',ptm)
         Cloud[idplcd] = 1 # all cld
-
         # mask out the non-contiguous pixels
         Cloud[~(mask)] = 0
-
-        # # improving by majority filtering
-        #Cloud=bwmorph(Cloud,'majority')# exclude <5/9
-        #Cloud = scipy.signal.convolve2d(Cloud,numpy.ones((3,3),Cloud.dtype.name))[1:-1,1:-1]
-        #Cloud = (Cloud > 4).astype('uint8')
-        # Applying twice, makes a cleaner result
-        #Cloud = scipy.signal.convolve2d(Cloud,numpy.ones((3,3),Cloud.dtype.name))[1:-1,1:-1]
-        #Cloud = Cloud > 4
-
         Shadow[Cloud == 0] = 1
         Temp = -1
         t_templ = -1
         t_temph = -1
     else:
-        # fprintf('Clear pixel EXIST in this scene (del prct = #.2f)\n',ptm)
-        #################################################(temperature test )
         if lndptm >= 0.1:
-            F_temp = Temp[idlnd] # get land temperature
-            #       fprintf('Land temperature\n')
+            id_temp = idlnd # get land temperature
         else:
-            F_temp = Temp[idclr] # get del temperature
-            #        fprintf('Clear temperature\n')
+            id_temp = idlnd | idwt # get del temperature
 
-        # Get cloud prob over water
-        ## temperature test (over water)
-        #F_wtemp = Temp[numexpr.evaluate("(WT == 1) & (data6 <= 300)")] # get del water temperature
-        F_wtemp = Temp[idwt]
-        if len(F_wtemp) == 0:
+        if not idwt.any():
             t_wtemp = 0
         else:
-            t_wtemp = scipy.stats.scoreatpercentile(F_wtemp, 100 * h_pt)
-        wTemp_prob = numexpr.evaluate('(t_wtemp - Temp) / 400')
-        wTemp_prob[numexpr.evaluate('wTemp_prob < 0')] = 0
-
-        ## Brightness test (over water)
-        t_bright = 1100
-        Brightness_prob = data5 / t_bright
-        Brightness_prob[Brightness_prob > 1] = 1
-        Brightness_prob[Brightness_prob < 0] = 0
-
-        ## Final prob mask (water)
-        wfinal_prob = numexpr.evaluate('100 * wTemp_prob * Brightness_prob + 100 * Thin_prob') # cloud over water probability
-        wclr_max    = scipy.stats.scoreatpercentile(wfinal_prob[idwt], 100 * h_pt) + cldprob # dynamic threshold (land)
-        #wclr_max=50;% fixed threshold (water)
+            t_wtemp, = masked_percentile(Temp, idwt, [100 * h_pt], block_lines=block_lines)
 
-        # release memory
-        del wTemp_prob
-        del Brightness_prob
-
-        ## Temperature test
         t_buffer = 4 * 100
-        if len(F_temp) != 0:
+        if id_temp.any():
             # 0.175 percentile background temperature (low)
-            t_templ = scipy.stats.scoreatpercentile(F_temp, 100 * l_pt)
             # 0.825 percentile background temperature (high)
-            t_temph = scipy.stats.scoreatpercentile(F_temp, 100 * h_pt)
+            t_templ, t_temph = masked_percentile(Temp, id_temp, [100 * l_pt, 100 * h_pt], block_lines=block_lines)
         else:
             t_templ = 0
             t_temph = 0
@@ -1213,149 +1498,207 @@ def plcloud_warm(toa_bt, cldprob=22.5, num_Lst=None,
         t_tempL = t_templ - t_buffer
         t_tempH = t_temph + t_buffer
         Temp_l = t_tempH - t_tempL
-        Temp_prob = (t_tempH - Temp) / Temp_l
-        # Temperature can have prob > 1
-        Temp_prob[Temp_prob < 0] = 0
-        #Temp_prob(Temp_prob > 1) = 1
-
-        NDSI[numexpr.evaluate('satu_B2 & (NDSI < 0)')] = 0
-        NDVI[numexpr.evaluate('satu_B3 & (NDVI > 0)')] = 0
-
-        Vari_prob= 1 - numpy.maximum(numpy.maximum(numpy.absolute(NDSI), numpy.absolute(NDVI)), whiteness)
-
-
-        # release memory
-        del satu_B2
-        del satu_B3
-        del NDSI
-        del NDVI
-        del whiteness
-
-        ## Final prob mask (land)
-        final_prob = 100 * Temp_prob * Vari_prob + 100 * Thin_prob # cloud over land probability
-        clr_max = scipy.stats.scoreatpercentile(final_prob[idlnd], 100 * h_pt) + cldprob # dynamic threshold (land)
 
-
-        # release memory
-        del Vari_prob
-        del Temp_prob
-        del Thin_prob
+        ################################################## Pass 2: dynamic thresholds
+        # Two passes of the streaming percentile estimator over the windows
+        F_final = StreamingPercentile([100 * h_pt], bin_width=0.01)
+        F_wfinal = StreamingPercentile([100 * h_pt], bin_width=0.01)
+        for feed in ('update', 'refine'):
+            for window in iter_windows(dim, block_lines):
+                rows = slice(window[1], window[1] + window[3])
+                final_prob, wfinal_prob = _plcloud_window_probs(
+                    Temp[rows], Vari_prob[rows], Brightness_prob[rows],
+                    0 if Thin_prob is None else Thin_prob[rows],
+                    t_wtemp, t_tempH, Temp_l)
+                getattr(F_final, feed)(final_prob[idlnd[rows]])
+                getattr(F_wfinal, feed)(wfinal_prob[idwt[rows]])
+        clr_max = F_final.result()[0] + cldprob # dynamic threshold (land)
+        wclr_max = F_wfinal.result()[0] + cldprob # dynamic threshold (water)
 
         logger.debug('cldprob: %s', cldprob)
         logger.debug('clr_max: %s', clr_max)
         logger.debug('t_templ: %s', t_templ)
-        sys.stdout.flush()
-
-        # fprintf('pcloud probability threshold (land) = .2f#\n',clr_max)
-        # cloud over land : (idplcd & (final_prob > clr_max) & (WT == 0))
-        # thin cloud over water : (idplcd & (wfinal_prob > wclr_max) & (WT == 1))
-        # high prob cloud (land) : (final_prob > 99.0) & (WT == 0)
-        # extremly cold cloud : (Temp < t_templ - 3500)
-        id_final_cld = numexpr.evaluate('(idplcd & (final_prob > clr_max) & (WT == 0)) | (idplcd & (wfinal_prob > wclr_max) & (WT == 1)) | (Temp < t_templ - 3500)')
 
-        ## Star with potential cloud mask
-        # # potential cloud mask
-        Cloud[id_final_cld] = 1
-
-        # release memory
-        del final_prob
-        del wfinal_prob
-        del id_final_cld
+        ################################################## Pass 3: potential cloud mask
+        for window in iter_windows(dim, block_lines):
+            rows = slice(window[1], window[1] + window[3])
+            final_prob, wfinal_prob = _plcloud_window_probs(
+                Temp[rows], Vari_prob[rows], Brightness_prob[rows],
+                0 if Thin_prob is None else Thin_prob[rows],
+                t_wtemp, t_tempH, Temp_l)
+            t_idplcd = idplcd[rows]
+            t_WT = WT[rows]
+            t_Temp = Temp[rows]
+            Cloud[rows][numexpr.evaluate('(t_idplcd & (final_prob > clr_max) & (t_WT == 0)) | (t_idplcd & (wfinal_prob > wclr_max) & (t_WT == 1)) | (t_Temp < t_templ - 3500)')] = 1
+        del final_prob, wfinal_prob, t_idplcd
+        # Only the land mask and Band 4 & 5 are left for the flood fills
+        del Vari_prob, Brightness_prob, Thin_prob, idwt
+        gc.collect()
 
         ## Start with potential cloud shadow mask
         if shadow_prob:
-            # band 4 flood fill
-            nir = data4.astype('float32')
+            data4 = nir.copy()
+            data5 = swir
             # estimating background (land) Band 4 ref
-            backg_B4 = scipy.stats.scoreatpercentile(nir[idlnd], 100.0 * l_pt)
+            backg_B4 = masked_percentile(nir, idlnd, [100.0 * l_pt])[0]
             nir[mask == 0] = backg_B4
             # fill in regional minimum Band 4 ref
-            nir = imfill_skimage(nir)
+            nir = imfill(nir, fill)
             nir = nir - data4
+            del data4
 
-            # band 5 flood fill
-            swir = data5
-            # estimating background (land) Band 4 ref
-            backg_B5 = scipy.stats.scoreatpercentile(swir[idlnd], 100.0 * l_pt)
+            # estimating background (land) Band 5 ref
+            backg_B5 = masked_percentile(swir, idlnd, [100.0 * l_pt])[0]
             swir[mask == 0] = backg_B5
             # fill in regional minimum Band 5 ref
-            swir = imfill_skimage(swir)
+            swir = imfill(swir, fill)
             swir = swir - data5
+            del data5
 
             # compute shadow probability
             shadow_prob = numpy.minimum(nir, swir)
-            # release remory
             del nir
             del swir
 
             Shadow[shadow_prob > 200] = 1
-            # release remory
             del shadow_prob
 
-        #Cloud[idplcd==True]=1 # all cld
-
-        #*************************************************************************************#
-        #*************************************************************************************#
-        #*************************************************************************************#
-        #************The following code may be removed as the new code has changed************#
-        # Mask the non-contiguous pixels
-        #Cloud[~(mask)] = 0
-
-        ## # improving by majority filtering
-        ## ERROR: not aware of a similar filter in scipy (though one may very well exist)
-        ## Doing convolution of all surrounding pixels & filtering those > 4, which should in theory have the same result
-        #Cloud = scipy.signal.convolve2d(Cloud, numpy.ones((3,3), Cloud.dtype.name))[1:-1,1:-1]
-        #Cloud = (Cloud > 4).astype('uint8')
-        ## Applying twice, makes a cleaner result
-        #Cloud = scipy.signal.convolve2d(Cloud, numpy.ones((3,3), Cloud.dtype.name))[1:-1,1:-1]
-        ##Cloud=(Cloud>4).astype('uint8')
-        ## 3rd, still some single pixels at tile edges
-        ##Cloud=scipy.signal.convolve2d(Cloud,numpy.ones((3,3),Cloud.dtype.name))[1:-1,1:-1]
-        #Cloud = Cloud > 4
-        #************The above code may be removed as the new code has changed****************#
-        #*************************************************************************************#
-        #*************************************************************************************#
-        #*************************************************************************************#
-
-    del data
-    images = None
+    del idplcd
     gc.collect()
 
     # refine Water mask - Zhe's water mask (no confusion water/cloud)
     WT[numexpr.evaluate("(WT == 1) & (Cloud == 0)")] = 1
-    # bwmorph changed Cloud to Binary
-    Cloud = Cloud.astype('uint8')
     Cloud[mask == 0] = 255
     Shadow[mask == 0] = 255
 
-    gc.collect()
-    cloud_mask = (Cloud == 1) & mask
+    logger.info("Final Cloud Layer Percent: %f\n" % ((float((Cloud == 1).sum()) / float(mask.sum())) * 100.0))
 
-    if ptm > 0.1:
-        cloud_temp = Temp[cloud_mask]
+    logger.info("Completed processing FMASK cloud cover...\n")
 
-        logger.debug("Snow Percent: %f\n" % ((float(Snow[mask].sum()) / float(mask.sum())) * 100.0))
-        logger.debug("Cloud Mean: %f C\n" % (numpy.mean(cloud_temp) / 100.0))
+    if packed:
+        # One raster of bit planes in place of the four class layers
+        WT = fmask_bitmask.pack(WT, Snow, Cloud, Shadow)
+        Snow = Cloud = Shadow = None
 
-        if numpy.sum(cloud_mask) > 0:
-            cloud_stddev  = numpy.std(cloud_temp, dtype='float64', ddof=1) / 100.0
-            pct_upper     = numpy.percentile(cloud_temp, 97.5) / 100.0
-            pct_lower     = numpy.percentile(cloud_temp, 83.5) / 100.0
-            pct_upper_max = numpy.percentile(cloud_temp, 98.75) / 100.0
+    return (zen,azi,ptm,Temp,t_templ,t_temph,WT,Snow,Cloud,Shadow,dim,ul,resolu,zc,geoT,prj)
 
-            logger.debug("Standard Deviation: %f C\n" % cloud_stddev)
-            logger.debug("97.5 percentile: %f C\n" % pct_upper)
-            logger.debug("83.5 percentile: %f C\n" % pct_lower)
-            logger.debug("98.75 percentile: %f C\n" % pct_upper_max)
+def _plcloud_window_probs(Temp, Vari_prob, Brightness_prob, Thin_prob,
+                          t_wtemp, t_tempH, Temp_l):
+    """ Cloud probability over land & water for one window of plcloud_tiled """
+    wfinal_prob = _water_prob(Temp, Brightness_prob, Thin_prob, t_wtemp) # cloud over water probability
+    final_prob = _land_prob(Temp, Vari_prob, Thin_prob, t_tempH, Temp_l) # cloud over land probability
+    return final_prob, wfinal_prob
 
-    logger.info("Final Cloud Layer Percent: %f\n" % ((float(Cloud[cloud_mask].sum()) / float(mask.sum())) * 100.0))
+def _spectral_tests(data, Temp, satu_B1, satu_B2, satu_B3, Thin_prob, Snow, WT):
+    """
+    Runs the per pixel spectral tests of plcloud as a few fused numexpr kernels.
 
-    logger.info("Completed processing FMASK cloud cover...\n")
+    The snow and water tests are evaluated straight into Snow and WT and the
+    potential cloud tests into a single boolean layer, so none of the tests
+    allocates full-scene temporaries (HOT, satu_Bv, the per test masks).
 
-    # We'll modify the return argument for the Python implementation (geoT,prj) are added to the list
-    return (zen,azi,ptm,Temp,t_templ,t_temph,WT,Snow,Cloud,Shadow,dim,ul,resolu,zc,geoT,prj)
+    :param data:
+        The TOA reflectance bands from nd2toarbt, float32 or int16.
+
+    :param Temp:
+        The brightness temperature from nd2toarbt.
+
+    :param satu_B1, satu_B2, satu_B3:
+        The saturation masks of the visible bands from nd2toarbt.
+
+    :param Thin_prob:
+        The cirrus probability (0 for Landsat 4~7).
 
-def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,resolu,ZC,cldpix,sdpix,snpix):
+    :param Snow:
+        A zeroed uint8 numpy.ndarray, set to 1 where the snow test passes.
+
+    :param WT:
+        A zeroed uint8 numpy.ndarray, set to 1 where the water test passes.
+
+    :return:
+        Tuple (potential cloud layer, NDVI, NDSI, whiteness).
+    """
+    if data.dtype.kind != 'f':
+        # int16 bands (see nd2toarbt) are tested as float32, a stripe of
+        #   rows at a time
+        dim = data.shape[1:]
+        idplcd = numpy.empty(dim, 'bool')
+        NDVI = numpy.empty(dim, 'float32')
+        NDSI = numpy.empty(dim, 'float32')
+        whiteness = numpy.empty(dim, 'float32')
+        for window in iter_windows(dim):
+            rows = slice(window[1], window[1] + window[3])
+            thin = Thin_prob if numpy.isscalar(Thin_prob) else Thin_prob[rows]
+            idplcd[rows], NDVI[rows], NDSI[rows], whiteness[rows] = _spectral_tests(data[:, rows].astype(numpy.float32), as_float(Temp[rows]), satu_B1[rows], satu_B2[rows], satu_B3[rows], thin, Snow[rows], WT[rows])
+        return idplcd, NDVI, NDSI, whiteness
+
+    data1 = data[0,:,:]
+    data2 = data[1,:,:]
+    data3 = data[2,:,:]
+    data4 = data[3,:,:]
+    data5 = data[4,:,:]
+    data6 = data[5,:,:]
+
+    # float32 constants, as numpy used them with the float32 bands
+    fill = numpy.float32(0.01)
+    w_max = numpy.float32(0.7)
+
+    NDVI = numexpr.evaluate("where((data4 + data3) == 0, fill, (data4 - data3) / (data4 + data3))")
+    NDSI = numexpr.evaluate("where((data2 + data5) == 0, fill, (data2 - data5) / (data2 + data5))")
+
+    ################################################## Snow test
+    # It takes every snow pixels including snow pixel under thin clouds or icy clouds
+    numexpr.evaluate("(NDSI > 0.15) & (Temp < 1000) & (data4 > 1100) & (data2 > 1000)", out=Snow.view('bool'))
+    ################################################## Water test
+    # Zhe's water test (works over thin cloud)
+    numexpr.evaluate("((NDVI < 0.01) & (data4 < 1100)) | ((NDVI < 0.1) & (NDVI > 0) & (data4 < 500))", out=WT.view('bool'))
+
+    # ################################################ Whiteness test
+    # visible bands flatness (sum(abs)/mean < 0.6 => brigt and dark cloud )
+    # If one visible is saturated whiteness == 0, computed in the visimean buffer
+    visimean = numexpr.evaluate("(data1 + data2 + data3) / 3 ")
+    whiteness = numexpr.evaluate("where(satu_B1 | satu_B2 | satu_B3, 0, (abs(data1 - visimean) + abs(data2 - visimean)+ abs(data3 - visimean)) / visimean)", out=visimean)
+    del visimean
+
+    # Basic cloud test & whiteness test & haze test (HOT > 0 or saturated
+    #   visible band, to find thick warm cloud) & Ratio4/5>0.75 cloud test, or
+    #   cirrus test from Landsat 8
+    idplcd = numexpr.evaluate("((NDSI < 0.8) & (NDVI < 0.8) & (data6 > 300) & (Temp < 2700) & (whiteness < w_max) & ((data1 - 0.5 * data3 - 800 > 0) | satu_B1 | satu_B2 | satu_B3) & ((data4 / data5) > 0.75)) | (Thin_prob > 0.25)")
+
+    return idplcd, NDVI, NDSI, whiteness
+
+def _variability_prob(NDVI, NDSI, whiteness, satu_B2, satu_B3, out=None):
+    """
+    Spectral variability probability, 1 - max(|NDSI|, |NDVI|, whiteness).
+
+    NDSI and NDVI are overwritten. NaN propagates as with numpy.maximum.
+    """
+    numexpr.evaluate("where(satu_B2 & (NDSI < 0), 0, NDSI)", out=NDSI)
+    numexpr.evaluate("where(satu_B3 & (NDVI > 0), 0, NDVI)", out=NDVI)
+    numexpr.evaluate("where((abs(NDSI) >= abs(NDVI)) | (NDSI != NDSI), abs(NDSI), abs(NDVI))", out=NDSI)
+    return numexpr.evaluate("1 - where((NDSI >= whiteness) | (NDSI != NDSI), NDSI, whiteness)", out=out)
+
+def _brightness_prob(data5, out=None):
+    """ Brightness probability over water, Band 5 ref / 1100 within [0, 1] """
+    data5 = as_float(data5)
+    return numexpr.evaluate("where(data5 / 1100 > 1, 1, where(data5 / 1100 < 0, 0, data5 / 1100))", out=out)
+
+def _water_prob(Temp, Brightness_prob, Thin_prob, t_wtemp, out=None):
+    """ Cloud over water probability (temperature, brightness & cirrus) """
+    Temp = as_float(Temp)
+    return numexpr.evaluate("100 * where((t_wtemp - Temp) / 400 < 0, 0, (t_wtemp - Temp) / 400) * Brightness_prob + 100 * Thin_prob", out=out)
+
+def _land_prob(Temp, Vari_prob, Thin_prob, t_tempH, Temp_l, out=None):
+    """ Cloud over land probability (temperature, variability & cirrus) """
+    # numpy computed the temperature probability in the type of Temp
+    Temp = as_float(Temp)
+    t_tempH = Temp.dtype.type(t_tempH)
+    Temp_l = Temp.dtype.type(Temp_l)
+    # Temperature can have prob > 1
+    return numexpr.evaluate("100 * where((t_tempH - Temp) / Temp_l < 0, 0, (t_tempH - Temp) / Temp_l) * Vari_prob + 100 * Thin_prob", out=out)
+
+@fmask_profile.stage('fcssm')
+def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,resolu,ZC,cldpix,sdpix,snpix,n_jobs=1,search='exhaustive',progress=None):
     """
     NEW:
     fcssm(dir_im,Sun_zen,Sun_azi,ptm,Temp,...
@@ -1385,7 +1728,7 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
         0.825 percentile background temperature (high).
 
     :param Water:
-        A numpy.ndarray of type Bool containing the water mask calculated by FMask.
+        A numpy.ndarray of type Bool containing the water mask calculated by FMask, or the packed mask raster of plcloud(packed=True), in which case Snow, plcim and plsim are None.
 
     :param Snow:
         A numpy.ndarray of type Bool containing the snow mask calculated by FMask.
@@ -1410,6 +1753,31 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
 
     :param sdpix:
         A number for the cloud shadow mask dilation (in pixels)
+
+    :param n_jobs:
+        The number of processes used to match the cloud objects to their shadows, and of threads used for the dilations. Default is 1 (no process pool).
+
+    :param search:
+        The cloud height search strategy. 'exhaustive' (default) visits every height step like the original Fmask code, 'coarse' does a coarse sweep followed by a local refinement.
+
+    :param progress:
+        An optional callable taking (stage, fraction), called through the segmentation ('segmentation'), the cloud/shadow matching ('matching') and the dilation ('dilation').
+    """
+    state = fcssm_match(Sun_zen, Sun_azi, ptm, Temp, t_templ, t_temph, Water,
+                        Snow, plcim, plsim, ijDim, resolu, ZC,
+                        n_jobs=n_jobs, search=search, progress=progress)
+    return fcssm_dilate(state, cldpix, sdpix, snpix, progress=progress,
+                        n_jobs=n_jobs)
+
+@fmask_profile.stage('fcssm_match')
+def fcssm_match(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,resolu,ZC,n_jobs=1,search='exhaustive',progress=None):
+    """
+    Matches the clouds of a scene to their shadows, i.e. everything in fcssm before the cloud, cloud shadow and snow dilation.
+
+    The parameters are those of fcssm, without the dilation buffers.
+
+    :return:
+        A dict holding the cloud shadow match similarity (similar_num), the cloud objects (segm_cloud) and the packed mask raster (masks) with the undilated cloud shadow in its MATCHED_SHADOW bit plane (see fmask_bitmask). Pass it to fcssm_dilate.
     """
     # Function for Cloud, cloud Shadow, and Snow Masking 1.6.3sav
     # History of revisions:
@@ -1430,31 +1798,21 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
     sun_tazi_rad = math.radians(Sun_tazi)
     # assume resolu.x=resolu.y
     sub_size = resolu[0]
-    win_height = ijDim[0]
-    win_width = ijDim[1]
-
-    # potential cloud & shadow layer
-    cloud_test = numpy.zeros(ijDim,'uint8')
-    shadow_test = numpy.zeros(ijDim,'uint8')
-    # matched cloud & shadow layer
-    shadow_cal = numpy.zeros(ijDim,'uint8')
-    cloud_cal = numpy.zeros(ijDim,'uint8')
-    # cloud_height=zeros(ijDim)# cloud relative height (m)
-    # boundary layer
-    boundary_test = numpy.zeros(ijDim,'uint8')
-    # final cloud, shadow and snow mask
-    cs_final = numpy.zeros(ijDim,'uint8')
-
-    # get potential mask values
-    shadow_test[plsim == 1] = 1# plshadow layer
-    del plsim # empty memory
 
-    boundary_test[plcim < 255] = 1 # boundary layer
-    cloud_test[plcim == 1] = 1# plcloud layer
-    del plcim # empty memory
+    # boundary (VALID), potential cloud (CLOUD) & shadow (SHADOW) layers,
+    #   water & snow, and the matched shadow layer (MATCHED_SHADOW) as bit
+    #   planes of one raster, see fmask_bitmask
+    if plcim is None:
+        masks = Water.copy()
+    else:
+        masks = fmask_bitmask.pack(Water, Snow, plcim, plsim)
+    del Water, Snow, plcim, plsim # empty memory
+    # cloud_height=zeros(ijDim)# cloud relative height (m)
 
     # revised percent of cloud on the scene after plcloud
-    revised_ptm = numpy.sum(cloud_test) / numpy.sum(boundary_test)
+    hist = fmask_bitmask.counts(masks)
+    revised_ptm = fmask_bitmask.count(hist, fmask_bitmask.CLOUD) / \
+        fmask_bitmask.count(hist, fmask_bitmask.VALID)
     # no t test  => more than 98 # clouds and partly cloud over land
     # => no match => rest are definite shadows
 
@@ -1464,9 +1822,9 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
 
     if ptm <= 0.1 or revised_ptm >= 0.90:
         #     fprintf('No Shadow Match due to too much cloud (>90 percent)\n')
-        cloud_cal[cloud_test == True] = 1
-        shadow_cal[cloud_test == False] = 1
+        # cloud_cal is the cloud layer & shadow_cal the rest, see fcssm_dilate
         similar_num = -1
+        segm_cloud = None
         #   height_num=-1
 
     else:
@@ -1489,10 +1847,8 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
         #     fprintf('Shadow match for cloud object >= #d pixels\n',num_cldoj)
 
 
-        i_step = 2 * sub_size * math.tan(sun_ele_rad) # move 2 pixel at a time
-
         # get moving direction
-        (rows,cols)= numpy.nonzero(boundary_test)
+        (rows,cols)= numpy.nonzero(masks & fmask_bitmask.VALID)
         (y_ul,num) = (rows.min(), rows.argmin())
         x_ul = cols[num]
 
@@ -1509,9 +1865,11 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
         #print x_ul, y_ul, x_ur, y_ur, x_ll, y_ll, x_lr, y_lr
         (A, B, C, omiga_par, omiga_per) = viewgeo(float(x_ul), float(y_ul), float(x_ur), float(y_ur), float(x_ll), float(y_ll), float(x_lr), float(y_lr))
 
+        report(progress, 'segmentation', 0.0)
+        fmask_profile.step('segmentation')
         # Segmentate each cloud
         #     fprintf('Cloud segmentation & matching\n')
-        (segm_cloud_init,segm_cloud_init_features) = scipy.ndimage.measurements.label(cloud_test, scipy.ndimage.morphology.generate_binary_structure(2,2))
+        (segm_cloud_init,segm_cloud_init_features) = scipy.ndimage.measurements.label(masks & fmask_bitmask.CLOUD, scipy.ndimage.morphology.generate_binary_structure(2,2))
 
         # filter out cloud object < than num_cldoj pixels
         morphology.remove_small_objects(segm_cloud_init, num_cldoj, in_place=True)
@@ -1521,146 +1879,77 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
             segm_cloud, fw, inv = segmentation.relabel_from_one(segm_cloud_init)
         num = numpy.max(segm_cloud)
 
-        # NOTE: properties is deprecated as of version 0.9 and all properties are computed. Currently using version 0.8.2. If this version or a later versionproves too slow, I'll implement another method. JS 16/12/2013
-        # The properties is taking approx 3min, I can cut that down to just a few seconds using another method, but will leave for the time being.
-        if skimage_version[1] > 9:
-            s = measure.regionprops(segm_cloud)
-        else:
-            s = measure.regionprops(segm_cloud,  properties=['Area', 'Coordinates'])
+        # Coordinates of each cloud object, grouped by label in one pass
+        # (replaces skimage.measure.regionprops)
+        segments = SegmentTable(segm_cloud, num)
+        report(progress, 'segmentation', 1.0)
+        fmask_profile.note(segm_cloud=segm_cloud)
 
+        fmask_profile.step('matching')
         # Use iteration to get the optimal move distance
         # Calulate the moving cloud shadow
+        # The per object height search is batched & vectorised in ShadowMatcher
+        matcher = ShadowMatcher(Temp, segm_cloud, masks, t_templ, t_temph,
+                                Sun_azi, sun_ele_rad, sun_tazi_rad, sub_size,
+                                (A, B, C, omiga_par, omiga_per),
+                                {'Tsimilar' : Tsimilar, 'Tbuffer' : Tbuffer,
+                                 'num_pix' : num_pix,
+                                 'rate_elapse' : rate_elapse,
+                                 'rate_dlapse' : rate_dlapse},
+                                search=search)
+        similar_num = matcher.run(segments, num, masks,
+                                  value=fmask_bitmask.MATCHED_SHADOW,
+                                  n_jobs=n_jobs, progress=progress)
+
+    return {'similar_num' : similar_num, 'segm_cloud' : segm_cloud,
+            'masks' : masks}
+
+@fmask_profile.stage('fcssm_dilate')
+def fcssm_dilate(state, cldpix, sdpix, snpix, progress=None, cache=None, n_jobs=None):
+    """
+    Dilates the matched clouds, cloud shadows and snow from fcssm_match and composes the final mask.
 
-        # height_num=zeros(num) # cloud relative height (m)
-        similar_num = numpy.zeros(num) # cloud shadow match similarity (m)
-
-        # Newer method of looping through the cloud objects/segments JS 16/12/2013
-        for cloud_type in s:
-
-            cld_area  = cloud_type['Area']
-            cld_label = cloud_type['Label']
-
-            num_pixels = cld_area
-
-            # Have re-formatted the arrays to be Python style memory ordering (2,num_pixels) JS 16/12/2013
-            # moving cloud xys
-            XY_type = numpy.zeros((2,num_pixels), dtype='uint32')
-
-            # record the max threshold moving cloud xys
-            tmp_XY_type = numpy.zeros((2,num_pixels), dtype='uint32')
-
-            # corrected for view angle xys
-            tmp_xys = numpy.zeros((2,num_pixels)) # Leave as float for the time being
-
-            # record this original ids
-            orin_cid = (cloud_type['Coordinates'][:,0],cloud_type['Coordinates'][:,1])
-
-            # Temperature of the cloud object
-            temp_obj = Temp[orin_cid]
-
-            # assume object is round r_obj is radium of object
-            r_obj    = math.sqrt(cld_area / math.pi)
-
-            # number of inward pixes for correct temperature
-            #        num_pix=8
-            pct_obj = math.pow(r_obj - num_pix, 2) / math.pow(r_obj, 2)
-            pct_obj = numpy.minimum(pct_obj, 1) # pct of edge pixel should be less than 1
-            t_obj   = scipy.stats.mstats.mquantiles(temp_obj, pct_obj)
-
-            # put the edge of the cloud the same value as t_obj
-            temp_obj[temp_obj > t_obj] = t_obj
-
-            # wet adiabatic lapse rate 6.5 degrees/km
-            # dry adiabatic lapse rate 9.8 degrees/km
-            #        rate_wlapse=6.5# degrees/km
-            #        rate_dlapse=9.8# degrees/km
-
-            Max_cl_height = 12000 # Max cloud base height (m)
-            Min_cl_height = 200 # Min cloud base height (m)
-
-            # refine cloud height range (m)
-            Min_cl_height = max(Min_cl_height, 10 *(t_templ - 400 - t_obj) / rate_dlapse)
-            Max_cl_height = min(Max_cl_height, 10 *(t_temph + 400 - t_obj))
-
-            # initialize height and similarity info
-            record_h = 0.0
-            record_thresh = 0.0
-
-            for base_h in numpy.arange(Min_cl_height, Max_cl_height, i_step): # iterate in height (m)
-                # Get the true postion of the cloud
-                # calculate cloud DEM with initial base height
-                h = (10 * (t_obj - temp_obj) / rate_elapse + base_h)
-                tmp_xys[1,:], tmp_xys[0,:] = mat_truecloud(orin_cid[1], orin_cid[0], h, A, B, C, omiga_par, omiga_per) # Function is returned as (x_new,y_new)
-
-                # shadow moved distance (pixel)
-                # i_xy=h*cos(sun_tazi_rad)/(sub_size*math.tan(sun_ele_rad))
-                i_xy = h / (sub_size * math.tan(sun_ele_rad))
-
-                if Sun_azi < 180:
-                    XY_type[1,:] = numpy.round(tmp_xys[1,:] - i_xy * math.cos(sun_tazi_rad)) # X is for j,1
-                    XY_type[0,:] = numpy.round(tmp_xys[0,:] - i_xy * math.sin(sun_tazi_rad)) # Y is for i,0
-                else:
-                    XY_type[1,:] = numpy.round(tmp_xys[1,:] + i_xy * math.cos(sun_tazi_rad)) # X is for j,1
-                    XY_type[0,:] = numpy.round(tmp_xys[0,:] + i_xy * math.sin(sun_tazi_rad)) # Y is for i,0
-
-                tmp_j = XY_type[1,:] # col
-                tmp_i = XY_type[0,:] # row
-
-
-                # the id that is out of the image
-                out_id = (tmp_i < 0) | (tmp_i >= win_height) | (tmp_j < 0) | (tmp_j >= win_width)
-                out_all = numpy.sum(out_id)
+    The state is not modified, so it can be dilated again with other buffers.
 
-                tmp_ii = tmp_i[out_id == 0]
-                tmp_jj = tmp_j[out_id == 0]
+    :param state:
+        The dict returned by fcssm_match.
 
-                tmp_id = [tmp_ii, tmp_jj]
+    :param cldpix:
+        A number for the cloud mask dilation (in pixels).
 
-                # the id that is matched (exclude original cloud)
-                match_id = numexpr.evaluate("(b_test == 0) | ((seg != label) & ((cld_test > 0) | (shad_test == 1)))", {'b_test':boundary_test[tmp_id], 'seg':segm_cloud[tmp_id], 'label':cld_label, 'cld_test':cloud_test[tmp_id], 'shad_test':shadow_test[tmp_id]})
-                matched_all = numpy.sum(match_id) + out_all
+    :param sdpix:
+        A number for the cloud shadow mask dilation (in pixels)
 
-                # the id that is the total pixel (exclude original cloud)
-                total_id = segm_cloud[tmp_id] != cld_label
-                total_all = numpy.sum(total_id) + out_all
+    :param snpix:
+        A number for the snow mask dilation (in pixels)
 
-                thresh_match = numpy.float32(matched_all) / total_all
-                if (thresh_match >= (Tbuffer * record_thresh)) and (base_h < (Max_cl_height - i_step)) and (record_thresh < 0.95):
-                    if thresh_match > record_thresh:
-                        record_thresh = thresh_match
-                        record_h = h
+    :param progress:
+        An optional callable taking (stage, fraction), called before and after the dilation ('dilation').
 
-                elif record_thresh > Tsimilar:
-                    similar_num[cld_label -1] = record_thresh # -1 to account for the zero based index used by Python (MATLAB is 1 one based).
-                    i_vir = record_h / (sub_size * math.tan(sun_ele_rad))
-                    # height_num=record_h
+    :param cache:
+        An optional dict, empty for the first call on a state and then passed again with it. The dilated cloud, cloud shadow and snow layers are kept in it by buffer, so a layer is dilated once per buffer value when several buffer combinations are tried. The shadow_cal returned is then shared with the cache and must not be modified.
 
-                    if Sun_azi < 180:
-                        tmp_XY_type[1,:] = numpy.round(tmp_xys[1,:] - i_vir * math.cos(sun_tazi_rad)) # X is for col j,2
-                        tmp_XY_type[0,:] = numpy.round(tmp_xys[0,:] - i_vir * math.sin(sun_tazi_rad)) # Y is for row i,1
-                    else:
-                        tmp_XY_type[1,:] = numpy.round(tmp_xys[1,:] + i_vir * math.cos(sun_tazi_rad)) # X is for col j,2
-                        tmp_XY_type[0,:] = numpy.round(tmp_xys[0,:] + i_vir * math.sin(sun_tazi_rad)) # Y is for row i,1
-
-                    tmp_scol = tmp_XY_type[1,:]
-                    tmp_srow = tmp_XY_type[0,:]
-
-                    # put data within range
-                    tmp_srow[tmp_srow < 0] = 0
-                    tmp_srow[tmp_srow >= win_height] = win_height - 1
-                    tmp_scol[tmp_scol < 0] = 0
-                    tmp_scol[tmp_scol >= win_width] = win_width - 1
-
-                    tmp_sid = [tmp_srow, tmp_scol] # sub2ind(ijDim,tmp_srow,tmp_scol)
-                    # give shadow_cal=1
-                    shadow_cal[tmp_sid] = 1
-                    # record matched cloud
-                    #cloud_cal(orin_cid)=1
-                    # cloud_height[orin_cid]=record_h
-                    break
-                else:
-                    record_thresh = 0.0
+    :param n_jobs:
+        The number of threads of the dilations (see fmask_morphology). Default is the number of CPUs.
 
+    :return:
+        Tuple (similar_num, cspt, shadow_cal, cs_final), as fcssm.
+    """
+    similar_num = state['similar_num']
+    segm_cloud = state['segm_cloud']
+    masks = state['masks']
+
+    report(progress, 'dilation', 0.0)
+    # final water, snow, cloud shadow and cloud layers as bit planes
+    final = numpy.bitwise_and(masks, fmask_bitmask.VALID | fmask_bitmask.WATER)
+
+    if segm_cloud is None:
+        # no match => no dilation; the potential clouds are the clouds and
+        #   the rest of the scene is shadow
+        cloud_cal = fmask_bitmask.layer(masks, fmask_bitmask.CLOUD)
+        shadow_cal = (~cloud_cal).view('uint8')
+        Snow = fmask_bitmask.layer(masks, fmask_bitmask.SNOW)
+    else:
         # # dilate each cloud and shadow object by 3 and 6 pixel outward in 8 connect directions
         #    cldpix=3 # number of pixels to be dilated for cloud
         #    sdpix=3 # number of pixels to be dilated for shadow
@@ -1668,41 +1957,50 @@ def fcssm(Sun_zen,Sun_azi,ptm,Temp,t_templ,t_temph,Water,Snow,plcim,plsim,ijDim,
 
         # NOTE: An alternative for a structuring element would be to use the iterations parameter of binary_dilation()
         # The number of iterations is equal to the number of dilations if using a 3x3 structuring element. JS 16/12/2013
-        SEc  = 2 * cldpix + 1
-        SEc  = numpy.ones((SEc, SEc), 'uint8')
-        SEs  = 2 * sdpix + 1
-        SEs  = numpy.ones((SEs, SEs), 'uint8')
-        SEsn = 2 * snpix + 1
-        SEsn = numpy.ones((SEsn, SEsn), 'uint8')
+        # The (2n+1)x(2n+1) square dilations of binary_dilation are done as separable running maxima on row stripes, see fmask_morphology
+        if cache is None:
+            cache = {}
+
+        def dilate(name, pix, layer):
+            # layer is called only if the dilation is not cached
+            if (name, pix) not in cache:
+                cache[(name, pix)] = fmask_morphology.dilate(layer(), pix, n_jobs=n_jobs)
+            return cache[(name, pix)]
 
         # dilate shadow first
         # NOTE: The original transcription returned the inverse, i.e. cloud_shadow = 0 rather than 1. We'll try inverting it outside this function in order to preserve the original return values of Fmask
-        shadow_cal = scipy.ndimage.morphology.binary_dilation(shadow_cal, structure=SEs)
+        shadow_cal = dilate('shadow', sdpix, lambda: masks & fmask_bitmask.MATCHED_SHADOW)
 
         #     # find shadow within plshadow
         #     shadow_cal(shadow_test~=1)=0
         #     # dilate shadow again with the more accurate cloud shadow
         #     shadow_cal=imdilate(shadow_cal,SEs)
 
-        segm_cloud_tmp = numexpr.evaluate("segm_cloud != 0")
         # NOTE: The original transcription returned the inverse, i.e. cloud = 0 rather than 1. We'll try inverting it outside this function in order to preserve the original return values of Fmask
-        cloud_cal = scipy.ndimage.morphology.binary_dilation(segm_cloud_tmp, structure=SEc)
+        cloud_cal = dilate('cloud', cldpix, lambda: numexpr.evaluate("segm_cloud != 0", {'segm_cloud' : segm_cloud}))
 
-        Snow = scipy.ndimage.morphology.binary_dilation(Snow, structure=SEsn)
+        Snow = dilate('snow', snpix, lambda: masks & fmask_bitmask.SNOW)
 
-    cs_final[Water == 1] = 1
-    # mask from plcloud
+    for bit, layer in ((fmask_bitmask.SNOW, Snow),
+                       (fmask_bitmask.MATCHED_SHADOW, shadow_cal),
+                       (fmask_bitmask.CLOUD, cloud_cal)):
+        numpy.bitwise_or(final, bit, out=final, where=layer.view('bool'))
+    del Snow
+
+    # mask from plcloud, in one lookup (FMASK_CODES)
     # step 1 snow or unknow
-    cs_final[Snow == 1] = 3 # snow
     # step 2 shadow above snow and everyting
-    cs_final[shadow_cal == 1] = 2 #shadow
     # step 3 cloud above all
-    cs_final[cloud_cal == 1] = 4 # cloud
-    cs_final[boundary_test == 0] = 255
+    cs_final = fmask_bitmask.classes(final, fmask_bitmask.FMASK_CODES,
+                                     outside=fmask_bitmask.FMASK_OUTSIDE)
+    del final
 
     # record cloud and cloud shadow percent
-    tmpcs = ((cs_final == 1) | (cs_final == 3)).astype('uint8')
-    cspt = 100.0 * (tmpcs.sum() / boundary_test.sum())
+    hist = numpy.bincount(cs_final.ravel(), minlength=256)
+    cspt = 100.0 * ((hist[1] + hist[3]) /
+                    fmask_bitmask.count(fmask_bitmask.counts(masks),
+                                        fmask_bitmask.VALID))
+    report(progress, 'dilation', 1.0)
 
     return (similar_num, cspt, shadow_cal, cs_final)
 
@@ -1730,26 +2028,70 @@ def viewgeo(x_ul, y_ul, x_ur, y_ur, x_ll, y_ll, x_lr, y_lr):
     omiga_per = math.atan( B / A) # get the angle which is perpendicular to the trace line
     return (A,B,C,omiga_par,omiga_per)
 
-# mat_truecloud function
-def mat_truecloud(x, y, h, A, B, C, omiga_par, omiga_per):
-    # imput "x",j col
-    # imput "y",i row
-    # imput cloud height "h"
-    H = 705000 # average Landsat 7 height (m)
-    dist = (A * x + B * y + C) / math.sqrt(A * A + B * B) # from the cetral perpendicular (unit: pixel)
-    dist_par = dist / math.cos(omiga_per - omiga_par)
-    dist_move = dist_par * h / H # cloud move distance (m)
-    delt_x = dist_move * math.cos(omiga_par)
-    delt_y = dist_move * math.sin(omiga_par)
+def output_bands(masks, shadow_cal):
+    """
+    The cloud and cloud shadow bands written by run_FMask.
 
-    x_new = x + delt_x # new x, j
-    y_new = y + delt_y # new y, i
+    Cloud*255 & shadow_cal*255 (uint8, as written before) are given as lookup tables, applied block by block while writing (see fmask_output.write_bands).
 
-    return (x_new, y_new)
+    :param masks:
+        The packed plcloud masks (see fmask_bitmask).
+    :param shadow_cal:
+        The dilated cloud shadow mask of fcssm.
+
+    :return:
+        The (cloud, cloud shadow) bands.
+    """
+    times_255 = (numpy.arange(256) * 255).astype('uint8')
+    cloud = (masks, times_255[fmask_bitmask.lookup(
+        ((fmask_bitmask.CLOUD, 1), ), outside=255)])
+    shadow = (shadow_cal, times_255)
+    return cloud, shadow
+
+def run_FMask(mtl, outdir, cldprob=22.5, cldpix=3, sdpix=3, snpix=3,
+              tiled=False, block_lines=512, n_jobs=1,
+              search='exhaustive', profile=None, fill='skimage',
+              output='envi', multiband=False, dtype='float32'):
+    """
+    Run Fmask on a scene and write the cloud, cloud shadow and Fmask results to outdir.
+
+    :param mtl:
+        The MTL file of the scene, or the scene archive (.tar.gz, .tgz or .tar), which is read without extracting it.
+
+    :param profile:
+        An optional filename. If given, the wall time and memory use of each stage of the run are written to it as JSON (see fmask_profile).
+
+    :param output:
+        The output profile (see fmask_output): 'envi' (default, uncompressed ENVI), 'gtiff', 'deflate', 'zstd' or 'cog' (Cloud Optimized GeoTIFF). GeoTIFF outputs get a .tif extension.
+
+    :param multiband:
+        If True, the cloud, cloud shadow and Fmask rasters are written as the three bands of a single fmask file.
+
+    :param fill:
+        The flood fill of the shadow probability, 'skimage' (default) or 'uint16', see imfill.
+
+    :param dtype:
+        The type the reflectance and temperature are held in, 'float32' (default) or 'int16' (half the memory, rounded values), see nd2toarbt.
+
+    :return:
+        A dict summarising the run: the output filenames, the scene dimensions, the seconds spent in plcloud and fcssm, the number of cloud objects matched to a shadow (matched_clouds) and the cloud and cloud shadow percentage recorded by fcssm (cspt).
+    """
+    if profile is not None:
+        with fmask_profile.Profiler(scene=mtl) as profiler:
+            with fmask_profile.stage('run_FMask'):
+                summary = run_FMask(mtl, outdir, cldprob, cldpix, sdpix,
+                                    snpix, tiled, block_lines, n_jobs, search,
+                                    fill=fill, output=output,
+                                    multiband=multiband, dtype=dtype)
+        profiler.write(profile)
+        summary['profile'] = profile
+        return summary
+
+    # Scene archives are read in place through /vsitar/
+    mtl = scene_mtl(mtl)
 
-def run_FMask(mtl, outdir, cldprob=22.5, cldpix=3, sdpix=3, snpix=3):
     # Check that the MTL file exists
-    assert os.path.exists(mtl), "Invalid filename: %s" % mtl
+    assert exists(mtl), "Invalid filename: %s" % mtl
 
     if not os.path.exists(outdir):
         os.mkdir(outdir)
@@ -1759,68 +2101,79 @@ def run_FMask(mtl, outdir, cldprob=22.5, cldpix=3, sdpix=3, snpix=3):
 
     # Create the output filenames
     log_fname          = os.path.join(outdir, 'FMASK_LOGFILE.txt')
-    cloud_fname        = os.path.join(outdir, 'fmask_cloud')
-    cloud_shadow_fname = os.path.join(outdir, 'fmask_cloud_shadow')
-    fmask_fname        = os.path.join(outdir, 'fmask')
+    ext                = extension(output)
+    cloud_fname        = os.path.join(outdir, 'fmask_cloud' + ext)
+    cloud_shadow_fname = os.path.join(outdir, 'fmask_cloud_shadow' + ext)
+    fmask_fname        = os.path.join(outdir, 'fmask' + ext)
 
     # Open the MTL file.
     # The original MATLAB code opens the file twice to retrieve the Landsat number.
-    # It would be better to open it once and restructure the function parameters.
-    data = {}
-    fl = open(mtl,'r')
-    file_lines = fl.readlines()
-    for line in file_lines:
-        values = line.split(' = ')
-        if len(values) != 2:
-            continue
-
-        data[values[0].strip()] = values[1].strip().strip('"')
-
-    fl.close()
+    # read_mtl parses it once for this and lndhdrread.
+    data = read_mtl(mtl)
 
     # Identify Landsat Number (Lnum = 4, 5 or 7)
     LID=data['SPACECRAFT_ID']
     Lnum=int(LID[len(LID)-1])
 
     st = datetime.datetime.now()
-    zen, azi, ptm, Temp, t_templ, t_temph, WT, Snow, Cloud, Shadow, dim, ul, resolu, zc, geoT, prj = plcloud(mtl, cldprob, num_Lst=Lnum, shadow_prob=True)
+    if tiled:
+        zen, azi, ptm, Temp, t_templ, t_temph, masks, _, _, _, dim, ul, resolu, zc, geoT, prj = plcloud_tiled(mtl, cldprob, num_Lst=Lnum, shadow_prob=True, block_lines=block_lines, fill=fill, packed=True, dtype=dtype)
+    else:
+        zen, azi, ptm, Temp, t_templ, t_temph, masks, _, _, _, dim, ul, resolu, zc, geoT, prj = plcloud(mtl, cldprob, num_Lst=Lnum, shadow_prob=True, fill=fill, packed=True, dtype=dtype)
     et = datetime.datetime.now()
     logger.info('time taken for plcloud function: %s', str(et - st))
+    plcloud_time = et - st
     st = datetime.datetime.now()
-    similar_num, cspt, shadow_cal, cs_final = fcssm(zen, azi, ptm, Temp, t_templ, t_temph, WT, Snow, Cloud, Shadow, dim, resolu, zc, cldpix, sdpix, snpix)
+    similar_num, cspt, shadow_cal, cs_final = fcssm(zen, azi, ptm, Temp, t_templ, t_temph, masks, None, None, None, dim, resolu, zc, cldpix, sdpix, snpix, n_jobs, search)
     et = datetime.datetime.now()
     logger.info('time taken for fcssm function: %s', str(et - st))
+    fcssm_time = et - st
 
-    c = gdal.GetDriverByName('ENVI').Create(cloud_fname, Cloud.shape[1], Cloud.shape[0], 1, gdal.GDT_Byte)
-    c.SetGeoTransform(geoT)
-    c.SetProjection(prj)
-    c.GetRasterBand(1).WriteArray(Cloud*255)
-    c = None
+    fmask_profile.step('write')
 
-    c = gdal.GetDriverByName('ENVI').Create(cloud_shadow_fname, shadow_cal.shape[1], shadow_cal.shape[0], 1, gdal.GDT_Byte)
-    c.SetGeoTransform(geoT)
-    c.SetProjection(prj)
-    c.GetRasterBand(1).WriteArray(shadow_cal*255)
-    c = None
+    cloud, shadow = output_bands(masks, shadow_cal)
 
-    c = gdal.GetDriverByName('ENVI').Create(fmask_fname, cs_final.shape[1], cs_final.shape[0], 1, gdal.GDT_Byte)
-    c.SetGeoTransform(geoT)
-    c.SetProjection(prj)
-    c.GetRasterBand(1).WriteArray(cs_final)
-    c = None
+    if multiband:
+        outputs = [write_bands(fmask_fname, [cloud, shadow, cs_final], geoT,
+                               prj, output,
+                               descriptions=['cloud', 'cloud shadow',
+                                             'fmask'])]
+    else:
+        outputs = [write_bands(cloud_fname, [cloud], geoT, prj, output),
+                   write_bands(cloud_shadow_fname, [shadow], geoT, prj,
+                               output),
+                   write_bands(fmask_fname, [cs_final], geoT, prj, output)]
 
     # TODO: Save water/snow masks?
 
+    return {'mtl': mtl,
+            'outputs': outputs,
+            'dim': [int(d) for d in dim],
+            'plcloud_seconds': plcloud_time.total_seconds(),
+            'fcssm_seconds': fcssm_time.total_seconds(),
+            'matched_clouds': int(numpy.count_nonzero(
+                numpy.asarray(similar_num) > 0)),
+            'cspt': float(cspt)}
+
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Computes the Fmask algorithm. Cloud, cloud shadow and Fmask combined (contains thecloud, cloud shadow and snow masks in a single array) are output to disk.')
-    parser.add_argument('--mtl', required=True, help='The full file path to the Landsat MTL file.')
+    parser.add_argument('--mtl', required=True, help='The full file path to the Landsat MTL file, or to the scene archive (.tar.gz, .tgz or .tar), which is read without extracting it.')
     parser.add_argument('--cldprob', type=float, default=22.5, help='The cloud probability for the scene. Default is 22.5 percent.')
     parser.add_argument('--cldpix', type=int, default=3, help='The number of pixels to be dilated for the cloud mask. Default is 3.')
     parser.add_argument('--sdpix', type=int, default=3, help='The number of pixels to be dilated for the cloud shadow mask. Default is 3.')
     parser.add_argument('--snpix', type=int, default=3, help='The number of pixels to be dilated for the snow mask. Default is 3.')
     parser.add_argument('--outdir', required=True, help='The full file path of the output directory that will contain the Fmask results.')
+    parser.add_argument('--tiled', action='store_true', help='Read and test the scene block by block to reduce peak memory use.')
+    parser.add_argument('--block_lines', type=int, default=512, help='The number of lines in each block when --tiled is used. Default is 512.')
+    parser.add_argument('--n_jobs', type=int, default=1, help='The number of processes used for cloud shadow matching, and of threads used for the mask dilations. Default is 1.')
+    parser.add_argument('--search', choices=SEARCHES, default='exhaustive', help='The cloud height search used for cloud shadow matching. Default is exhaustive.')
+    parser.add_argument('--fill', choices=FILLS, default='skimage', help='The flood fill of the cloud shadow probability: skimage, or uint16 (faster, on the reflectance quantized to 16 bit levels). Default is skimage.')
+    parser.add_argument('--output', choices=PROFILES, default='envi', help='The output profile: envi (uncompressed ENVI), gtiff (uncompressed GeoTIFF), deflate or zstd (tiled, compressed GeoTIFF) or cog (Cloud Optimized GeoTIFF with overviews). Default is envi.')
+    parser.add_argument('--multiband', action='store_true', help='Write the cloud, cloud shadow and Fmask rasters as the bands of a single file.')
+    parser.add_argument('--profile', default=None, help='The full file path of a JSON file to write the wall time and memory use of each processing stage to.')
+    parser.add_argument('--dtype', choices=TOA_DTYPES, default='float32', help='The type the reflectance and temperature are held in: float32, or int16 (half the memory, values rounded to 0.0001 reflectance and 0.01 degrees). Default is float32.')
 
     parsed_args = parser.parse_args()
     mtl         = parsed_args.mtl
@@ -1829,9 +2182,18 @@ if __name__ == '__main__':
     sdpix       = parsed_args.sdpix
     snpix       = parsed_args.snpix
     outdir      = parsed_args.outdir
+    tiled       = parsed_args.tiled
+    block_lines = parsed_args.block_lines
+    n_jobs      = parsed_args.n_jobs
+    search      = parsed_args.search
+    profile     = parsed_args.profile
+    fill        = parsed_args.fill
+    output      = parsed_args.output
+    multiband   = parsed_args.multiband
+    dtype       = parsed_args.dtype
 
     logger.setLevel(logging.INFO)
     logging.basicConfig()
-    run_FMask(mtl, outdir, cldprob, cldpix, sdpix, snpix)
+    run_FMask(mtl, outdir, cldprob, cldpix, sdpix, snpix, tiled, block_lines, n_jobs, search, profile, fill, output, multiband, dtype)
 
 
@@ -0,0 +1,150 @@
+# coding=utf-8
+"""
+Fast grayscale hole filling (imfill) for the shadow probability of plcloud.
+
+plcloud fills the regional minima of the Band 4 and Band 5 reflectance with
+imfill_skimage, a reconstruction by erosion from the image border done by
+skimage.morphology.reconstruction. That function works on float64 copies of
+the image interleaved with the marker and sorts them twice (argsort and
+rank_order), which dominates its run time and memory use.
+
+Two fill engines are available:
+
+'skimage'   the reference, imfill_skimage on the float image
+'uint16'    the reflectance is quantized to at most 65536 levels and filled
+            with the priority queue flood of skimage's compiled
+            reconstruction loop (the downhill filter of Robinson & Whelan).
+            The pixels are ordered with a counting sort of the 16 bit
+            levels (the COO to CSR conversion of scipy.sparse) and ranked with a lookup table of the levels present,
+            instead of the float sorts. Reconstruction commutes with the
+            (increasing) quantization, so the result is the reference fill
+            quantized: it differs from imfill_skimage by at most half a
+            quantization step, which is 0.5 (reflectance * 10000) unless
+            the value range of the image exceeds 65535.
+"""
+import logging
+
+import numpy
+from scipy import sparse
+from skimage import morphology
+
+# The compiled loop of skimage.morphology.reconstruction, renamed from
+#   _greyreconstruct to _grayreconstruct in later scikit-image releases
+try:
+    from skimage.morphology._greyreconstruct import reconstruction_loop
+except ImportError:
+    try:
+        from skimage.morphology._grayreconstruct import reconstruction_loop
+    except ImportError:
+        reconstruction_loop = None
+
+import fmask_profile
+
+logger = logging.getLogger('root.' + __name__)
+
+FILLS = ('skimage', 'uint16')
+
+LEVELS = 65536
+
+
+def quantize(img, levels=LEVELS):
+    """ Quantize img to uint16 levels
+
+    Returns:
+    (levels image, offset, step) with img ~= levels image * step + offset
+    """
+    offset = float(img.min())
+    value_range = float(img.max()) - offset
+    step = max(1.0, value_range / (levels - 1))
+    q = numpy.empty(img.shape, numpy.uint16)
+    numpy.rint((img - offset) / step, out=q, casting='unsafe')
+    return q, offset, step
+
+
+def fill_levels(q):
+    """ Fill the regional minima of the uint16 image q
+
+    Reconstruction by erosion of q from a marker equal to q on the image
+    border and to max(q) inside, i.e. imfill_skimage for integer levels.
+    """
+    nrow, ncol = q.shape
+    top = q.max()
+
+    seed = numpy.empty_like(q)
+    seed.fill(top)
+    seed[0, :] = q[0, :]
+    seed[-1, :] = q[-1, :]
+    seed[:, 0] = q[:, 0]
+    seed[:, -1] = q[:, -1]
+
+    if reconstruction_loop is None:
+        logger.warning('The reconstruction loop of this scikit-image release '
+                       'was not found: the uint16 fill falls back to the '
+                       'slower skimage.morphology.reconstruction')
+        return morphology.reconstruction(seed, q, method='erosion').astype(
+            numpy.uint16)
+
+    # Marker & mask padded with max(q) and interleaved along the first axis,
+    #   so that one ordering of the pixels serves both
+    images = numpy.empty((2, nrow + 2, ncol + 2), numpy.uint16)
+    images.fill(top)
+    images[0, 1:-1, 1:-1] = seed
+    images[1, 1:-1, 1:-1] = q
+    del seed
+    images = images.ravel()
+    image_stride = (nrow + 2) * (ncol + 2)
+
+    # Offsets of the 8-connected neighbours in the flattened array
+    nb_strides = numpy.array([dy * (ncol + 2) + dx
+                              for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                              if dy or dx], numpy.int32)
+
+    # Rank of each pixel among the levels present, highest level first
+    #   (what rank_order(-images) gives for an erosion)
+    present = numpy.bincount(images, minlength=LEVELS) > 0
+    ascending = numpy.cumsum(present) - 1
+    n_levels = ascending[-1] + 1
+    value_rank = (n_levels - 1 - ascending).astype(numpy.uint32)[images]
+    value_map = numpy.flatnonzero(present)[::-1].astype(numpy.uint16)
+    del present, ascending
+
+    # Pixels from lowest to highest level as a linked list. The column
+    #   indices of a (level, pixel) CSR matrix are the pixels grouped by
+    #   level: a counting sort, O(N) instead of the O(N log N) argsort
+    n = len(images)
+    pixels = numpy.arange(n, dtype=numpy.int32)
+    index_sorted = sparse.coo_matrix(
+        (numpy.ones(n, numpy.bool_), (images, pixels)),
+        shape=(LEVELS, n)).tocsr().indices
+    del pixels
+    del images
+    prev = numpy.empty(len(index_sorted), numpy.int32)
+    next = numpy.empty(len(index_sorted), numpy.int32)
+    prev[index_sorted[0]] = -1
+    prev[index_sorted[1:]] = index_sorted[:-1]
+    next[index_sorted[:-1]] = index_sorted[1:]
+    next[index_sorted[-1]] = -1
+    start = index_sorted[0]
+    del index_sorted
+
+    reconstruction_loop(value_rank, prev, next, nb_strides, start,
+                        image_stride)
+    del prev, next
+
+    filled = value_map[value_rank[:image_stride]]
+    return filled.reshape(nrow + 2, ncol + 2)[1:-1, 1:-1]
+
+
+@fmask_profile.stage('imfill_uint16')
+def imfill_uint16(img):
+    """ imfill_skimage on img quantized to 16 bit levels (see module doc)
+
+    Returns the filled image with the dtype of img.
+    """
+    q, offset, step = quantize(img)
+    filled = fill_levels(q)
+    del q
+    out = numpy.empty(img.shape, img.dtype)
+    numpy.multiply(filled, step, out=out, casting='unsafe')
+    out += offset
+    return out
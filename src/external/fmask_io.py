@@ -0,0 +1,366 @@
+# coding=utf-8
+"""
+Reading of Landsat scenes, extracted or inside archives.
+
+A scene can be given as its MTL file or as the archive it is distributed in
+(.tar.gz, .tgz or .tar). scene_mtl turns an archive into the path of its MTL
+file in GDAL's /vsitar/ virtual filesystem, and glob, exists and read_text
+work on such paths as on regular ones, so band discovery, MTL parsing and
+raster reads stream from the archive without extracting it. Gzipped files
+(e.g. a band stored as ``*_B1.TIF.gz``) are read through /vsigzip/.
+
+The band files are described by one in-memory VRT, one Float32 band per
+file, and the bands are read concurrently on a pool of threads. GDAL releases
+the GIL while it reads and decodes, so the files are read in parallel. Each
+band is read straight into a float32 array supplied by the caller (e.g. one
+plane of the band stack nd2toarbt returns), so neither a per band astype copy
+nor a stacking copy is made.
+
+MTL files are parsed by read_mtl, once per modification time. A scene
+catalog (see fmask_catalog) can register the parsed MTL and the band file
+names of a scene beforehand, so that neither the MTL nor the scene directory
+(or archive) is read again to process it.
+"""
+import fnmatch
+import glob as _glob
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
+
+from osgeo import gdal
+
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar')
+MTL_SUFFIX = '_MTL.txt'
+
+# GDAL virtual filesystems read by this module
+_VSI_PREFIXES = ('/vsitar/', '/vsigzip/')
+
+# Parsed MTL files, {path: (mtime, fields)}, and names of the files of
+#   registered scene directories, {directory: names}
+_mtls = {}
+_listings = {}
+
+
+def is_archive(path):
+    """ True if path is a scene archive (.tar.gz, .tgz or .tar) """
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_virtual(path):
+    """ True if path is in a GDAL virtual filesystem (/vsi...) """
+    return path.startswith('/vsi')
+
+
+def vsi_path(path):
+    """ GDAL path of path: /vsitar/ for archives, /vsigzip/ for .gz files """
+    if is_archive(path):
+        return '/vsitar/' + (path if is_virtual(path) else
+                             os.path.abspath(path))
+    if path.lower().endswith('.gz') and not path.startswith('/vsigzip/'):
+        return '/vsigzip/' + (path if is_virtual(path) else
+                              os.path.abspath(path))
+    return path
+
+
+def real_path(path):
+    """ The file on disk holding path (e.g. the archive of a /vsitar/ path) """
+    while is_virtual(path):
+        for prefix in _VSI_PREFIXES:
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+                break
+        else:
+            raise ValueError('Unsupported virtual filesystem: {p}'.format(
+                p=path))
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def listdir(directory):
+    """ Names of the entries of directory (which may be virtual) """
+    if directory in _listings:
+        return list(_listings[directory])
+    if is_virtual(directory):
+        names = gdal.ReadDir(directory) or []
+        return [n for n in names if n not in ('.', '..')]
+    return os.listdir(directory)
+
+
+def glob(pattern):
+    """ glob.glob that also matches files inside archives
+
+    Matching is done on the last path component only for virtual
+    directories. Gzipped files are returned as /vsigzip/ paths so that GDAL
+    can open them.
+    """
+    directory, name = os.path.split(pattern)
+    if directory in _listings:
+        # Registered scene; like glob.glob, * does not match hidden files
+        res = [os.path.join(directory, n) for n in _listings[directory]
+               if fnmatch.fnmatchcase(n, name) and
+               (not n.startswith('.') or name.startswith('.'))]
+    elif is_virtual(directory):
+        res = [os.path.join(directory, n) for n in sorted(listdir(directory))
+               if fnmatch.fnmatchcase(n, name)]
+    else:
+        res = _glob.glob(pattern)
+    return [vsi_path(r) if not is_archive(r) else r for r in res]
+
+
+def exists(path):
+    """ os.path.exists that also works for virtual paths """
+    if is_virtual(path):
+        return gdal.VSIStatL(path) is not None
+    return os.path.exists(path)
+
+
+def read_text(filename):
+    """ Contents of text file filename, which may be virtual """
+    if not is_virtual(filename):
+        with open(filename, 'r') as f:
+            return f.read()
+
+    stat = gdal.VSIStatL(filename)
+    if stat is None:
+        raise IOError('Cannot open {f}'.format(f=filename))
+    f = gdal.VSIFOpenL(filename, 'rb')
+    if f is None:
+        raise IOError('Cannot open {f}'.format(f=filename))
+    try:
+        data = gdal.VSIFReadL(1, stat.size, f)
+    finally:
+        gdal.VSIFCloseL(f)
+    if not isinstance(data, str):
+        data = data.decode('utf-8')
+    return data
+
+
+def parse_mtl(text):
+    """ Dict of the KEY = VALUE fields of MTL text (str values, unquoted) """
+    fields = {}
+    for line in text.splitlines():
+        values = line.split(' = ')
+        if len(values) != 2:
+            continue
+        fields[values[0].strip()] = values[1].strip().strip('"')
+    return fields
+
+
+def mtime(path):
+    """ Modification time of the file on disk holding path """
+    return os.path.getmtime(real_path(path))
+
+
+def read_mtl(filename):
+    """ Fields of MTL file filename (see parse_mtl), which may be virtual
+
+    A file is parsed once per modification time (of its archive for virtual
+    paths), or not at all if its scene was registered (see register_scene).
+    """
+    stamp = mtime(filename)
+    cached = _mtls.get(filename)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, parse_mtl(read_text(filename)))
+        _mtls[filename] = cached
+    return dict(cached[1])
+
+
+def register_scene(mtl, mtl_mtime, fields, files):
+    """ Make a scene known without reading its MTL file or directory
+
+    Arguments:
+    'mtl'           MTL file of the scene (as returned by scene_mtl)
+    'mtl_mtime'     modification time of the MTL file the fields are from
+                    (see mtime); read_mtl parses the file again if it changed
+    'fields'        MTL fields (see parse_mtl)
+    'files'         names of the files of the scene directory
+    """
+    _mtls[mtl] = (mtl_mtime, dict(fields))
+    _listings[os.path.dirname(mtl)] = sorted(files)
+
+
+def unregister_scene(mtl):
+    """ Forget what register_scene made known about a scene """
+    _mtls.pop(mtl, None)
+    _listings.pop(os.path.dirname(mtl), None)
+
+
+def find_mtls(paths):
+    """ Returns list of MTL files and scene archives from directories, MTL
+    files, scene archives and manifests
+
+    Arguments:
+    'paths'         list of directories (searched recursively), MTL files,
+                    scene archives or manifests (text files of MTL or archive
+                    paths, one per line; blank lines and lines starting with
+                    # are ignored, relative paths are relative to the
+                    manifest)
+    """
+    mtls = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                mtls.extend(os.path.join(root, f) for f in sorted(files)
+                            if f.endswith(MTL_SUFFIX) or is_archive(f))
+        elif path.endswith(MTL_SUFFIX) or is_archive(path):
+            mtls.append(path)
+        else:
+            base = os.path.dirname(path)
+            with open(path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        mtls.append(os.path.join(base, line))
+
+    # Remove duplicates, keeping the first occurrence. Scenes share an output
+    #   directory by scene id, so an extracted scene and its archive are one
+    seen = set()
+    unique = []
+    for mtl in mtls:
+        mtl = os.path.abspath(mtl)
+        if scene_id(mtl) not in seen:
+            seen.add(scene_id(mtl))
+            unique.append(mtl)
+    return unique
+
+
+def scene_id(mtl):
+    """ Scene identifier from MTL or archive filename (e.g.
+    LT50120312002300LGS01)
+    """
+    name = os.path.basename(mtl)
+    for suffix in (MTL_SUFFIX, ) + ARCHIVE_SUFFIXES:
+        if name.lower().endswith(suffix.lower()):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def scene_mtl(path):
+    """ MTL file of a scene given as MTL file or archive
+
+    For an archive the MTL file is returned as a /vsitar/ path; other paths
+    are returned unchanged.
+    """
+    if not is_archive(path):
+        return path
+    root = vsi_path(path)
+    for name in sorted(listdir(root)):
+        if name.endswith(MTL_SUFFIX):
+            return root + '/' + name
+    raise IOError('No {s} file in {p}'.format(s=MTL_SUFFIX, p=path))
+
+
+def cache_directory():
+    """ Per user directory of the pyfmask caches and catalog
+    ($XDG_CACHE_HOME/pyfmask or ~/.cache/pyfmask)
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pyfmask')
+
+
+def band_vrt(filenames):
+    """ VRT XML with band i + 1 being band 1 of filenames[i], as Float32
+
+    The VRT is a string, which gdal.Open accepts in place of a file name.
+    All files must be of the same size.
+
+    Arguments:
+    'filenames'     list of band files
+    """
+    size = None
+    bands = []
+    for i, fname in enumerate(filenames):
+        img = gdal.Open(fname)
+        if img is None:
+            raise IOError('Cannot open {f}'.format(f=fname))
+        if size is None:
+            size = (img.RasterXSize, img.RasterYSize)
+        elif size != (img.RasterXSize, img.RasterYSize):
+            raise ValueError('{f} is {x} x {y}, other bands are {s[0]} x '
+                             '{s[1]}'.format(f=fname, x=img.RasterXSize,
+                                             y=img.RasterYSize, s=size))
+        bands.append(
+            '  <VRTRasterBand dataType="Float32" band="{b}">\n'
+            '    <SimpleSource>\n'
+            '      <SourceFilename relativeToVRT="0">{f}</SourceFilename>\n'
+            '      <SourceBand>1</SourceBand>\n'
+            '    </SimpleSource>\n'
+            '  </VRTRasterBand>\n'.format(b=i + 1, f=escape(fname)))
+        img = None
+
+    return ('<VRTDataset rasterXSize="{x}" rasterYSize="{y}">\n'.format(
+        x=size[0], y=size[1]) + ''.join(bands) + '</VRTDataset>\n')
+
+
+def read_bands(filenames, out, window=None, n_threads=None, progress=None,
+               vrt=None):
+    """ Read band 1 of each file into the arrays of out in parallel
+
+    Arguments:
+    'filenames'     list of band files of the same size
+    'out'           list of C contiguous float32 (or uint16, the DN being
+                    integers) arrays, one per file, of the shape of the
+                    window (or of the files), or smaller to read
+                    the window decimated (GDAL reads from the overviews of
+                    the files when they have some)
+    'window'        optional (xoff, yoff, xsize, ysize) tuple to read
+    'n_threads'     number of reading threads (default: one per file, at
+                    most the number of CPUs)
+    'progress'      optional callable taking the fraction of the bands read,
+                    called from the calling thread
+    'vrt'           band_vrt(filenames) if already built (e.g. by a caller
+                    reading the files window by window)
+
+    Returns:
+    out
+    """
+    if len(filenames) != len(out):
+        raise ValueError('Need one output array per band file')
+    buf_ysize, buf_xsize = out[0].shape
+    for a in out:
+        if a.shape != (buf_ysize, buf_xsize) or \
+                a.dtype not in ('float32', 'uint16') or \
+                not a.flags['C_CONTIGUOUS']:
+            raise ValueError('Output arrays must be C contiguous float32 or '
+                             'uint16 arrays of shape {s}'.format(
+                                 s=(buf_ysize, buf_xsize)))
+
+    if vrt is None:
+        vrt = band_vrt(filenames)
+    if window is None:
+        img = gdal.Open(vrt)
+        xoff, yoff, xsize, ysize = 0, 0, img.RasterXSize, img.RasterYSize
+        img = None
+    else:
+        xoff, yoff, xsize, ysize = window
+
+    def read(i):
+        # Dataset handles must not be shared between threads
+        img = gdal.Open(vrt)
+        img.GetRasterBand(i + 1).ReadAsArray(xoff, yoff, xsize, ysize,
+                                             buf_xsize=buf_xsize,
+                                             buf_ysize=buf_ysize,
+                                             buf_obj=out[i])
+        img = None
+        return i
+
+    if n_threads is None:
+        n_threads = min(len(filenames), multiprocessing.cpu_count())
+    pool = ThreadPool(max(1, n_threads))
+    try:
+        for n, _ in enumerate(pool.imap_unordered(read,
+                                                  range(len(filenames)))):
+            if progress is not None:
+                progress(float(n + 1) / len(filenames))
+    finally:
+        pool.close()
+        pool.join()
+
+    return out
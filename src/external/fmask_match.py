@@ -0,0 +1,415 @@
+# coding=utf-8
+"""
+Batched cloud / cloud shadow matching for fcssm.
+
+fcssm used to loop over every cloud object and, for each object, over every
+candidate cloud base height, projecting the object and fancy-indexing four
+full-scene rasters once per height. ShadowMatcher evaluates a batch of
+candidate heights for one object as a single (heights x pixels) array
+operation, and can spread the cloud objects over a process pool. The cloud
+objects do not depend on each other: each one only reads the potential
+cloud/shadow layers and adds pixels to shadow_cal, so the order in which they
+are matched does not matter.
+
+Two height search strategies are available:
+
+'exhaustive'    the reference search of the original loop: every 2 pixel
+                height step is visited in order until the Tbuffer /
+                record_thresh stopping rule fires. The arithmetic is the
+                element-wise arithmetic of the original loop, so similar_num
+                and shadow_cal are bit for bit the same.
+'coarse'        a coarse sweep of every coarse_step-th height using a
+                decimated object footprint (at most coarse_pixels pixels),
+                stopped with the same Tbuffer / record_thresh rule, followed
+                by a full resolution refinement over the fine heights around
+                the recorded coarse height. The object is matched at the best
+                refined height if its similarity exceeds Tsimilar. This
+                visits roughly len(heights) / coarse_step + 2 * coarse_step
+                heights per object instead of len(heights).
+"""
+import math
+import multiprocessing
+import os
+
+import numpy
+import scipy.stats
+
+from fmask_bitmask import CLOUD, SHADOW, VALID
+
+SEARCHES = ('exhaustive', 'coarse')
+
+# Matcher of a pool worker, set by _init_worker; the forked workers share
+#   its rasters
+_matcher = None
+
+
+class ShadowMatcher(object):
+    """ Matches cloud objects to their shadows for one scene
+
+    Arguments:
+    'Temp'              brightness temperature (Celcius*100)
+    'segm_cloud'        labelled cloud objects
+    'masks'             packed mask raster (see fmask_bitmask) holding the
+                        scene footprint and the potential cloud and cloud
+                        shadow layers
+    't_templ'           0.175 percentile background temperature (low)
+    't_temph'           0.825 percentile background temperature (high)
+    'Sun_azi'           solar azimuth angle (degrees)
+    'sun_ele_rad'       solar elevation angle (radians)
+    'sun_tazi_rad'      solar azimuth angle - 90 (radians)
+    'sub_size'          pixel size (m)
+    'geometry'          (A, B, C, omiga_par, omiga_per) from viewgeo
+    'constants'         dict of Tsimilar, Tbuffer, num_pix, rate_elapse and
+                        rate_dlapse from fcssm
+    'max_elements'      largest (heights x pixels) batch evaluated at once
+    'search'            height search strategy, 'exhaustive' or 'coarse'
+    'coarse_step'       fine height steps per coarse step ('coarse' search)
+    'coarse_pixels'     maximum object pixels used by the coarse sweep
+    """
+
+    def __init__(self, Temp, segm_cloud, masks, t_templ, t_temph, Sun_azi,
+                 sun_ele_rad, sun_tazi_rad, sub_size, geometry, constants,
+                 max_elements=2 ** 22, search='exhaustive', coarse_step=8,
+                 coarse_pixels=1024):
+        if search not in SEARCHES:
+            raise ValueError('Unknown height search: %s' % search)
+        self.Temp = Temp
+        self.win_height, self.win_width = segm_cloud.shape
+        self.seg = segm_cloud.ravel()
+        # A shadow pixel matches if it is outside the scene, cloud or
+        # potential shadow. Pixels outside the scene are never part of a
+        # cloud object, so one lookup replaces boundary/cloud/shadow tests.
+        self.matchable = (
+            (masks & (VALID | CLOUD | SHADOW)) != VALID).ravel()
+        self.t_templ = t_templ
+        self.t_temph = t_temph
+        self.Sun_azi = Sun_azi
+        self.sun_ele_rad = sun_ele_rad
+        self.sun_tazi_rad = sun_tazi_rad
+        self.sub_size = sub_size
+        self.geometry = geometry
+        self.Tsimilar = constants['Tsimilar']
+        self.Tbuffer = constants['Tbuffer']
+        self.num_pix = constants['num_pix']
+        self.rate_elapse = constants['rate_elapse']
+        self.rate_dlapse = constants['rate_dlapse']
+        self.max_elements = max_elements
+        self.search = search
+        self.coarse_step = int(coarse_step)
+        self.coarse_pixels = int(coarse_pixels)
+
+        # move 2 pixel at a time
+        self.i_step = 2 * sub_size * math.tan(sun_ele_rad)
+
+    def heights(self, temp_obj):
+        """ Cloud height range & object temperature profile for one object
+
+        Returns (t_obj, temp_obj, Min_cl_height, Max_cl_height)
+        """
+        cld_area = temp_obj.size
+        # assume object is round r_obj is radium of object
+        r_obj = math.sqrt(cld_area / math.pi)
+        # number of inward pixes for correct temperature
+        pct_obj = math.pow(r_obj - self.num_pix, 2) / math.pow(r_obj, 2)
+        pct_obj = numpy.minimum(pct_obj, 1) # pct of edge pixel should be less than 1
+        t_obj = scipy.stats.mstats.mquantiles(temp_obj, pct_obj)
+
+        # put the edge of the cloud the same value as t_obj
+        temp_obj[temp_obj > t_obj] = t_obj
+
+        Max_cl_height = 12000 # Max cloud base height (m)
+        Min_cl_height = 200 # Min cloud base height (m)
+
+        # refine cloud height range (m)
+        Min_cl_height = max(Min_cl_height, 10 *(self.t_templ - 400 - t_obj) / self.rate_dlapse)
+        Max_cl_height = min(Max_cl_height, 10 *(self.t_temph + 400 - t_obj))
+        return t_obj, temp_obj, Min_cl_height, Max_cl_height
+
+    def project(self, rows, cols, h):
+        """ View angle corrected cloud position & shadow pixel offsets
+
+        h may be (pixels,) or (heights, pixels); returns (x, y, i_xy) with
+        the same shape.
+        """
+        A, B, C, omiga_par, omiga_per = self.geometry
+        x, y = mat_truecloud(cols, rows, h, A, B, C, omiga_par, omiga_per)
+        # shadow moved distance (pixel)
+        i_xy = h / (self.sub_size * math.tan(self.sun_ele_rad))
+        return x, y, i_xy
+
+    def shift(self, x, y, i_xy):
+        """ Shadow (row, col) for a projected cloud, as uint32 like fcssm """
+        if self.Sun_azi < 180:
+            col = numpy.round(x - i_xy * math.cos(self.sun_tazi_rad))
+            row = numpy.round(y - i_xy * math.sin(self.sun_tazi_rad))
+        else:
+            col = numpy.round(x + i_xy * math.cos(self.sun_tazi_rad))
+            row = numpy.round(y + i_xy * math.sin(self.sun_tazi_rad))
+        return row.astype('uint32'), col.astype('uint32')
+
+    def similarity(self, label, rows, cols, h):
+        """ Matched fraction of the shadow for a batch of heights
+
+        Returns (thresh_match, x, y) where thresh_match has one value per
+        row of h.
+        """
+        x, y, i_xy = self.project(rows, cols, h)
+        tmp_i, tmp_j = self.shift(x, y, i_xy)
+
+        # the id that is out of the image
+        out_id = (tmp_i >= self.win_height) | (tmp_j >= self.win_width)
+        out_all = out_id.sum(axis=-1)
+
+        flat = tmp_i.astype(numpy.intp) * self.win_width + tmp_j
+        flat[out_id] = 0
+        other = (self.seg[flat] != label) & ~out_id
+
+        # the id that is matched (exclude original cloud)
+        matched_all = (other & self.matchable[flat]).sum(axis=-1) + out_all
+        # the id that is the total pixel (exclude original cloud)
+        total_all = other.sum(axis=-1) + out_all
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            thresh_match = matched_all.astype(numpy.float32) / total_all
+        return thresh_match, x, y
+
+    def match(self, label, rows, cols):
+        """ Search the cloud height for one object
+
+        Returns (record_thresh, shadow pixel flat indices) for a matched
+        object, or None.
+        """
+        temp_obj = self.Temp[(rows, cols)]
+        if temp_obj.dtype.kind != 'f':
+            # int16 temperature (see nd2toarbt), the profile is float
+            temp_obj = temp_obj.astype(numpy.float32)
+        t_obj, temp_obj, Min_cl_height, Max_cl_height = self.heights(temp_obj)
+        base_hs = numpy.arange(Min_cl_height, Max_cl_height, self.i_step)
+        if not base_hs.size:
+            return None
+        # calculate cloud DEM with initial base height
+        dem = 10 * (t_obj - temp_obj) / self.rate_elapse
+
+        if self.search == 'coarse':
+            return self._search_coarse(label, rows, cols, dem, base_hs,
+                                       Max_cl_height - self.i_step)
+        return self._search_exhaustive(label, rows, cols, dem, base_hs,
+                                       Max_cl_height - self.i_step)
+
+    def _search_exhaustive(self, label, rows, cols, dem, base_hs, last):
+        """ Reference search: visit each height until the match stops """
+        # initialize height and similarity info
+        record_h = 0.0
+        record_thresh = 0.0
+
+        # Heights are evaluated in growing batches; most objects stop early
+        batch = 8
+        start = 0
+        while start < base_hs.size:
+            batch = min(batch, max(1, self.max_elements // max(1, rows.size)))
+            bh = base_hs[start:start + batch]
+            h = dem[numpy.newaxis, :] + bh[:, numpy.newaxis]
+            thresh, x, y = self.similarity(label, rows, cols, h)
+
+            for k, base_h in enumerate(bh):
+                thresh_match = thresh[k]
+                if (thresh_match >= (self.Tbuffer * record_thresh)) and (base_h < last) and (record_thresh < 0.95):
+                    if thresh_match > record_thresh:
+                        record_thresh = thresh_match
+                        record_h = h[k]
+                elif record_thresh > self.Tsimilar:
+                    return record_thresh, self.shadow(x[k], y[k], record_h)
+                else:
+                    record_thresh = 0.0
+
+            start += bh.size
+            batch *= 2
+        return None
+
+    def _thresholds(self, label, rows, cols, dem, base_hs):
+        """ Similarity at every height in base_hs, in batches """
+        batch = max(1, self.max_elements // max(1, rows.size))
+        thresh = [self.similarity(label, rows, cols,
+                                  dem[numpy.newaxis, :] +
+                                  bh[:, numpy.newaxis])[0]
+                  for bh in (base_hs[i:i + batch]
+                             for i in range(0, base_hs.size, batch))]
+        return numpy.concatenate(thresh)
+
+    def _search_coarse(self, label, rows, cols, dem, base_hs, last):
+        """ Coarse sweep on a decimated footprint, then a local fine search """
+        step = self.coarse_step
+        sub = slice(None, None, max(1, -(-rows.size // self.coarse_pixels)))
+        coarse = self._thresholds(label, rows[sub], cols[sub], dem[sub],
+                                  base_hs[::step])
+        best = _first_peak(coarse, base_hs[::step], last, self.Tbuffer,
+                           self.Tsimilar)
+        if best is None:
+            return None
+
+        # refine over the fine heights either side of the best coarse height
+        fine_hs = base_hs[max(0, (best - 1) * step):(best + 1) * step + 1]
+        thresh = self._thresholds(label, rows, cols, dem, fine_hs)
+        if not numpy.isfinite(thresh).any():
+            return None
+        k = int(numpy.nanargmax(thresh))
+        if thresh[k] > self.Tsimilar:
+            h = dem + fine_hs[k]
+            x, y, i_xy = self.project(rows, cols, h)
+            return thresh[k], self.shadow(x, y, h)
+        return None
+
+    def shadow(self, x, y, record_h):
+        """ Flat indices of the matched shadow of an object """
+        i_vir = record_h / (self.sub_size * math.tan(self.sun_ele_rad))
+        tmp_srow, tmp_scol = self.shift(x, y, i_vir)
+
+        # put data within range
+        tmp_srow[tmp_srow >= self.win_height] = self.win_height - 1
+        tmp_scol[tmp_scol >= self.win_width] = self.win_width - 1
+        return tmp_srow.astype(numpy.intp) * self.win_width + tmp_scol
+
+    def run(self, objects, num, shadow_cal, value=1, n_jobs=1,
+            progress=None):
+        """ Match all cloud objects
+
+        Arguments:
+        'objects'       iterable of (label, rows, cols)
+        'num'           number of cloud objects (labels are 1 ... num)
+        'shadow_cal'    uint8 matched shadow layer, updated in place
+        'value'         bit set in shadow_cal at the matched shadow pixels
+                        (e.g. fmask_bitmask.MATCHED_SHADOW)
+        'n_jobs'        number of processes (1 matches in this process)
+        'progress'      optional callable taking (stage, fraction), called
+                        as objects are matched ('matching'); it may raise an
+                        exception to stop the matching
+
+        Returns similar_num, the match similarity of each object
+        """
+        similar_num = numpy.zeros(num) # cloud shadow match similarity (m)
+        shadow_flat = shadow_cal.reshape(-1)
+
+        # report roughly every percent of the objects
+        every = max(1, num // 100)
+        if progress is not None:
+            progress('matching', 0.0)
+
+        for done, (label, result) in enumerate(self._results(objects, n_jobs)):
+            if progress is not None and (done + 1) % every == 0:
+                progress('matching', (done + 1) / float(num))
+            if result is None:
+                continue
+            # -1 to account for the zero based index used by Python (MATLAB is 1 one based).
+            similar_num[label - 1] = result[0]
+            shadow_flat[result[1]] |= value
+
+        return similar_num
+
+    def _results(self, objects, n_jobs):
+        if n_jobs == 1 or not hasattr(os, 'fork'):
+            for label, rows, cols in objects:
+                yield label, self.match(label, rows, cols)
+            return
+
+        objects = list(objects)
+        chunks = [objects[i::n_jobs * 4] for i in range(n_jobs * 4)]
+        # The matcher is handed to the workers as they fork, not through a
+        #   global of this process, so concurrent matchers (e.g. in threads)
+        #   do not see each other's
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                    initargs=(self, ))
+        try:
+            for results in pool.imap_unordered(_match_chunk, chunks):
+                for label_result in results:
+                    yield label_result
+        finally:
+            pool.terminate()
+
+
+class SegmentTable(object):
+    """ Pixel coordinates of every object in a label image
+
+    The table is built in one pass: the labelled pixel indices are sorted by
+    label (stably, so each object keeps row-major order like regionprops'
+    Coordinates) and grouped with per-label offsets from a bincount. Objects
+    are slices of two contiguous row/col buffers.
+
+    Arguments:
+    'labels'    label image, 0 is background
+    'num'       highest label (defaults to labels.max())
+    """
+
+    def __init__(self, labels, num=None):
+        flat = labels.ravel()
+        idx = numpy.flatnonzero(flat)
+        lab = flat[idx]
+        if num is None:
+            num = int(lab.max()) if lab.size else 0
+        idx = idx[numpy.argsort(lab, kind='mergesort')]
+
+        self.num = num
+        self.area = numpy.bincount(lab, minlength=num + 1)[1:]
+        self.offsets = numpy.zeros(num + 1, dtype=numpy.intp)
+        numpy.cumsum(self.area, out=self.offsets[1:])
+        self.rows = idx // labels.shape[1]
+        self.cols = idx % labels.shape[1]
+
+    def __len__(self):
+        return self.num
+
+    def coordinates(self, label):
+        """ (rows, cols) of one object """
+        start, stop = self.offsets[label - 1], self.offsets[label]
+        return self.rows[start:stop], self.cols[start:stop]
+
+    def __iter__(self):
+        """ Yield (label, rows, cols) for each non-empty object """
+        for label in range(1, self.num + 1):
+            if self.area[label - 1]:
+                rows, cols = self.coordinates(label)
+                yield label, rows, cols
+
+
+def _first_peak(thresh, base_hs, last, Tbuffer, Tsimilar):
+    """ Index of the height recorded by the fcssm stopping rule, or None """
+    record = None
+    record_thresh = 0.0
+    for k, base_h in enumerate(base_hs):
+        thresh_match = thresh[k]
+        if (thresh_match >= (Tbuffer * record_thresh)) and (base_h < last) and (record_thresh < 0.95):
+            if thresh_match > record_thresh:
+                record_thresh = thresh_match
+                record = k
+        elif record_thresh > Tsimilar:
+            return record
+        else:
+            record_thresh = 0.0
+    return None
+
+
+def mat_truecloud(x, y, h, A, B, C, omiga_par, omiga_per):
+    # imput "x",j col
+    # imput "y",i row
+    # imput cloud height "h"
+    H = 705000 # average Landsat 7 height (m)
+    dist = (A * x + B * y + C) / math.sqrt(A * A + B * B) # from the cetral perpendicular (unit: pixel)
+    dist_par = dist / math.cos(omiga_per - omiga_par)
+    dist_move = dist_par * h / H # cloud move distance (m)
+    delt_x = dist_move * math.cos(omiga_par)
+    delt_y = dist_move * math.sin(omiga_par)
+
+    x_new = x + delt_x # new x, j
+    y_new = y + delt_y # new y, i
+
+    return (x_new, y_new)
+
+
+def _init_worker(matcher):
+    global _matcher
+    _matcher = matcher
+
+
+def _match_chunk(objects):
+    """ Pool worker - match a list of objects with the inherited matcher """
+    return [(label, _matcher.match(label, rows, cols))
+            for label, rows, cols in objects]
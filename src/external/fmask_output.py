@@ -0,0 +1,132 @@
+# coding=utf-8
+"""
+Writing of the Fmask rasters with selectable output profiles.
+
+'envi'      uncompressed ENVI, the original run_FMask output
+'gtiff'     uncompressed striped GeoTIFF, the original temp_raster output
+'deflate'   tiled (512 x 512) GeoTIFF, DEFLATE compressed
+'zstd'      tiled (512 x 512) GeoTIFF, ZSTD compressed (GDAL >= 2.3)
+'cog'       Cloud Optimized GeoTIFF: tiled, DEFLATE compressed, with
+            internal nearest neighbour overviews down to about 256 pixels
+
+Rasters are written block by block. A band may be given with a 256 entry
+lookup table, which is applied to one block at a time, so derived rasters
+(e.g. the cloud mask scaled to 0/255, or the classes of a packed mask raster,
+see fmask_bitmask) are never materialized at full size. The compressed
+profiles compress with all CPUs.
+"""
+import itertools
+
+import numpy
+from osgeo import gdal
+from osgeo import gdal_array
+
+PROFILES = ('envi', 'gtiff', 'deflate', 'zstd', 'cog')
+
+_TILED = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+          'NUM_THREADS=ALL_CPUS']
+
+# Driver and creation options of each profile ('cog' is written as a tiled
+#   GeoTIFF with overviews, then copied with COPY_SRC_OVERVIEWS)
+_CREATE = {'envi': ('ENVI', []),
+           'gtiff': ('GTiff', []),
+           'deflate': ('GTiff', _TILED + ['COMPRESS=DEFLATE']),
+           'zstd': ('GTiff', _TILED + ['COMPRESS=ZSTD']),
+           'cog': ('GTiff', ['TILED=YES', 'BLOCKXSIZE=512',
+                             'BLOCKYSIZE=512'])}
+_COG_COPY = _TILED + ['COMPRESS=DEFLATE', 'COPY_SRC_OVERVIEWS=YES']
+
+
+def extension(profile):
+    """ Filename extension of the rasters written with profile """
+    return '' if profile == 'envi' else '.tif'
+
+
+def overview_levels(shape, min_size=256):
+    """ Overview decimation factors until the raster is about min_size """
+    levels = []
+    factor = 2
+    while max(shape) // factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def _as_indices(block):
+    # Boolean masks index tables as 0/1, not as a selection
+    if block.dtype == numpy.bool_:
+        return block.view(numpy.uint8)
+    return block
+
+
+def write_bands(filename, bands, geo_transform, projection, profile='envi',
+                descriptions=None, block_lines=512, count=None):
+    """ Write bands to one raster of filename, block by block
+
+    Arguments:
+    'filename'          output filename (see extension)
+    'bands'             sequence of 2D arrays of the same shape, or of
+                        (array, table) pairs: the band written is
+                        table[array], table being a 256 entry lookup table
+                        (array is then uint8 or bool). With count, may be
+                        an iterator producing the bands one at a time
+    'geo_transform'     tuple of raster geotransform
+    'projection'        str of raster's projection
+    'profile'           one of PROFILES
+    'descriptions'      optional band descriptions
+    'block_lines'       number of lines written at once
+    'count'             number of bands, if bands is an iterator
+
+    Returns:
+    filename
+    """
+    if profile not in PROFILES:
+        raise ValueError('Unknown output profile {p}, use one of {c}'.format(
+            p=profile, c=', '.join(PROFILES)))
+    if count is None:
+        bands = list(bands)
+        count = len(bands)
+    bands = (b if isinstance(b, tuple) else (b, None) for b in bands)
+    first = next(bands)
+    bands = itertools.chain([first], bands)
+    nrow, ncol = first[0].shape
+    array, table = first
+    dtype = _as_indices(array[:0]).dtype if table is None else table.dtype
+
+    driver, options = _CREATE[profile]
+    path = filename + '.tmp.tif' if profile == 'cog' else filename
+    ds = gdal.GetDriverByName(driver).Create(
+        path, ncol, nrow, count,
+        gdal_array.NumericTypeCodeToGDALTypeCode(dtype.type), options)
+    if ds is None:
+        raise IOError('Cannot create {f}'.format(f=path))
+    ds.SetGeoTransform(geo_transform)
+    ds.SetProjection(projection)
+
+    for i, (array, table) in enumerate(bands):
+        band = ds.GetRasterBand(i + 1)
+        if descriptions is not None:
+            band.SetDescription(descriptions[i])
+        for start in range(0, nrow, block_lines):
+            block = _as_indices(array[start:start + block_lines])
+            if table is not None:
+                block = table[block]
+            band.WriteArray(block, 0, start)
+        band = None
+
+    if profile == 'cog':
+        # Overviews are built in the temporary GeoTIFF and copied in front
+        #   of the full resolution tiles
+        levels = overview_levels((nrow, ncol))
+        if levels:
+            ds.BuildOverviews('NEAREST', levels)
+        out = gdal.GetDriverByName('GTiff').CreateCopy(filename, ds, 0,
+                                                       _COG_COPY)
+        if out is None:
+            raise IOError('Cannot create {f}'.format(f=filename))
+        out = None
+        ds = None
+        gdal.GetDriverByName('GTiff').Delete(path)
+    ds = None
+
+    return filename
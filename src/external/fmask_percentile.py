@@ -0,0 +1,300 @@
+# coding=utf-8
+"""
+Streaming percentiles for the Fmask dynamic thresholds.
+
+plcloud used to compute its thresholds with
+``scipy.stats.scoreatpercentile(Temp[idlnd], ...)``, which copies every clear
+pixel out of the scene and sorts the copy. StreamingPercentile is instead fed
+chunks of values (e.g. one row stripe or tile at a time) in two passes:
+
+1. ``update`` accumulates a fixed-width histogram of the values. Accumulators
+   fed with different tiles can be combined with ``merge``.
+2. ``refine`` is fed the same values again and keeps only the distinct values
+   that fall into the one or two histogram bins holding the requested order
+   statistics.
+
+``result`` then returns exactly what scipy.stats.scoreatpercentile (default
+'fraction' interpolation) returns for the concatenated values, bit for bit.
+If the second pass is skipped, ``estimate`` interpolates within the histogram
+bins and is within one bin width (``StreamingPercentile.bin_width``) of the
+exact value.
+
+Memory use is bounded by ``max_bins`` histogram counts plus the number of
+distinct values inside the target bins. It does not depend on how many values
+are fed.
+"""
+import numpy
+
+import fmask_profile
+
+
+class StreamingPercentile(object):
+    """ Two-pass, mergeable percentile accumulator
+
+    Arguments:
+    'percentiles'       sequence of percentiles in [0, 100]
+    'bin_width'         initial histogram bin width in data units
+    'max_bins'          histogram size limit; bins are merged in pairs (the
+                        bin width doubles) whenever the data range needs more
+    """
+
+    def __init__(self, percentiles, bin_width=1.0, max_bins=65536):
+        self.percentiles = [float(p) for p in percentiles]
+        for p in self.percentiles:
+            if not (0 <= p <= 100):
+                raise ValueError('percentile must be in the range [0, 100]')
+        self._base_width = float(bin_width)
+        self.max_bins = int(max_bins)
+
+        # Histogram of finite values, bin k holds [k * width, (k + 1) * width)
+        self._shift = 0
+        self._lo = 0
+        self._counts = numpy.zeros(0, dtype=numpy.int64)
+        # Non-finite values sort as -inf < finite < inf < nan
+        self._n_neginf = 0
+        self._n_posinf = 0
+        self._n_nan = 0
+        self._dtype = None
+
+        # Second pass state
+        self._targets = None
+        self._values = {}
+
+    @property
+    def bin_width(self):
+        """ Current histogram bin width (the error bound of ``estimate``) """
+        return self._base_width * 2 ** self._shift
+
+    @property
+    def n(self):
+        """ Number of values fed to the first pass """
+        return (int(self._counts.sum()) + self._n_neginf +
+                self._n_posinf + self._n_nan)
+
+    def _bins(self, values):
+        """ Return (finite values, their histogram bin) """
+        finite = values[numpy.isfinite(values)]
+        bins = numpy.floor(finite / self._base_width).astype(numpy.int64)
+        if self._shift:
+            bins >>= self._shift
+        return finite, bins
+
+    def _coarsen(self):
+        """ Merge pairs of neighbouring bins, doubling the bin width """
+        old = numpy.arange(self._lo, self._lo + self._counts.size) >> 1
+        self._lo = int(old[0]) if old.size else self._lo >> 1
+        self._counts = numpy.bincount(old - self._lo, weights=self._counts)
+        self._counts = self._counts.astype(numpy.int64)
+        self._shift += 1
+
+    def _add_counts(self, lo, counts):
+        """ Add histogram counts starting at bin lo (at the current width) """
+        if not counts.size:
+            return
+        if not self._counts.size:
+            self._lo = lo
+            self._counts = counts.astype(numpy.int64)
+            return
+        new_lo = min(self._lo, lo)
+        new_hi = max(self._lo + self._counts.size, lo + counts.size)
+        merged = numpy.zeros(new_hi - new_lo, dtype=numpy.int64)
+        merged[self._lo - new_lo:self._lo - new_lo + self._counts.size] += \
+            self._counts
+        merged[lo - new_lo:lo - new_lo + counts.size] += counts
+        self._lo = new_lo
+        self._counts = merged
+
+    def update(self, values):
+        """ First pass: add a chunk of values to the histogram """
+        if self._targets is not None:
+            raise RuntimeError('update() called after start_refine()')
+        values = numpy.asarray(values).ravel()
+        if not values.size:
+            return
+        if self._dtype is None:
+            self._dtype = values.dtype
+        if values.dtype.kind == 'f':
+            self._n_neginf += int(numpy.sum(values == -numpy.inf))
+            self._n_posinf += int(numpy.sum(values == numpy.inf))
+            self._n_nan += int(numpy.sum(numpy.isnan(values)))
+
+        finite, bins = self._bins(values)
+        if not bins.size:
+            return
+        while True:
+            lo, hi = int(bins.min()), int(bins.max())
+            span_lo = min(lo, self._lo) if self._counts.size else lo
+            span_hi = (max(hi + 1, self._lo + self._counts.size)
+                       if self._counts.size else hi + 1)
+            if span_hi - span_lo <= self.max_bins:
+                break
+            self._coarsen()
+            bins >>= 1
+        self._add_counts(lo, numpy.bincount(bins - lo))
+
+    def merge(self, other):
+        """ Combine with an accumulator fed other chunks of the same data """
+        if self.percentiles != other.percentiles or \
+                self._base_width != other._base_width:
+            raise ValueError('Cannot merge accumulators with different '
+                             'percentiles or bin widths')
+        if (self._targets is None) != (other._targets is None):
+            raise ValueError('Cannot merge accumulators in different passes')
+
+        if self._targets is None:
+            counts, lo, shift = other._counts, other._lo, other._shift
+            while self._shift < shift:
+                self._coarsen()
+            if shift < self._shift and counts.size:
+                bins = numpy.arange(lo, lo + counts.size) >> \
+                    (self._shift - shift)
+                lo = int(bins[0])
+                counts = numpy.bincount(bins - lo, weights=counts).astype(
+                    numpy.int64)
+            self._add_counts(lo, counts)
+            self._n_neginf += other._n_neginf
+            self._n_posinf += other._n_posinf
+            self._n_nan += other._n_nan
+            if self._dtype is None:
+                self._dtype = other._dtype
+            while self._counts.size > self.max_bins:
+                self._coarsen()
+        else:
+            for b, (values, counts) in other._values.items():
+                self._add_values(b, values, counts)
+
+    def _ranks(self, per):
+        """ Order statistics needed for percentile per (as scipy does it) """
+        idx = per / 100. * (self.n - 1)
+        i = int(idx)
+        if i == idx:
+            return idx, [i]
+        return idx, [i, i + 1]
+
+    def _locate(self, rank):
+        """ Return ('bin', bin, rank within bin) or ('value', value) """
+        if rank < self._n_neginf:
+            return ('value', -numpy.inf)
+        rank -= self._n_neginf
+        n_finite = int(self._counts.sum())
+        if rank >= n_finite:
+            if rank - n_finite < self._n_posinf:
+                return ('value', numpy.inf)
+            return ('value', numpy.nan)
+        cum = numpy.cumsum(self._counts)
+        k = int(numpy.searchsorted(cum, rank, side='right'))
+        before = int(cum[k - 1]) if k > 0 else 0
+        return ('bin', self._lo + k, rank - before)
+
+    def estimate(self):
+        """ Percentiles from the histogram alone, within one bin width """
+        if self.n == 0:
+            return [numpy.nan for p in self.percentiles]
+        result = []
+        for per in self.percentiles:
+            idx, ranks = self._ranks(per)
+            values = []
+            for rank in ranks:
+                loc = self._locate(rank)
+                if loc[0] == 'value':
+                    values.append(loc[1])
+                    continue
+                b, r = loc[1], loc[2]
+                count = self._counts[b - self._lo]
+                values.append((b + (r + 0.5) / count) * self.bin_width)
+            if len(values) == 1:
+                result.append(values[0])
+            else:
+                i = ranks[0]
+                result.append(values[0] * (i + 1 - idx) +
+                              values[1] * (idx - i))
+        return result
+
+    def start_refine(self):
+        """ Finish the first pass and choose the bins kept by the second """
+        self._targets = set()
+        if self.n == 0:
+            return
+        for per in self.percentiles:
+            for rank in self._ranks(per)[1]:
+                loc = self._locate(rank)
+                if loc[0] == 'bin':
+                    self._targets.add(loc[1])
+
+    def _add_values(self, b, values, counts):
+        if b in self._values:
+            old_values, old_counts = self._values[b]
+            values = numpy.concatenate((old_values, values))
+            counts = numpy.concatenate((old_counts, counts))
+            values, inverse = numpy.unique(values, return_inverse=True)
+            counts = numpy.bincount(inverse, weights=counts).astype(
+                numpy.int64)
+        self._values[b] = (values, counts)
+
+    def refine(self, values):
+        """ Second pass: feed the same chunks of values again """
+        if self._targets is None:
+            self.start_refine()
+        if not self._targets:
+            return
+        values = numpy.asarray(values).ravel()
+        finite, bins = self._bins(values)
+        for b in self._targets:
+            inside = finite[bins == b]
+            if inside.size:
+                unique, counts = numpy.unique(inside, return_counts=True)
+                self._add_values(b, unique, counts)
+
+    def result(self):
+        """ Exact percentiles, identical to scipy.stats.scoreatpercentile """
+        if self._targets is None:
+            raise RuntimeError('result() needs the second pass (refine)')
+        if self.n == 0:
+            return [numpy.nan for p in self.percentiles]
+        dtype = self._dtype
+        result = []
+        for per in self.percentiles:
+            idx, ranks = self._ranks(per)
+            pair = numpy.empty(len(ranks), dtype=dtype)
+            for k, rank in enumerate(ranks):
+                loc = self._locate(rank)
+                if loc[0] == 'value':
+                    pair[k] = loc[1]
+                    continue
+                values, counts = self._values[loc[1]]
+                pos = numpy.searchsorted(numpy.cumsum(counts), loc[2],
+                                         side='right')
+                pair[k] = values[pos]
+            result.append(_interpolate(pair, idx, ranks[0]))
+        return result
+
+
+def _interpolate(pair, idx, i):
+    """ Same arithmetic as scipy.stats' _compute_qth_percentile """
+    if i == idx:
+        weights = numpy.array(1)
+        sumval = 1.0
+    else:
+        weights = numpy.array([(i + 1 - idx), (idx - i)], float)
+        sumval = weights.sum()
+    return numpy.add.reduce(pair * weights, axis=0) / sumval
+
+
+@fmask_profile.stage('masked_percentile')
+def masked_percentile(a, where, percentiles, bin_width=1.0, block_lines=512):
+    """ Exact scoreatpercentile(a[where], p) for each p in percentiles
+
+    The masked values are streamed in row blocks so a[where] is never copied
+    out as a whole. Returns NaN for each percentile if where is empty, like
+    scipy does.
+    """
+    est = StreamingPercentile(percentiles, bin_width=bin_width)
+    nrow = a.shape[0]
+    for start in range(0, nrow, block_lines):
+        rows = slice(start, start + block_lines)
+        est.update(a[rows][where[rows]])
+    est.start_refine()
+    for start in range(0, nrow, block_lines):
+        rows = slice(start, start + block_lines)
+        est.refine(a[rows][where[rows]])
+    return est.result()
@@ -0,0 +1,202 @@
+# coding=utf-8
+"""
+Per-stage timing and memory instrumentation for the Fmask pipeline.
+
+The pipeline functions mark their stages with ``stage`` (a context manager
+and function decorator), ``step`` (ends the previous step and starts the next
+one inside the enclosing stage, so a long function can be split up without
+re-indenting it) and ``note`` (records the size of arrays allocated by the
+current stage or step). All three do nothing unless a Profiler is active, so
+the instrumentation costs one global lookup per call when profiling is off.
+
+    with Profiler(scene=mtl) as profiler:
+        run_FMask(...)
+    profiler.write('fmask_profile.json')
+
+Each stage is recorded with its path (e.g. ``plcloud/spectral tests``), start
+offset and wall time, the resident set size (RSS) when it started and ended,
+the process' peak RSS when it ended and how much the stage raised that peak,
+and the bytes of the arrays noted in it. RSS is read from /proc and is None
+where that is not available.
+"""
+import functools
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Profiler receiving the stages (None when profiling is off)
+_active = None
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss():
+    """ Resident set size of this process in bytes (None if unknown) """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes (None if unknown) """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Stage(object):
+    """ A running stage: its record and its current step """
+
+    def __init__(self, profiler, path):
+        self.record = {'name': path,
+                       'start': time.time() - profiler.start,
+                       'rss_start': current_rss(),
+                       'arrays': {}}
+        self._peak_start = peak_rss()
+        self._time_start = time.time()
+        self.step = None
+
+    def finish(self):
+        record = self.record
+        record['seconds'] = time.time() - self._time_start
+        record['rss_end'] = current_rss()
+        record['peak_rss'] = peak_rss()
+        if record['peak_rss'] is not None:
+            record['peak_rss_increase'] = \
+                record['peak_rss'] - self._peak_start
+        return record
+
+
+class Profiler(object):
+    """ Collects stage records of the pipeline while active
+
+    Arguments:
+    'scene'         scene identifier stored with the records (e.g. MTL path)
+    """
+
+    def __init__(self, scene=None):
+        self.scene = scene
+        self.stages = []
+        self.start = None
+        self.seconds = None
+        self._stack = []
+
+    def __enter__(self):
+        global _active
+        self.start = time.time()
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        while self._stack:
+            self._pop()
+        self.seconds = time.time() - self.start
+        _active = self._previous
+        return False
+
+    def _path(self, name):
+        """ Path of a stage nested in the current stage or step """
+        if self._stack:
+            parent = self._stack[-1]
+            if parent.step is not None:
+                parent = parent.step
+            return parent.record['name'] + '/' + name
+        return name
+
+    def _push(self, name):
+        self._stack.append(_Stage(self, self._path(name)))
+
+    def _pop(self):
+        stage = self._stack.pop()
+        self._end_step(stage)
+        self.stages.append(stage.finish())
+
+    def _end_step(self, stage):
+        if stage.step is not None:
+            self.stages.append(stage.step.finish())
+            stage.step = None
+
+    def step(self, name):
+        """ End the current step and start step name in the current stage """
+        if not self._stack:
+            return
+        parent = self._stack[-1]
+        self._end_step(parent)
+        if name is not None:
+            parent.step = _Stage(self, self._path(name))
+
+    def note(self, arrays):
+        """ Record nbytes of arrays (dict name: array) in current step """
+        if not self._stack:
+            return
+        stage = self._stack[-1]
+        if stage.step is not None:
+            stage = stage.step
+        for name, array in arrays.items():
+            nbytes = getattr(array, 'nbytes', None)
+            if nbytes is not None:
+                stage.record['arrays'][name] = \
+                    stage.record['arrays'].get(name, 0) + int(nbytes)
+
+    def to_dict(self):
+        """ Records as a JSON serializable dict, stages in start order """
+        return {'scene': self.scene,
+                'seconds': self.seconds,
+                'peak_rss': peak_rss(),
+                'stages': sorted(self.stages, key=lambda s: s['start'])}
+
+    def write(self, filename):
+        """ Write records to filename as JSON """
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+
+class stage(object):
+    """ Profile a block (context manager) or function call (decorator) """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._profiler = _active
+        if self._profiler is not None:
+            self._profiler._push(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is not None:
+            self._profiler._pop()
+        return False
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def step(name):
+    """ End the current step and start the next one (None ends only) """
+    if _active is not None:
+        _active.step(name)
+
+
+def note(**arrays):
+    """ Record the size of arrays allocated in the current stage """
+    if _active is not None:
+        _active.note(arrays)
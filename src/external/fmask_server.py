@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Local Fmask scene server, shared by QGIS sessions and command line clients.
+
+Each client of FmaskResult or run_FMask reads and converts its own copy of a
+scene. The server keeps the scenes it is asked about loaded, as the cloud
+probabilities of plcloud_probs, and answers plcloud and fcssm requests with
+any parameters from them: a new cloud probability is only a threshold, new
+dilation buffers only a dilation (see the caches of fcssm_dilate), and a
+scene already loaded by one analyst is not read again for the next.
+
+Clients connect to a Unix socket, readable by its user only, and send one
+request per connection, a JSON object on one line, answered by one line of
+JSON. Clients only connect to a socket of their own user. The rasters of a response
+are written as .npy files to a shared memory directory (/dev/shm when there
+is one) and returned by path; Client loads and removes them, or returns the
+paths as handles to map with numpy.load(path, mmap_mode='r'). Client only
+accepts paths of that directory named as the server names them.
+
+Requests ('op'):
+
+'plcloud'           the packed plcloud masks (see fmask_bitmask) for
+                    'cldprob', as 'masks'
+'fcssm'             the final Fmask ('fmask') for 'cldprob', 'cldpix',
+                    'sdpix' and 'snpix', and optionally the dilated cloud
+                    shadow ('shadow_cal') and plcloud masks ('masks'), see
+                    'arrays'; the clouds are matched in the server process,
+                    as forking a pool from its request threads could
+                    deadlock
+'status'            the resident scenes and memory use
+'evict'             unload the scenes of 'mtl' (all scenes if not given)
+'shutdown'          stop the server
+
+A scene is given by 'mtl' (MTL file or scene archive) with optional 'scale'
+(preview decimation), 'window' (pixel window, processed with scene-wide
+baselines as in FmaskResult), 'dtype' (see nd2toarbt) and 'shadow_prob'
+(compute the potential cloud shadow, as run_FMask does, for plcloud and
+fcssm alike so that both give the results of FmaskResult). Buffers are in
+full resolution pixels.
+
+Scenes are admitted within a memory budget: a scene is estimated to need
+bytes_per_pixel per pixel while it loads, less for int16 (see
+fmask_batch.pixel_bytes), and the least recently used scenes are unloaded
+until it fits. A scene larger than the whole budget is refused. Requests on
+different scenes run concurrently.
+
+    python fmask_server.py serve --memory 32
+    python fmask_server.py fmask --mtl LT50120312002300LGS01_MTL.txt --outdir out --cldprob 17.5
+"""
+import argparse
+from collections import OrderedDict
+import getpass
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import traceback
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+import numpy
+
+from fmask_batch import BYTES_PER_PIXEL, pixel_bytes
+from fmask_cloud_masking_edit import (BASELINE_SCALE, TOA_DTYPES,
+                                      fcssm_dilate, fcssm_match, lndhdrread,
+                                      nd2toarbt, output_bands,
+                                      plcloud_baseline, plcloud_probs,
+                                      plcloud_threshold)
+from fmask_io import scene_mtl
+from fmask_output import PROFILES, extension, write_bands
+
+logger = logging.getLogger('root.' + __name__)
+
+# One server per user, in the user's runtime directory, or in a directory
+#   of the user in the temporary directory
+SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+        tempfile.gettempdir(), 'pyfmask-{u}'.format(u=getpass.getuser())),
+    'pyfmask_server.sock')
+
+# Prefix of the rasters of the responses
+_PREFIX = 'pyfmask_'
+
+# Cloud/shadow matches kept per scene, for the latest cloud probabilities
+MATCHES = 4
+
+
+class ServerError(Exception):
+    """ Error answered by the server """
+    pass
+
+
+def shm_directory():
+    """ Directory the rasters of the responses are written to """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def check_owner(path):
+    """ Raise IOError unless path belongs to the current user """
+    if hasattr(os, 'getuid') and os.stat(path).st_uid != os.getuid():
+        raise IOError('{p} is not owned by the current user'.format(p=path))
+
+
+def _text(value):
+    # JSON strings are unicode in Python 2; paths are given to GDAL as str
+    return value if isinstance(value, str) else value.encode('utf-8')
+
+
+def _nbytes(value):
+    """ Bytes of the arrays in value (nested dicts, tuples and lists) """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class _Scene(object):
+    """ A loaded scene: its cloud probabilities & recent matches """
+
+    def __init__(self, key, nbytes):
+        # (mtl, scale, window, dtype, shadow_prob)
+        self.key = key
+        self.nbytes = nbytes
+        # Requests on the scene are run one at a time
+        self.lock = threading.Lock()
+        self.state = None
+        # cldprob -> (fcssm_match state, dilation cache), latest last
+        self.matches = OrderedDict()
+
+
+class FmaskServer(object):
+    """ Scenes loaded for clients, within a memory budget
+
+    Arguments:
+    'memory'            memory budget in bytes shared by the loaded scenes
+    'bytes_per_pixel'   estimated peak bytes per pixel of a float32 scene
+                        loading
+    'n_jobs'            threads of the dilations
+    'shm_dir'           directory the rasters of the responses are written to
+                        (default: /dev/shm if it exists)
+    """
+
+    def __init__(self, memory, bytes_per_pixel=BYTES_PER_PIXEL, n_jobs=1,
+                 shm_dir=None):
+        self.memory = memory
+        self.bytes_per_pixel = bytes_per_pixel
+        self.n_jobs = n_jobs
+        self.shm_dir = shm_dir or shm_directory()
+        # key -> _Scene, least recently used first
+        self.scenes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def estimate(self, mtl, scale=1, window=None, dtype='float32'):
+        """ Estimated peak memory in bytes of loading a scene """
+        if window is not None:
+            lines, samples = window[3], window[2]
+        else:
+            lines, samples = lndhdrread(mtl)[6] # ijdim_ref
+        pixels = (-(-int(lines) // scale)) * (-(-int(samples) // scale))
+        return pixels * pixel_bytes(self.bytes_per_pixel, dtype)
+
+    def used(self):
+        """ Bytes used by the loaded scenes """
+        return sum(scene.nbytes for scene in self.scenes.values())
+
+    def scene(self, mtl, scale=1, window=None, dtype='float32',
+              shadow_prob=False):
+        """ The _Scene of a request, admitted within the memory budget """
+        key = (mtl, scale, window, dtype, shadow_prob)
+        with self.lock:
+            if key in self.scenes:
+                # Most recently used last
+                scene = self.scenes.pop(key)
+                self.scenes[key] = scene
+                return scene
+
+            estimate = self.estimate(mtl, scale, window, dtype)
+            if estimate > self.memory:
+                raise ServerError(
+                    '{m} needs an estimated {e} bytes, more than the memory '
+                    'budget of the server ({b} bytes)'.format(
+                        m=mtl, e=estimate, b=self.memory))
+            self._evict(self.memory - estimate)
+            scene = _Scene(key, estimate)
+            self.scenes[key] = scene
+            return scene
+
+    def _evict(self, max_bytes):
+        # Unload the least recently used scenes until max_bytes are used
+        for key in list(self.scenes):
+            if self.used() <= max_bytes:
+                break
+            logger.info('Unloading {k}'.format(k=key))
+            del self.scenes[key]
+
+    def evict(self, mtl=None):
+        """ Unload the scenes of mtl, or all scenes """
+        with self.lock:
+            for key in list(self.scenes):
+                if mtl is None or key[0] == mtl:
+                    del self.scenes[key]
+
+    def _probs(self, scene):
+        # Cloud probabilities of the scene, computed when first needed
+        if scene.state is None:
+            mtl, scale, window, dtype, shadow_prob = scene.key
+            baseline = None
+            if window is not None:
+                # As FmaskResult.get_baseline
+                whole = self.scene(mtl, max(scale, BASELINE_SCALE), None,
+                                   dtype, True)
+                with whole.lock:
+                    baseline = plcloud_baseline(self._probs(whole))
+            logger.info('Loading {k}'.format(k=scene.key))
+            scene.state = plcloud_probs(
+                nd2toarbt(mtl, window=window, scale=scale, dtype=dtype),
+                num_Lst=lndhdrread(mtl)[14], shadow_prob=shadow_prob,
+                baseline=baseline)
+            scene.nbytes = _nbytes(scene.state)
+        return scene.state
+
+    def _match(self, scene, cldprob):
+        # Cloud/shadow match & dilation cache of a cloud probability
+        if cldprob in scene.matches:
+            match = scene.matches.pop(cldprob)
+        else:
+            zen, azi, ptm, Temp, t_templ, t_temph, masks, _, _, _, dim, _, \
+                resolu, zc, _, _ = plcloud_threshold(
+                    self._probs(scene), cldprob, packed=True)
+            # In this process: a pool forked while other requests run could
+            #   inherit the locks they hold
+            match = (fcssm_match(zen, azi, ptm, Temp, t_templ, t_temph,
+                                 masks, None, None, None, dim, resolu, zc,
+                                 n_jobs=1), {})
+            while len(scene.matches) >= MATCHES:
+                scene.matches.popitem(last=False)
+        scene.matches[cldprob] = match
+        return match
+
+    def share(self, array):
+        """ Write array to the shared memory directory, return its path """
+        fd, path = tempfile.mkstemp(prefix=_PREFIX, suffix='.npy',
+                                    dir=self.shm_dir)
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        return path
+
+    def plcloud(self, scene, cldprob=22.5):
+        """ Response of a plcloud request """
+        with scene.lock:
+            result = plcloud_threshold(self._probs(scene), cldprob,
+                                       packed=True)
+            scene.nbytes = _nbytes(scene.state) + _nbytes(scene.matches)
+        return {'masks': self.share(result[6]),
+                'dim': [int(d) for d in result[10]],
+                'geoT': list(result[14]), 'prj': result[15]}
+
+    def fcssm(self, scene, cldprob=22.5, cldpix=3, sdpix=3, snpix=3,
+              arrays=('fmask', )):
+        """ Response of a fcssm request """
+        scale = scene.key[1]
+        if scale != 1:
+            # Buffers are in full resolution pixels
+            cldpix, sdpix, snpix = [int(round(float(b) / scale))
+                                    for b in (cldpix, sdpix, snpix)]
+        with scene.lock:
+            match, dilated = self._match(scene, cldprob)
+            similar_num, cspt, shadow_cal, fmask = fcssm_dilate(
+                match, cldpix, sdpix, snpix, cache=dilated,
+                n_jobs=self.n_jobs)
+            state = scene.state
+            scene.nbytes = _nbytes(scene.state) + _nbytes(scene.matches)
+        layers = {'fmask': fmask, 'shadow_cal': shadow_cal,
+                  'masks': match['masks']}
+        response = dict((name, self.share(layers[name])) for name in arrays)
+        response.update({
+            'cspt': float(cspt),
+            'matched_clouds': int(numpy.count_nonzero(
+                numpy.asarray(similar_num) > 0)),
+            'dim': [int(d) for d in state['dim']],
+            'geoT': list(state['geoT']), 'prj': state['prj']})
+        return response
+
+    def status(self):
+        """ Response of a status request """
+        with self.lock:
+            scenes = [{'mtl': key[0], 'scale': key[1], 'window': key[2],
+                       'dtype': key[3], 'shadow_prob': key[4],
+                       'bytes': scene.nbytes,
+                       'loaded': scene.state is not None,
+                       'matches': list(scene.matches)}
+                      for key, scene in self.scenes.items()]
+            return {'scenes': scenes, 'used': self.used(),
+                    'memory': self.memory}
+
+    def handle(self, request):
+        """ Response (dict) of a request (dict), see module doc """
+        op = request['op']
+        if op == 'status':
+            return self.status()
+        if op == 'evict':
+            mtl = request.get('mtl')
+            self.evict(None if mtl is None else scene_mtl(_text(mtl)))
+            return {}
+
+        window = request.get('window')
+        dtype = request.get('dtype', 'float32')
+        if dtype not in TOA_DTYPES:
+            raise ValueError('Unknown dtype {d}'.format(d=dtype))
+        scene = self.scene(scene_mtl(_text(request['mtl'])),
+                           int(request.get('scale', 1)),
+                           None if window is None else tuple(window), dtype,
+                           bool(request.get('shadow_prob', False)))
+        if op == 'plcloud':
+            return self.plcloud(scene, request.get('cldprob', 22.5))
+        if op == 'fcssm':
+            return self.fcssm(scene, request.get('cldprob', 22.5),
+                              request.get('cldpix', 3),
+                              request.get('sdpix', 3),
+                              request.get('snpix', 3),
+                              request.get('arrays', ['fmask']))
+        raise ValueError('Unknown request {o}'.format(o=op))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """ Answers the request of one connection """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            if request.get('op') == 'shutdown':
+                # shutdown waits for serve_forever, so not in this request
+                threading.Thread(target=self.server.shutdown).start()
+                response = {}
+            else:
+                response = self.server.fmask.handle(request)
+            response['status'] = 'ok'
+        except Exception:
+            logger.exception('Request failed')
+            response = {'status': 'error', 'error': traceback.format_exc()}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(fmask_server, socket_path=SOCKET):
+    """ Answer requests to fmask_server on socket_path until shutdown """
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    if os.path.exists(socket_path):
+        # Not a server of this user, whose clients would not connect to it
+        check_owner(socket_path)
+        try:
+            Client(socket_path).status()
+        except (IOError, OSError, ServerError):
+            # Left over by a server that did not exit cleanly
+            os.remove(socket_path)
+        else:
+            raise IOError('A server is already running on {s}'.format(
+                s=socket_path))
+
+    server = _UnixServer(socket_path, _Handler, bind_and_activate=False)
+    try:
+        server.server_bind()
+        # Only the user can connect, set before the socket listens
+        os.chmod(socket_path, 0o600)
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    server.fmask = fmask_server
+    logger.info('Serving on {s}'.format(s=socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+class Client(object):
+    """ Client of a running server
+
+    Arguments:
+    'socket_path'       the Unix socket of the server
+    'shm_dir'           directory the server writes the rasters of the
+                        responses to (default: /dev/shm if it exists)
+    """
+
+    def __init__(self, socket_path=SOCKET, shm_dir=None):
+        self.socket_path = socket_path
+        self.shm_dir = shm_dir or shm_directory()
+
+    def request(self, request):
+        """ Send a request (dict), return the response (dict) """
+        # The files of a server of another user are not loaded or removed
+        check_owner(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            f = sock.makefile('rb')
+            line = f.readline()
+            f.close()
+        finally:
+            sock.close()
+        if not line:
+            raise ServerError('No response from {s}'.format(
+                s=self.socket_path))
+        response = json.loads(line.decode('utf-8'))
+        if response.pop('status') != 'ok':
+            raise ServerError(response['error'])
+        return response
+
+    def _scene_request(self, op, mtl, scale, window, dtype, **kwargs):
+        request = {'op': op, 'mtl': os.path.abspath(mtl)
+                   if os.path.exists(mtl) else mtl,
+                   'scale': scale,
+                   'window': None if window is None else list(window),
+                   'dtype': dtype}
+        request.update(kwargs)
+        return self.request(request)
+
+    def _arrays(self, response, names, handles):
+        for name in names:
+            path = os.path.realpath(response[name])
+            if os.path.dirname(path) != os.path.realpath(self.shm_dir) or \
+                    not os.path.basename(path).startswith(_PREFIX):
+                raise ServerError('Unexpected path {p} in the response'.
+                                  format(p=response[name]))
+            if not handles:
+                response[name] = numpy.load(path, allow_pickle=False)
+                os.remove(path)
+        return response
+
+    def plcloud(self, mtl, cldprob=22.5, shadow_prob=False, scale=1,
+                window=None, dtype='float32', handles=False):
+        """ Packed plcloud masks of a scene
+
+        Arguments:
+        'mtl'           MTL file or scene archive
+        'cldprob'       cloud probability
+        'shadow_prob'   compute the potential cloud shadow
+        'scale'         preview decimation factor
+        'window'        optional (xoff, yoff, xsize, ysize) pixel window
+        'dtype'         type of the reflectance and BT (see nd2toarbt)
+        'handles'       return the path of the masks rather than the array,
+                        to map with numpy.load(path, mmap_mode='r',
+                        allow_pickle=False); the caller removes it
+
+        Returns:
+        dict of the 'masks', the dimension ('dim'), 'geoT' and 'prj'
+        """
+        response = self._scene_request('plcloud', mtl, scale, window, dtype,
+                                       cldprob=cldprob,
+                                       shadow_prob=shadow_prob)
+        return self._arrays(response, ['masks'], handles)
+
+    def fcssm(self, mtl, cldprob=22.5, cldpix=3, sdpix=3, snpix=3,
+              shadow_prob=False, scale=1, window=None, dtype='float32',
+              arrays=('fmask', ), handles=False):
+        """ Final Fmask of a scene
+
+        Arguments are those of plcloud, plus:
+        'cldpix'        cloud dilation (full resolution pixels)
+        'sdpix'         cloud shadow dilation (full resolution pixels)
+        'snpix'         snow dilation (full resolution pixels)
+        'arrays'        rasters returned: 'fmask', 'shadow_cal' and/or
+                        'masks' (packed plcloud masks)
+
+        Returns:
+        dict of the arrays, the cloud and cloud shadow percentage ('cspt'),
+        the number of matched clouds ('matched_clouds'), 'dim', 'geoT' and
+        'prj'
+        """
+        response = self._scene_request('fcssm', mtl, scale, window, dtype,
+                                       cldprob=cldprob, cldpix=cldpix,
+                                       sdpix=sdpix, snpix=snpix,
+                                       shadow_prob=shadow_prob,
+                                       arrays=list(arrays))
+        return self._arrays(response, arrays, handles)
+
+    def status(self):
+        """ Resident scenes and memory use of the server """
+        return self.request({'op': 'status'})
+
+    def evict(self, mtl=None):
+        """ Unload the scenes of mtl, or all scenes """
+        request = {'op': 'evict'}
+        if mtl is not None:
+            request['mtl'] = os.path.abspath(mtl) \
+                if os.path.exists(mtl) else mtl
+        return self.request(request)
+
+    def shutdown(self):
+        """ Stop the server """
+        return self.request({'op': 'shutdown'})
+
+
+def run_client(client, mtl, outdir, cldprob=22.5, cldpix=3, sdpix=3, snpix=3,
+               dtype='float32', output='envi'):
+    """ Write the cloud, cloud shadow and Fmask rasters of run_FMask,
+    computed by the server
+
+    Returns:
+    dict of the outputs, 'cspt' and 'matched_clouds'
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    # As run by run_FMask
+    result = client.fcssm(mtl, cldprob, cldpix, sdpix, snpix,
+                          shadow_prob=True, dtype=dtype,
+                          arrays=('masks', 'shadow_cal', 'fmask'))
+    geoT, prj = tuple(result['geoT']), _text(result['prj'])
+
+    cloud, shadow = output_bands(result['masks'], result['shadow_cal'])
+    ext = extension(output)
+    outputs = [write_bands(os.path.join(outdir, name + ext), [band], geoT,
+                           prj, output)
+               for name, band in (('fmask_cloud', cloud),
+                                  ('fmask_cloud_shadow', shadow),
+                                  ('fmask', result['fmask']))]
+    return {'mtl': mtl, 'outputs': outputs, 'cspt': result['cspt'],
+            'matched_clouds': result['matched_clouds']}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Runs or queries a local Fmask server, which keeps scenes loaded for the QGIS plugin and command line clients.')
+    parser.add_argument('--socket', default=SOCKET, help='The Unix socket of the server. Default is %s.' % SOCKET)
+    parser.add_argument('--shm_dir', default=None, help='The directory the server writes the rasters of the responses to. Default is /dev/shm if it exists.')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help='Run the server until it is shut down.')
+    serve_parser.add_argument('--memory', type=float, default=16, help='The memory budget shared by the loaded scenes, in GiB. Default is 16.')
+    serve_parser.add_argument('--bytes_per_pixel', type=int, default=BYTES_PER_PIXEL, help='The estimated peak memory use per pixel of a float32 scene while it loads, in bytes; int16 scenes are estimated to need less. Default is %d.' % BYTES_PER_PIXEL)
+    serve_parser.add_argument('--n_jobs', type=int, default=1, help='The number of threads used for the mask dilations; clouds and shadows are matched in the server process. Default is 1.')
+    fmask_parser = commands.add_parser('fmask', help='Write the cloud, cloud shadow and Fmask rasters of a scene, computed by the server, as run_FMask does.')
+    fmask_parser.add_argument('--mtl', required=True, help='The full file path to the Landsat MTL file, or to the scene archive (.tar.gz, .tgz or .tar).')
+    fmask_parser.add_argument('--outdir', required=True, help='The full file path of the output directory that will contain the Fmask results.')
+    fmask_parser.add_argument('--cldprob', type=float, default=22.5, help='The cloud probability for the scene. Default is 22.5 percent.')
+    fmask_parser.add_argument('--cldpix', type=int, default=3, help='The number of pixels to be dilated for the cloud mask. Default is 3.')
+    fmask_parser.add_argument('--sdpix', type=int, default=3, help='The number of pixels to be dilated for the cloud shadow mask. Default is 3.')
+    fmask_parser.add_argument('--snpix', type=int, default=3, help='The number of pixels to be dilated for the snow mask. Default is 3.')
+    fmask_parser.add_argument('--dtype', choices=TOA_DTYPES, default='float32', help='The type the server holds the reflectance and temperature in. Default is float32.')
+    fmask_parser.add_argument('--output', choices=PROFILES, default='envi', help='The output profile: envi (uncompressed ENVI), gtiff (uncompressed GeoTIFF), deflate or zstd (tiled, compressed GeoTIFF) or cog (Cloud Optimized GeoTIFF with overviews). Default is envi.')
+    commands.add_parser('status', help='Print the loaded scenes and memory use of the server.')
+    evict_parser = commands.add_parser('evict', help='Unload scenes from the server.')
+    evict_parser.add_argument('--mtl', default=None, help='The scene to unload. Default is all scenes.')
+    commands.add_parser('shutdown', help='Stop the server.')
+
+    parsed_args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    logging.basicConfig()
+
+    if parsed_args.command == 'serve':
+        serve(FmaskServer(int(parsed_args.memory * 1024 ** 3),
+                          bytes_per_pixel=parsed_args.bytes_per_pixel,
+                          n_jobs=parsed_args.n_jobs,
+                          shm_dir=parsed_args.shm_dir),
+              parsed_args.socket)
+    else:
+        client = Client(parsed_args.socket, parsed_args.shm_dir)
+        if parsed_args.command == 'fmask':
+            response = run_client(client, parsed_args.mtl,
+                                  parsed_args.outdir,
+                                  cldprob=parsed_args.cldprob,
+                                  cldpix=parsed_args.cldpix,
+                                  sdpix=parsed_args.sdpix,
+                                  snpix=parsed_args.snpix,
+                                  dtype=parsed_args.dtype,
+                                  output=parsed_args.output)
+        elif parsed_args.command == 'status':
+            response = client.status()
+        elif parsed_args.command == 'evict':
+            response = client.evict(parsed_args.mtl)
+        else:
+            response = client.shutdown()
+        print(json.dumps(response, indent=2, sort_keys=True))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Run Fmask over a grid of cloud probabilities and dilation buffers in one pass.
+
+Tuning a scene by rerunning run_FMask for each parameter combination repeats
+the work that does not depend on the parameters. The sweep loads the scene and
+computes the cloud probabilities (plcloud_probs) once, thresholds and matches
+the cloud shadows (plcloud_threshold, fcssm_match) once per cloud probability,
+and dilates each cloud, cloud shadow and snow layer once per buffer value
+(see the cache of fcssm_dilate). Each combination is then one lookup.
+
+The Fmask of every combination is written as one band of a single raster,
+``fmask_sweep`` in the output directory, in the order cldprob, cldpix, sdpix,
+snpix (the last varying fastest), the band description giving the parameters.
+The bands are written as they are computed, so only one Fmask is held in
+memory at a time. The summaries of the combinations are written to
+``fmask_sweep.json``, one record per band:
+
+'band'              band of the combination in the raster (from 1)
+'cldprob', 'cldpix', 'sdpix', 'snpix'
+                    the parameters
+'cspt'              the cloud and cloud shadow percentage recorded by fcssm
+'fractions'         fraction of the valid pixels of each Fmask class (clear,
+                    water, shadow, snow, cloud)
+'similar_num'       the cloud objects (objects), those matched to a shadow
+                    (matched) and the mean and maximum similarity of the
+                    matches
+'seconds'           the time of the dilation and summary
+
+The per cloud probability time of the thresholding and matching is recorded in
+``fmask_sweep.json`` too.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+
+import numpy
+
+import fmask_bitmask
+from fmask_cloud_masking_edit import (fcssm_dilate, fcssm_match, lndhdrread,
+                                      nd2toarbt, plcloud_probs,
+                                      plcloud_threshold)
+from fmask_imfill import FILLS
+from fmask_io import scene_mtl
+from fmask_match import SEARCHES
+from fmask_output import PROFILES, extension, write_bands
+
+logger = logging.getLogger('root.' + __name__)
+
+SWEEP_FNAME = 'fmask_sweep'
+SUMMARY_FNAME = 'fmask_sweep.json'
+
+# Fmask classes reported in the summaries, by value
+CLASSES = (('clear', 0), ('water', 1), ('shadow', 2), ('snow', 3),
+           ('cloud', 4))
+
+
+def combinations(cldprobs, cldpixs, sdpixs, snpixs):
+    """ Parameter combinations of the sweep, in band order """
+    return list(itertools.product(cldprobs, cldpixs, sdpixs, snpixs))
+
+
+def summarize(similar_num, cspt, cs_final):
+    """ Summary record of one combination (see module doc) """
+    hist = numpy.bincount(cs_final.ravel(), minlength=256)
+    valid = float(hist.sum() - hist[fmask_bitmask.FMASK_OUTSIDE])
+    fractions = dict((name, float(hist[value] / valid) if valid else 0.0)
+                     for name, value in CLASSES)
+
+    # similar_num is -1 if fcssm_match found no cloud objects to match
+    similar_num = numpy.atleast_1d(numpy.asarray(similar_num, 'float64'))
+    if similar_num.size == 1 and similar_num[0] == -1:
+        similar_num = similar_num[:0]
+    matched = similar_num[similar_num > 0]
+    return {'cspt': float(cspt),
+            'fractions': fractions,
+            'similar_num': {
+                'objects': int(similar_num.size),
+                'matched': int(matched.size),
+                'mean': float(matched.mean()) if matched.size else None,
+                'max': float(matched.max()) if matched.size else None}}
+
+
+def sweep(mtl, outdir, cldprobs, cldpixs, sdpixs, snpixs, n_jobs=1,
+          search='exhaustive', fill='skimage', output='deflate'):
+    """ Run Fmask on a scene for every parameter combination
+
+    Arguments:
+    'mtl'               MTL file or scene archive of the scene
+    'outdir'            output directory of the raster and summaries
+    'cldprobs'          sequence of cloud probabilities
+    'cldpixs'           sequence of cloud dilations (pixels)
+    'sdpixs'            sequence of cloud shadow dilations (pixels)
+    'snpixs'            sequence of snow dilations (pixels)
+    'n_jobs'            processes used for the cloud shadow matching and
+                        threads used for the dilations
+    'search'            cloud height search (see fmask_match)
+    'fill'              flood fill of the shadow probability (see fmask_imfill)
+    'output'            output profile of the raster (see fmask_output)
+
+    Returns:
+    dict of the outputs, the scene and the summary records
+    """
+    mtl = scene_mtl(mtl)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    sweep_fname = os.path.join(outdir, SWEEP_FNAME + extension(output))
+    summary_fname = os.path.join(outdir, SUMMARY_FNAME)
+
+    params = combinations(cldprobs, cldpixs, sdpixs, snpixs)
+    Lnum = lndhdrread(mtl)[14]
+
+    st = time.time()
+    state = plcloud_probs(nd2toarbt(mtl), num_Lst=Lnum, shadow_prob=True,
+                          fill=fill)
+    probs_seconds = time.time() - st
+
+    records = []
+    matches = []
+
+    def fmasks():
+        # The Fmask of each combination, matching once per cloud probability
+        for cldprob, group in itertools.groupby(params, lambda p: p[0]):
+            st = time.time()
+            zen, azi, ptm, Temp, t_templ, t_temph, masks, _, _, _, dim, _, \
+                resolu, zc, _, _ = plcloud_threshold(state, cldprob,
+                                                     packed=True)
+            match = fcssm_match(zen, azi, ptm, Temp, t_templ, t_temph, masks,
+                                None, None, None, dim, resolu, zc,
+                                n_jobs=n_jobs, search=search)
+            matches.append({'cldprob': cldprob,
+                            'seconds': time.time() - st})
+            logger.info('Matched cloud shadows for cldprob={c}'.format(
+                c=cldprob))
+
+            dilated = {}
+            for _, cldpix, sdpix, snpix in group:
+                st = time.time()
+                similar_num, cspt, _, cs_final = fcssm_dilate(
+                    match, cldpix, sdpix, snpix, cache=dilated,
+                    n_jobs=n_jobs)
+                record = summarize(similar_num, cspt, cs_final)
+                record.update({'band': len(records) + 1, 'cldprob': cldprob,
+                               'cldpix': cldpix, 'sdpix': sdpix,
+                               'snpix': snpix,
+                               'seconds': time.time() - st})
+                records.append(record)
+                yield cs_final
+            del match, dilated
+
+    descriptions = ['cldprob={0} cldpix={1} sdpix={2} snpix={3}'.format(*p)
+                    for p in params]
+    write_bands(sweep_fname, fmasks(), state['geoT'], state['prj'], output,
+                descriptions=descriptions, count=len(params))
+
+    summary = {'mtl': mtl,
+               'outputs': [sweep_fname, summary_fname],
+               'dim': [int(d) for d in state['dim']],
+               'probs_seconds': probs_seconds,
+               'matches': matches,
+               'combinations': records}
+    with open(summary_fname, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    return summary
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Computes the Fmask algorithm for every combination of the given cloud probabilities and dilation buffers, loading the scene and computing the cloud probabilities once. The Fmask of each combination is written as one band of a single raster, and the cloud, shadow and snow fractions of each combination to a JSON summary.')
+    parser.add_argument('--mtl', required=True, help='The full file path to the Landsat MTL file, or to the scene archive (.tar.gz, .tgz or .tar), which is read without extracting it.')
+    parser.add_argument('--outdir', required=True, help='The output directory of the raster (%s) and the summary (%s).' % (SWEEP_FNAME, SUMMARY_FNAME))
+    parser.add_argument('--cldprob', type=float, nargs='+', default=[22.5], help='The cloud probabilities. Default is 22.5 percent.')
+    parser.add_argument('--cldpix', type=int, nargs='+', default=[3], help='The numbers of pixels to be dilated for the cloud mask. Default is 3.')
+    parser.add_argument('--sdpix', type=int, nargs='+', default=[3], help='The numbers of pixels to be dilated for the cloud shadow mask. Default is 3.')
+    parser.add_argument('--snpix', type=int, nargs='+', default=[3], help='The numbers of pixels to be dilated for the snow mask. Default is 3.')
+    parser.add_argument('--n_jobs', type=int, default=1, help='The number of processes used for cloud shadow matching, and of threads used for the mask dilations. Default is 1.')
+    parser.add_argument('--search', choices=SEARCHES, default='exhaustive', help='The cloud height search used for cloud shadow matching. Default is exhaustive.')
+    parser.add_argument('--fill', choices=FILLS, default='skimage', help='The flood fill of the cloud shadow probability: skimage, or uint16 (faster, on the reflectance quantized to 16 bit levels). Default is skimage.')
+    parser.add_argument('--output', choices=PROFILES, default='deflate', help='The output profile: envi (uncompressed ENVI), gtiff (uncompressed GeoTIFF), deflate or zstd (tiled, compressed GeoTIFF) or cog (Cloud Optimized GeoTIFF with overviews). Default is deflate.')
+
+    parsed_args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    logging.basicConfig()
+
+    sweep(parsed_args.mtl, parsed_args.outdir,
+          parsed_args.cldprob, parsed_args.cldpix, parsed_args.sdpix,
+          parsed_args.snpix, n_jobs=parsed_args.n_jobs,
+          search=parsed_args.search, fill=parsed_args.fill,
+          output=parsed_args.output)
@@ -25,17 +25,24 @@ from collections import OrderedDict
 from functools import partial
 import logging
 import os
+import sqlite3
 
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 
 import qgis.core
+import qgis.gui
 
 from osgeo import gdal
 
 from ui_config_fmask import Ui_config_fmask
 
+import fmask_bitmask
+import fmask_catalog
+import fmask_server
+import pyfmask_cache
 import pyfmask_utils
+import pyfmask_worker
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                             level=logging.DEBUG,
@@ -58,8 +65,28 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
     enable_calc_plcloud = False
     enable_calc_match = False
     enable_save = False
+    # A worker is running on fmask_result: the inputs changing it and the
+    #   calculation buttons are disabled, whatever the switches above
+    busy = False
 
     cache_toa_bt = False
+    # Preview decimation factors: plcloud & fcssm run on the scene decimated
+    #   by the selected factor, saving runs at full resolution
+    preview_scales = OrderedDict((
+        ('Full resolution', 1),
+        ('1/2', 2),
+        ('1/4', 4),
+        ('1/8', 8)
+    ))
+    preview_scale = 1
+    # Disk budget of persistent TOA/BT cache (bytes, 0 to disable)
+    cache_disk_bytes = 8 * 1024 ** 3
+    # Type the TOA/BT data is held & cached in ('float32' or 'int16', half
+    #   the memory & disk, see nd2toarbt)
+    toa_dtype = 'float32'
+    # Unix socket of a running fmask_server the scenes are processed by,
+    #   shared with other sessions (None to process them in QGIS)
+    server_socket = None
 
     # Fmask parameters
     cloud_prob = 22.5  # cloud_prob is scaled by 10 for slider
@@ -68,6 +95,7 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
     snow_dilate = 3
 
     mtl_file = ''
+    save_file = ''
     mtl = {}
 
     # Temporary result files
@@ -109,6 +137,28 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
 
         self.fmask_result = None
 
+        # Background computation (FmaskWorker, QThread) & progress widgets
+        self.worker = None
+        self.worker_thread = None
+        self.progress_message = None
+        self.progress_bar = None
+
+        # Persistent TOA/BT cache shared by all loaded scenes
+        self.disk_cache = None
+        if self.cache_disk_bytes > 0:
+            try:
+                self.disk_cache = pyfmask_cache.ToaBtCache(
+                    max_bytes=self.cache_disk_bytes)
+            except (IOError, OSError):
+                logger.warning('Could not create TOA/BT disk cache')
+
+        # Scene catalog, so reloaded scenes are not parsed & listed again
+        self.catalog = None
+        try:
+            self.catalog = fmask_catalog.Catalog()
+        except Exception:
+            logger.warning('Could not open scene catalog')
+
     def setup_gui(self):
         # Setup MTL input
         # Init text
@@ -121,13 +171,22 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
         self.get_available_drivers()
         # Populate QComboBox with available drivers
         self.cbox_formats.addItems(self.drivers)
-        # Save button
+        # Output filename & save button
+        self.edit_save.setText(self.save_file)
+        self.button_save.clicked.connect(self.find_save)
         self.but_save.clicked.connect(self.save_result)
 
         # Cache TOA reflectance and brightness temp result
         self.cbox_cache_toa_bt.setChecked(self.cache_toa_bt)
         self.cbox_cache_toa_bt.stateChanged.connect(self.cache_on_off)
 
+        # Preview scale
+        self.cbox_preview_scale.addItems(list(self.preview_scales.keys()))
+        self.cbox_preview_scale.setCurrentIndex(
+            list(self.preview_scales.values()).index(self.preview_scale))
+        self.cbox_preview_scale.currentIndexChanged.connect(
+            self.update_preview_scale)
+
         # Configure cloud probability slider, label and button
         # Set to cloud_prob * 10 initially since it value comes from slider
         #    which is scaled by 10
@@ -185,22 +244,42 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
 
     @QtCore.pyqtSlot()
     def find_MTL(self):
-        """ Open QFileDialog to find a MTL file """
+        """ Open QFileDialog to find a MTL file or scene archive """
         # Open QFileDialog
         mtl = str(QtGui.QFileDialog.
                   getOpenFileName(self,
                                   'Locate MTL file',
                                   self.mtl_file if os.path.isdir(self.mtl_file)
                                   else os.path.dirname(self.mtl_file),
-                                  '*MTL.txt'))
+                                  'MTL files (*MTL.txt);;'
+                                  'Landsat archives (*.tar.gz *.tgz *.tar)'))
         if mtl != '':
             self.edit_MTL.setText(mtl)
 
+    @QtCore.pyqtSlot()
+    def find_save(self):
+        """ Open QFileDialog to choose the output filename """
+        filename = str(QtGui.QFileDialog.
+                       getSaveFileName(self,
+                                       'Save Fmask result',
+                                       self.save_file or
+                                       os.path.dirname(self.mtl_file)))
+        if filename != '':
+            self.save_file = filename
+            self.edit_save.setText(filename)
+
     @QtCore.pyqtSlot()
     def load_MTL(self):
-        """ Load MTL file currently specified in QLineEdit """
+        """ Load MTL file (or scene archive) specified in QLineEdit """
         mtl = str(self.edit_MTL.text())
 
+        # Add or update scene in catalog (logs & skips unreadable scenes)
+        if self.catalog is not None:
+            try:
+                self.catalog.index([mtl])
+            except sqlite3.Error:
+                logger.warning('Could not update scene catalog')
+
         try:
             self.mtl = pyfmask_utils.mtl2dict(mtl)
         except:
@@ -214,7 +293,12 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
         self.mtl_file = mtl
         self.update_table_MTL()
 
-        self.fmask_result = pyfmask_utils.FmaskResult(self.mtl_file)
+        self.fmask_result = pyfmask_utils.FmaskResult(
+            self.mtl_file, disk_cache=self.disk_cache,
+            scale=self.preview_scale, catalog=self.catalog,
+            dtype=self.toa_dtype,
+            server=fmask_server.Client(self.server_socket)
+            if self.server_socket else None)
 
         self.allow_results(cache=True, plcloud=True)
 
@@ -237,6 +321,48 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
 
         self.allow_results(match=False, save=False)
 
+    @QtCore.pyqtSlot(int)
+    def update_preview_scale(self, index):
+        """ Update preview decimation factor when changed in combobox """
+        self.preview_scale = list(self.preview_scales.values())[index]
+        logger.info('Changed preview scale to {s}'.format(
+            s=self.cbox_preview_scale.itemText(index)))
+
+        # Results have to be recomputed at the new scale
+        if self.fmask_result is not None:
+            self.fmask_result.scale = self.preview_scale
+        self.allow_results(match=False, save=False)
+
+    def preview_name(self, name):
+        """ Layer name, marked as a preview if decimated or of an extent """
+        notes = []
+        if self.fmask_result.scale != 1:
+            notes.append('1/{s}'.format(s=self.fmask_result.scale))
+        if self.fmask_result.window is not None:
+            notes.append('extent')
+        if not notes:
+            return name
+        return '{n} (preview {p})'.format(n=name, p=', '.join(notes))
+
+    def canvas_window(self):
+        """ Pixel window of the scene visible in the map canvas """
+        canvas = self.iface.mapCanvas()
+        extent = canvas.extent()
+
+        # Canvas extent in the projection of the scene
+        geoT, prj, size = self.fmask_result.scene_info()
+        scene_crs = qgis.core.QgsCoordinateReferenceSystem()
+        scene_crs.createFromWkt(prj)
+        canvas_crs = canvas.mapRenderer().destinationCrs()
+        if canvas_crs != scene_crs:
+            extent = qgis.core.QgsCoordinateTransform(
+                canvas_crs, scene_crs).transformBoundingBox(extent)
+
+        return pyfmask_utils.extent_window(
+            (extent.xMinimum(), extent.yMinimum(),
+             extent.xMaximum(), extent.yMaximum()),
+            geoT, size)
+
     @QtCore.pyqtSlot(int)
     def update_dilation(self, value, variable):
         """ Update dilation parameter when changed in spinbox """
@@ -353,6 +479,8 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
 #            if _driver.GetMetadata().get('DCAP_CREATE') == 'YES':
 #                self.drivers.append(_driver.GetDescription())
         self.drivers = ['GTiff', 'ENVI']
+        # Output profile of fmask_output for each driver
+        self.driver_profiles = {'GTiff': 'gtiff', 'ENVI': 'envi'}
 
     def allow_results(self, cache=None, plcloud=None, match=None, save=None):
         """ Disable calculation buttons """
@@ -365,33 +493,132 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
         if save is not None:
             self.enable_save = save
 
-        self.cbox_cache_toa_bt.setEnabled(self.enable_cache_toa_bt)
-        self.but_calc_plcloud.setEnabled(self.enable_calc_plcloud)
-        self.but_calc_match.setEnabled(self.enable_calc_match)
-        self.but_save.setEnabled(self.enable_save)
+        idle = not self.busy
+        self.but_load_mtl.setEnabled(idle)
+        self.cbox_preview_scale.setEnabled(idle)
+        self.cbox_cache_toa_bt.setEnabled(self.enable_cache_toa_bt and idle)
+        self.but_calc_plcloud.setEnabled(self.enable_calc_plcloud and idle)
+        self.but_calc_match.setEnabled(self.enable_calc_match and idle)
+        self.but_save.setEnabled(self.enable_save and idle)
+
+    def run_worker(self, title, on_finished, func, *args, **kwargs):
+        """ Run func in a background thread, showing progress in QGIS
+
+        Calculation buttons, and the inputs changing fmask_result (scene,
+        preview scale, caching), are disabled until func finishes, fails or
+        is cancelled; changes of the parameters meanwhile still update which
+        buttons are enabled afterwards. on_finished is called with func's
+        result on success.
+        """
+        self.busy = True
+        self.allow_results()
+
+        # Progress bar & cancel button in QGIS message bar
+        bar = self.iface.messageBar()
+        self.progress_message = bar.createMessage('Fmask', title)
+        self.progress_bar = QtGui.QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setAlignment(QtCore.Qt.AlignLeft |
+                                       QtCore.Qt.AlignVCenter)
+        cancel = QtGui.QPushButton('Cancel')
+        cancel.clicked.connect(self.cancel_worker)
+        self.progress_message.layout().addWidget(self.progress_bar)
+        self.progress_message.layout().addWidget(cancel)
+        bar.pushWidget(self.progress_message, qgis.gui.QgsMessageBar.INFO)
+
+        self.worker = pyfmask_worker.FmaskWorker(func, *args, **kwargs)
+        self.worker.progress.connect(partial(self.update_progress, title))
+        self.worker.finished.connect(partial(self.worker_finished,
+                                             on_finished))
+        self.worker.cancelled.connect(self.worker_cancelled)
+        self.worker.error.connect(self.worker_error)
+        self.worker, self.worker_thread = \
+            pyfmask_worker.start_worker(self.worker)
+
+    def update_progress(self, title, stage, fraction):
+        """ Show worker progress in message bar """
+        self.progress_message.setText('{t} ({s})'.format(t=title, s=stage))
+        self.progress_bar.setValue(int(fraction * 100))
+
+    @QtCore.pyqtSlot()
+    def cancel_worker(self):
+        """ Cancel running computation at its next progress report """
+        # Called directly (not queued to the busy worker thread)
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def stop_worker(self):
+        """ Clean up after worker finishes and restore buttons """
+        if self.worker_thread is not None:
+            self.worker_thread.quit()
+            self.worker_thread.wait()
+        self.worker = None
+        self.worker_thread = None
+
+        if self.progress_message is not None:
+            self.iface.messageBar().popWidget(self.progress_message)
+        self.progress_message = None
+        self.progress_bar = None
+
+        self.busy = False
+        self.allow_results()
+
+    def worker_finished(self, on_finished, result):
+        """ Finish up computation on GUI thread """
+        self.stop_worker()
+        on_finished()
+
+    def worker_cancelled(self):
+        self.stop_worker()
+        self.iface.messageBar().pushMessage(
+            'Fmask', 'Calculation cancelled',
+            level=qgis.gui.QgsMessageBar.INFO, duration=3)
+
+    def worker_error(self, message):
+        self.stop_worker()
+        self.iface.messageBar().pushMessage(
+            'Fmask', 'Calculation failed: {m}'.format(m=message),
+            level=qgis.gui.QgsMessageBar.CRITICAL)
 
     @QtCore.pyqtSlot()
     def do_plcloud(self, cloud_prob=None):
-        """ Perform cloud masking and add result to QGIS """
+        """ Perform cloud masking in background and add result to QGIS """
         if cloud_prob is None:
             cloud_prob = self.cloud_prob
         # Find the Landsat spacecraft number
         landsat_num = int(self.mtl['SPACECRAFT_ID'][-1])
 
+        # Whole scene, or the part of it in the map canvas
+        window = None
+        if self.cbox_extent.isChecked():
+            window = self.canvas_window()
+            if window is None:
+                self.iface.messageBar().pushMessage(
+                    'Fmask', 'The map extent does not overlap the scene',
+                    level=qgis.gui.QgsMessageBar.WARNING, duration=3)
+                return
+        self.fmask_result.window = window
+
         logger.info('Running plcloud with cloud probability {p}'.
               format(p=cloud_prob))
 
-        self.fmask_result.get_plcloud(cloud_prob)
+        self.run_worker('Calculating cloud probability',
+                        partial(self.plcloud_finished, cloud_prob),
+                        self.fmask_result.get_plcloud, cloud_prob)
 
+    def plcloud_finished(self, cloud_prob):
+        """ Add cloud probability mask to QGIS """
         # TODO if PREVIEW RESULT button: (else keep in memory)
         self.plcloud_filename, _tempfile = \
-            pyfmask_utils.temp_raster(self.fmask_result.plcloud_mask * 4,
+            pyfmask_utils.temp_raster(self.fmask_result.plcloud_mask,
                                       self.fmask_result.geoT,
-                                      self.fmask_result.prj)
+                                      self.fmask_result.prj,
+                                      codes=((fmask_bitmask.CLOUD, 4), ))
         self.temp_files.append(_tempfile)
 
         # Open as raster layer
-        rlayer_name = 'Cloud probability {p}'.format(p=cloud_prob)
+        rlayer_name = self.preview_name(
+            'Cloud probability {p}'.format(p=cloud_prob))
         self.plcloud_rlayer = qgis.core.QgsRasterLayer(self.plcloud_filename,
                                                        rlayer_name)
         # Add to QGIS
@@ -407,12 +634,13 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
         # Refresh layer symbology
         self.iface.legendInterface().refreshLayerSymbology(self.plcloud_rlayer)
 
-        # Enable matching button
-        self.allow_results(match=True)
+        # Enable matching button, unless the cloud probability was changed
+        #   while computing
+        self.allow_results(match=cloud_prob == self.cloud_prob)
 
     @QtCore.pyqtSlot()
     def do_cloud_matching(self):
-        """ Perform cloud/shadow matching and finalize mask """
+        """ Perform cloud/shadow matching in background and finalize mask """
         logger.info('Running fcssm with dilation:\n' +
                     'cloud: {c}\n'.format(c=self.cloud_dilate) +
                     'shadow: {s}'.format(s=self.shadow_dilate) +
@@ -420,10 +648,15 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
                     )
 
         # Run Fmask FCSSM
-        self.fmask_result.do_fcssm(self.cloud_dilate,
-                                   self.shadow_dilate,
-                                   self.snow_dilate)
-
+        self.run_worker('Matching clouds and shadows',
+                        self.cloud_matching_finished,
+                        self.fmask_result.do_fcssm,
+                        self.cloud_dilate,
+                        self.shadow_dilate,
+                        self.snow_dilate)
+
+    def cloud_matching_finished(self):
+        """ Add Fmask result to QGIS """
         # TODO if PREVIEW RESULT button: (else keep in memory)
         self.fcssm_filename, _tempfile = \
             pyfmask_utils.temp_raster(self.fmask_result.fmask_final,
@@ -432,7 +665,8 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
         self.temp_files.append(_tempfile)
 
         # Open as raster layer
-        rlayer_name = 'Fmask (cloud probability {p})'.format(p=self.cloud_prob)
+        rlayer_name = self.preview_name(
+            'Fmask (cloud probability {p})'.format(p=self.cloud_prob))
         self.fmask_rlayer = qgis.core.QgsRasterLayer(self.fcssm_filename,
                                                      rlayer_name)
 
@@ -454,12 +688,35 @@ class FmaskDialog(QtGui.QDialog, Ui_config_fmask):
 
     @QtCore.pyqtSlot()
     def save_result(self):
-        """ Save final result to disk """
-        logger.warning('Saving of results not implemented yet...')
-        pass
+        """ Save final result to disk, at full resolution, in background """
+        filename = str(self.edit_save.text())
+        if filename == '' or os.path.isdir(filename):
+            self.iface.messageBar().pushMessage(
+                'Fmask', 'Choose an output filename to save the result',
+                level=qgis.gui.QgsMessageBar.WARNING, duration=3)
+            return
+        self.save_file = filename
+        profile = self.driver_profiles[str(self.cbox_formats.currentText())]
+
+        logger.info('Saving Fmask to {f} ({p})'.format(f=filename, p=profile))
+        self.run_worker('Saving Fmask',
+                        partial(self.save_finished, filename),
+                        self.fmask_result.save, filename, profile)
+
+    def save_finished(self, filename):
+        """ Report saved result """
+        self.iface.messageBar().pushMessage(
+            'Fmask', 'Saved Fmask to {f}'.format(f=filename),
+            level=qgis.gui.QgsMessageBar.INFO, duration=3)
 
     def unload(self):
         """ Disconnect / unload """
+        # Stop any running calculation
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker_thread.quit()
+            self.worker_thread.wait()
+
         logger.debug('Removing temporary files')
 
         for _tmp in self.temp_files:
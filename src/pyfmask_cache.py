@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+""" Persistent on-disk cache of nd2toarbt (TOA reflectance / BT) results
+
+Each scene is stored in its own directory as one .npy file per array
+(Temp, the reflectance stack and the saturation masks) plus a small JSON file
+of the remaining metadata. Cached scenes are re-opened as copy-on-write memory
+maps, so loading costs milliseconds and in-place edits made by plcloud never
+reach the disk. Nothing is unpickled, and the default cache directory belongs
+to the user, so entries planted by someone else are never loaded.
+
+Entries are keyed by the MTL path, its modification time, the MTL
+calibration fields and the type of the data (float32, or int16 at half the
+size, see nd2toarbt), and are evicted least recently used first when the
+cache grows past its disk budget.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from fmask_io import cache_directory, is_virtual, read_mtl, real_path
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of nd2toarbt's output or of the entries changes
+CACHE_VERSION = 2
+
+# MTL fields that change the DN -> TOA/BT conversion
+_CALIBRATION = re.compile(
+    r'^(SPACECRAFT_ID|PRODUCT_(SAMPLES|LINES)_\w+|'
+    r'(LMAX|LMIN|QCALMAX|QCALMIN)_BAND\w+|'
+    r'(RADIANCE|REFLECTANCE|QUANTIZE_CAL)_\w+|K[12]_CONSTANT\w*|'
+    r'SUN_(AZIMUTH|ELEVATION)|EARTH_SUN_DISTANCE)$')
+
+_META = 'meta.json'
+# Entries are written to a .tmp* directory first; one older than this
+#   (seconds) was left by a session killed while storing
+_TMP_MAX_AGE = 60 * 60
+# Metadata of the entries of CACHE_VERSION 1, only listed to be evicted
+_OLD_META = 'meta.pkl'
+
+
+def default_directory():
+    """ Per user cache directory ($XDG_CACHE_HOME or ~/.cache) """
+    return cache_directory()
+
+
+def _encode(item, i):
+    """ JSON record of item i of nd2toarbt's output """
+    if isinstance(item, np.ndarray):
+        return {'array': '%02d.npy' % i}
+    if isinstance(item, np.generic):
+        # Scalars keep their type (e.g. float32 angles)
+        return {'scalar': item.item(), 'dtype': item.dtype.name}
+    if isinstance(item, tuple):
+        return {'tuple': [v.item() if isinstance(v, np.generic) else v
+                          for v in item],
+                'dtypes': [v.dtype.name if isinstance(v, np.generic) else None
+                           for v in item]}
+    return {'value': item}
+
+
+def _decode(record, path):
+    """ Item of nd2toarbt's output from its JSON record """
+    if 'array' in record:
+        return np.load(os.path.join(path, os.path.basename(record['array'])),
+                       mmap_mode='c', allow_pickle=False)
+    if 'scalar' in record:
+        return np.dtype(str(record['dtype'])).type(record['scalar'])
+    if 'tuple' in record:
+        return tuple(_str(v) if dtype is None else np.dtype(str(dtype)).type(v)
+                     for v, dtype in zip(record['tuple'], record['dtypes']))
+    return _str(record['value'])
+
+
+def _str(value):
+    # JSON strings are unicode in Python 2, where nd2toarbt gives str
+    if not isinstance(value, str) and hasattr(value, 'encode'):
+        return value.encode('utf-8')
+    return value
+
+
+def calibration_fields(mtl):
+    """ Returns sorted list of (key, value) MTL calibration fields """
+    return sorted((key, value) for key, value in read_mtl(mtl).items()
+                  if _CALIBRATION.match(key))
+
+
+class ToaBtCache(object):
+    """ LRU disk cache of nd2toarbt results stored as memory mapped .npy
+
+    Arguments:
+    'directory'         cache directory (default: default_directory())
+    'max_bytes'         disk budget in bytes
+    """
+
+    def __init__(self, directory=None, max_bytes=8 * 1024 ** 3):
+        if directory is None:
+            directory = default_directory()
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        # Entries of a directory someone else owns could be planted
+        if hasattr(os, 'getuid') and \
+                os.stat(self.directory).st_uid != os.getuid():
+            raise IOError('Cache directory {d} is not owned by the current '
+                          'user'.format(d=self.directory))
+
+    def key(self, mtl, dtype='float32'):
+        """ Cache key for MTL file: path, mtime, calibration fields and dtype
+
+        For a MTL file inside an archive the mtime is that of the archive
+        """
+        if not is_virtual(mtl):
+            mtl = os.path.abspath(mtl)
+        fields = (CACHE_VERSION, mtl, os.path.getmtime(real_path(mtl)),
+                  calibration_fields(mtl))
+        # float32 entries keep the keys they had before int16 was cached
+        if dtype != 'float32':
+            fields += (dtype, )
+        h = hashlib.sha1()
+        h.update(repr(fields).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, mtl, dtype='float32'):
+        """ Returns cached nd2toarbt output for MTL, or None if not cached """
+        path = self._path(self.key(mtl, dtype))
+        meta = os.path.join(path, _META)
+        if not os.path.isfile(meta):
+            return None
+
+        try:
+            with open(meta, 'r') as f:
+                toa_bt = [_decode(record, path) for record in json.load(f)]
+        except Exception:
+            logger.warning('Could not read cached TOA/BT in {p}'.format(
+                p=path))
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        # Mark as recently used
+        os.utime(meta, None)
+        logger.info('Loaded cached TOA and BT data from {p}'.format(p=path))
+        return toa_bt
+
+    def store(self, mtl, toa_bt):
+        """ Store nd2toarbt output for MTL, evicting old scenes if needed """
+        key = self.key(mtl, toa_bt[1].dtype.name)
+        nbytes = sum(item.nbytes for item in toa_bt
+                     if isinstance(item, np.ndarray))
+        if nbytes > self.max_bytes:
+            logger.info('Not caching TOA and BT data: {n} bytes exceeds '
+                        'cache size {m}'.format(n=nbytes, m=self.max_bytes))
+            return False
+        self.evict(self.max_bytes - nbytes, keep=key)
+
+        # Write to a temporary directory and rename so readers never see a
+        #   partially written entry
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=self.directory)
+        try:
+            meta = []
+            for i, item in enumerate(toa_bt):
+                if isinstance(item, np.ndarray):
+                    np.save(os.path.join(tmp, '%02d.npy' % i), item,
+                            allow_pickle=False)
+                meta.append(_encode(item, i))
+            with open(os.path.join(tmp, _META), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp, self._path(key))
+        except OSError:
+            # Entry already written (e.g. by another session)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return os.path.isdir(self._path(key))
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        logger.info('Cached TOA and BT data to {p}'.format(
+            p=self._path(key)))
+        return True
+
+    def entries(self):
+        """ Returns list of (last used, size in bytes, path), oldest first """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            meta = os.path.join(path, _META)
+            if not os.path.isfile(meta):
+                meta = os.path.join(path, _OLD_META)
+            if name.startswith('.') or not os.path.isfile(meta):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((os.path.getmtime(meta), size, path))
+        return sorted(entries)
+
+    def size(self):
+        """ Total size of cached scenes in bytes """
+        return sum(e[1] for e in self.entries())
+
+    def remove_stale(self):
+        """ Remove entries left partially written by killed sessions """
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp') and os.path.isdir(path) and \
+                    now - os.path.getmtime(path) > _TMP_MAX_AGE:
+                logger.info('Removing stale {p}'.format(p=path))
+                shutil.rmtree(path, ignore_errors=True)
+
+    def evict(self, max_bytes=None, keep=None):
+        """ Remove least recently used scenes until cache fits max_bytes """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        self.remove_stale()
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            if keep is not None and os.path.basename(path) == keep:
+                continue
+            logger.info('Evicting cached TOA and BT data {p}'.format(p=path))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """ Remove all cached scenes """
+        self.evict(0)
+
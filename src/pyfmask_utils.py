@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
+import math
 import os
 import tempfile
 import time
@@ -9,27 +10,80 @@ import qgis.core
 
 import numpy as np
 from osgeo import gdal
-from osgeo import gdal_array
 
-from fmask_cloud_masking_edit import nd2toarbt, plcloud, plcloud_warm, fcssm
+from fmask_cloud_masking_edit import (BASELINE_SCALE, nd2toarbt,
+                                      plcloud_probs, plcloud_baseline,
+                                      plcloud_threshold, fcssm_match,
+                                      fcssm_dilate, im_info, reference_band)
+from fmask_bitmask import lookup
+from fmask_io import exists, read_mtl, scene_mtl
+from fmask_output import write_bands
 
 gdal.UseExceptions()
 
 logger = logging.getLogger(__name__)
 
 class FmaskResult(object):
-    """ Object for running and storing some results from Fmask """
+    """ Object for running and storing some results from Fmask
 
-    def __init__(self, mtl, cache_toa_bt=False):
-        # MTL filename
-        self.mtl = mtl
+    With a preview scale above 1 (see scale) plcloud and fcssm run on the
+    scene decimated by that factor, for fast tuning of the parameters; save
+    writes the final Fmask at full resolution.
+
+    With a window (see window) they run on that part of the scene only. The
+    scene-wide percentiles (background temperatures, clear sky probability
+    thresholds...) then come from a whole scene pass decimated by
+    baseline_scale, run once and cached, so the window is classified as in
+    the whole scene.
+
+    With dtype 'int16' the TOA reflectance and BT are held, and cached, as
+    int16 rather than float32, at half the size (see nd2toarbt).
+
+    With a server (fmask_server Client) plcloud and fcssm run in the server,
+    which keeps the scene loaded for other sessions and clients.
+    """
+
+    # Decimation factor of the whole scene pass giving the baselines of
+    #   windows (at least the preview scale)
+    baseline_scale = BASELINE_SCALE
+
+    def __init__(self, mtl, cache_toa_bt=False, disk_cache=None, scale=1,
+                 catalog=None, dtype='float32', server=None):
+        # Metadata of a cataloged scene is not read again (see fmask_catalog)
+        if catalog is not None:
+            catalog.scene(mtl)
+        # MTL filename (inside the archive if given a scene archive)
+        self.mtl = scene_mtl(mtl)
 
         # Should TOA and BT data be cached?
         self._cache_toa_bt = cache_toa_bt
         # If so, have we cached it?
         self._cached_toa_bt = False
-
-        # Cloud probability mask
+        # Persistent on-disk cache of TOA and BT data (ToaBtCache or None)
+        self.disk_cache = disk_cache
+        # Preview decimation factor (1 for full resolution)
+        self._scale = scale
+        # Type of the TOA and BT data ('float32' or 'int16')
+        self.dtype = dtype
+        # fmask_server Client running plcloud and fcssm, None to run here
+        self.server = server
+        # Pixel window (xoff, yoff, xsize, ysize) processed, None for the
+        #   whole scene, & scene-wide statistics used for windows
+        self._window = None
+        self.baseline = None
+
+        # Cloud probabilities from plcloud_probs, kept so that a new cloud
+        #   probability threshold does not rerun all of plcloud
+        self.plcloud_state = None
+        self._state_shadow_prob = False
+        # Cloud/shadow match from fcssm_match, kept so that new dilation
+        #   buffers do not rerun the matching
+        self.fcssm_state = None
+        # Parameters of the current results, rerun at full resolution by save
+        self.cldprob = None
+        self.buffers = None
+
+        # Packed plcloud masks (see fmask_bitmask)
         self.plcloud_mask = None
         self.geoT = None
         self.prj = None
@@ -46,123 +100,304 @@ class FmaskResult(object):
         # Switching off the caching - delete cached data
         if self._cache_toa_bt and value is False:
             self.toa_bt = None
+            # Memory mapped data can be re-opened from the disk cache
+            if self.disk_cache is not None:
+                self._cached_toa_bt = False
 
         self._cache_toa_bt = value
 
-    def get_plcloud(self, cldprob=22.5, shadow_prob=False):
-        """ Runs plcloud function according to cache_toa_bt policy """
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, value):
+        """ Setter for the preview decimation factor """
+        if value == self._scale:
+            return
+        logger.info('Changed preview scale to 1/{s}'.format(s=value))
+        # Everything computed so far is of the previous resolution
+        self.toa_bt = None
+        self._cached_toa_bt = False
+        self.plcloud_state = None
+        self._state_shadow_prob = False
+        self.fcssm_state = None
+
+        self._scale = value
+
+    @property
+    def window(self):
+        return self._window
+
+    @window.setter
+    def window(self, value):
+        """ Setter for the pixel window of the scene to process """
+        if value == self._window:
+            return
+        logger.info('Changed processed window to {w}'.format(w=value))
+        # Results of the whole scene give the baselines for free
+        if self._window is None and self.plcloud_state is not None and \
+                self.baseline is None:
+            self.baseline = plcloud_baseline(self.plcloud_state)
+        self.toa_bt = None
+        self._cached_toa_bt = False
+        self.plcloud_state = None
+        self._state_shadow_prob = False
+        self.fcssm_state = None
+
+        self._window = value
+
+    def scene_info(self):
+        """ Return (geotransform, projection, size) of the whole scene """
+        geoT, prj, size, _ = im_info(reference_band(self.mtl))
+        return geoT, prj, size
+
+    def get_plcloud(self, cldprob=22.5, shadow_prob=False, progress=None):
+        """ Runs plcloud, recomputing cloud probabilities only if needed
+
+        progress is an optional callable taking (stage, fraction); it may
+        raise an exception to cancel the run.
+        """
         start = time.time()
+        if self.server is not None:
+            self._state_shadow_prob = self._state_shadow_prob or shadow_prob
+            self.cldprob = cldprob
+            result = self.server.plcloud(
+                self.mtl, cldprob, shadow_prob=self._state_shadow_prob,
+                scale=self._scale, window=self._window, dtype=self.dtype)
+            self.plcloud_mask = result['masks']
+            self.geoT = tuple(result['geoT'])
+            self.prj = str(result['prj'])
+            logger.info('Took {s}s to run plcloud in the server'.format(
+                s=time.time() - start))
+            return
+
+        if self.plcloud_state is None or \
+                (shadow_prob and not self._state_shadow_prob):
+            self.plcloud_state = self.get_plcloud_probs(shadow_prob,
+                                                        progress=progress)
+            self._state_shadow_prob = shadow_prob
+        else:
+            logger.info('Using cached cloud probabilities')
+
+        # Water, snow, cloud & shadow masks are packed into one raster
+        self.cldprob = cldprob
+        self.plcloud_result = plcloud_threshold(self.plcloud_state,
+                                                cldprob=cldprob, packed=True)
+        # New cloud mask - previous match is out of date
+        self.fcssm_state = None
+
+        # Make reference to the packed masks, holding the cloud mask
+        self.plcloud_mask = self.plcloud_result[6]
+        # Also include gdal info
+        self.geoT = self.plcloud_result[14]
+        self.prj = self.plcloud_result[15]
+
+        processing_time = time.time() - start
+        logger.info('Took {s}s to run plcloud'.format(s=processing_time))
+
+    def get_plcloud_probs(self, shadow_prob=False, progress=None):
+        """ Runs plcloud_probs according to cache_toa_bt policy """
         # Load TOA and BT information if needed
         if not self._cached_toa_bt:
-#            (self.Temp, self.data,
-#                self.dim, self.ul, self.zen, self.azi, self.zc,
-#                self.satu_B1, self.satu_B2, self.satu_B3,
-#                self.resolu, self.geoT, self.prj) = nd2toarbt(self.mtl)
             # Just save results as list since we only just pass it
-            self.toa_bt = nd2toarbt(self.mtl)
+            self.toa_bt = self._load_toa_bt(progress=progress)
             self._cached_toa_bt = True
             logger.info('Cached TOA and BT data')
 
+        baseline = None
+        if self._window is not None:
+            baseline = self.get_baseline(progress=progress)
+
         # Run plcloud
-        if self._cache_toa_bt:
+        #   data from the disk cache is memory mapped, so it is always used,
+        #   as is the (small) data of a preview or window
+        if self._cache_toa_bt or self.disk_cache is not None or \
+                self._scale != 1 or self._window is not None:
             # Used cached output from nd2toarbt
-#            (zen,azi,ptm,
-#                Temp,t_templ,t_temph,
-#                WT,Snow,Cloud,Shadow,
-#                dim,ul,resolu,zc,geoT,prj) = \
-#            plcloud_warm(self.toa_bt, shadow_prob=shadow_prob)
-            self.plcloud_result = plcloud_warm(self.toa_bt,
-                                               cldprob=cldprob,
-                                               shadow_prob=shadow_prob)
+            return plcloud_probs(self.toa_bt, shadow_prob=shadow_prob,
+                                 progress=progress, baseline=baseline)
         else:
-#            (zen,azi,ptm,
-#                Temp,t_templ,t_temph,
-#                WT,Snow,Cloud,Shadow,
-#                dim,ul,resolu,zc,geoT,prj) = \
-#            plcloud(cldprob, shadow_prob=shadow_prob)
-            self.plcloud_result = plcloud(self.mtl,
-                                          cldprob=cldprob,
-                                          shadow_prob=shadow_prob)
-
-        # Make reference to cloud probability mask
-        self.plcloud_mask = self.plcloud_result[8]
-        # Also include gdal info
-        self.geoT = self.plcloud_result[14]
-        self.prj = self.plcloud_result[15]
+            return plcloud_probs(nd2toarbt(self.mtl, progress=progress,
+                                           dtype=self.dtype),
+                                 shadow_prob=shadow_prob, progress=progress)
+
+    def get_baseline(self, progress=None):
+        """ Return the scene-wide statistics used for windows """
+        if self.baseline is None:
+            scale = max(self._scale, self.baseline_scale)
+            logger.info('Calculating scene-wide baselines at 1/{s} scale'.
+                        format(s=scale))
+            self.baseline = plcloud_baseline(plcloud_probs(
+                nd2toarbt(self.mtl, progress=progress, scale=scale,
+                          dtype=self.dtype),
+                shadow_prob=True, progress=progress))
+        return self.baseline
+
+    def _load_toa_bt(self, progress=None):
+        """ Return nd2toarbt output, from the disk cache if possible """
+        if self._scale != 1 or self._window is not None:
+            # Previews & windows are cheap to read and are not cached on disk
+            return nd2toarbt(self.mtl, window=self._window,
+                             progress=progress, scale=self._scale,
+                             dtype=self.dtype)
+        if self.disk_cache is None:
+            return nd2toarbt(self.mtl, progress=progress, dtype=self.dtype)
+
+        toa_bt = self.disk_cache.load(self.mtl, self.dtype)
+        if toa_bt is None:
+            toa_bt = nd2toarbt(self.mtl, progress=progress, dtype=self.dtype)
+            self.disk_cache.store(self.mtl, toa_bt)
+        return toa_bt
+
+    def do_fcssm(self, cloudbuffer=3, shadowbuffer=3, snowbuffer=3,
+                 progress=None):
+        """ Run Fmask FCCSM
+
+        progress is an optional callable taking (stage, fraction); it may
+        raise an exception to cancel the run.
+        """
+
+        logger.debug('dim: {d}'.format(d=self.plcloud_mask.shape))
+
+        start = time.time()
+
+        # Buffers are in full resolution pixels
+        self.buffers = (cloudbuffer, shadowbuffer, snowbuffer)
+        if self.server is not None:
+            # The server scales the buffers of a preview itself, and
+            #   matches on the cloud probabilities of get_plcloud
+            result = self.server.fcssm(
+                self.mtl, self.cldprob, *self.buffers,
+                shadow_prob=self._state_shadow_prob, scale=self._scale,
+                window=self._window, dtype=self.dtype,
+                arrays=('fmask', 'shadow_cal'))
+            # Only the number of matched clouds is returned
+            self.similar_num = None
+            self.cspt = result['cspt']
+            self.shadow_cal = result['shadow_cal']
+            self.fmask_final = result['fmask']
+            logger.info('Took {s}s to run fcssm in the server'.format(
+                s=time.time() - start))
+            return
+        if self._scale != 1:
+            cloudbuffer, shadowbuffer, snowbuffer = [
+                int(round(float(b) / self._scale)) for b in self.buffers]
+
+        # Match clouds and shadows only if cloud mask changed
+        if self.fcssm_state is None:
+            self.fcssm_state = fcssm_match(
+                self.plcloud_result[0], # zenith angle
+                self.plcloud_result[1], # azimuth angle
+                self.plcloud_result[2], # ptm
+                self.plcloud_result[3], # Temp
+                self.plcloud_result[4], # t_templ
+                self.plcloud_result[5], # t_temph
+                self.plcloud_result[6], # packed masks
+                self.plcloud_result[7], # None (Snow)
+                self.plcloud_result[8], # None (Cloud)
+                self.plcloud_result[9], # None (Shadow)
+                self.plcloud_result[10], # dim
+                self.plcloud_result[12], # resolution
+                self.plcloud_result[13], # zone coordinate
+                progress=progress
+            )
+        else:
+            logger.info('Using cached cloud and shadow match')
+
+        self.similar_num, self.cspt, self.shadow_cal, self.fmask_final = \
+            fcssm_dilate(self.fcssm_state,
+                         cloudbuffer,
+                         shadowbuffer,
+                         snowbuffer,
+                         progress=progress)
 
         processing_time = time.time() - start
-        logger.info('Took {s}s to run plcloud'.format(s=processing_time))
+        logger.info('Took {s}s to run fcssm'.format(s=processing_time))
 
-    def do_fcssm(self, cloudbuffer=3, shadowbuffer=3, snowbuffer=3):
-        """ Run Fmask FCCSM """
+    def save(self, filename, profile='gtiff', progress=None):
+        """ Write the final Fmask at full resolution
 
-        logger.debug('dim: {d}'.format(d=self.plcloud_result[10]))
+        A preview (scale above 1) or window is rerun for the whole scene at
+        full resolution with the cloud probability and buffers of its
+        current result; the preview itself is kept.
 
-        start = time.time()
+        Arguments:
+        'filename'          output filename
+        'profile'           output profile of fmask_output
+        'progress'          optional callable taking (stage, fraction)
 
-#        similar_num, cspt, shadow_cal, cs_final = fcssm(zen, azi, ptm,
-#            Temp, t_templ, t_temph,
-#            WT, Snow, Cloud, Shadow,
-#            dim, resolu, zc,
-#            cloudbuffer, shadowbuffer, snowbuffer)
-        self.similar_num, self.cspt, self.shadow_cal, self.fmask_final = fcssm(
-            self.plcloud_result[0], # zenith angle
-            self.plcloud_result[1], # azimuth angle
-            self.plcloud_result[2], # ptm
-            self.plcloud_result[3], # Temp
-            self.plcloud_result[4], # t_templ
-            self.plcloud_result[5], # t_temph
-            self.plcloud_result[6], # WT
-            self.plcloud_result[7], # Snow
-            self.plcloud_result[8], # Cloud
-            self.plcloud_result[9], # Shadow
-            self.plcloud_result[10], # dim
-            self.plcloud_result[12], # resolution
-            self.plcloud_result[13], # zone coordinate
-            cloudbuffer,
-            shadowbuffer,
-            snowbuffer
-        )
+        Returns:
+        filename
+        """
+        if self._scale == 1 and self._window is None:
+            result = self
+        else:
+            logger.info('Running Fmask at full resolution')
+            result = FmaskResult(self.mtl, disk_cache=self.disk_cache,
+                                 dtype=self.dtype, server=self.server)
+            result.get_plcloud(self.cldprob,
+                               shadow_prob=self._state_shadow_prob,
+                               progress=progress)
+            result.do_fcssm(*self.buffers, progress=progress)
 
-        processing_time = time.time() - start
-        logger.info('Took {s}s to run fcssm'.format(s=processing_time))
+        return write_bands(filename, [result.fmask_final], result.geoT,
+                           result.prj, profile)
 
 
-def mtl2dict(filename, to_float=True):
-    """ Reads in filename and returns a dict with MTL metadata """
-    assert os.path.isfile(filename), '{f} is not a file'.format(f=filename)
+def extent_window(extent, geo_transform, size):
+    """ Pixel window of a map extent in a raster
+    Arguments:
+    'extent'            (xmin, ymin, xmax, ymax) in the raster's projection
+    'geo_transform'     tuple of raster geotransform (north up)
+    'size'              (nrow, ncol) of raster
+
+    Returns:
+    (xoff, yoff, xsize, ysize) window of the pixels intersecting extent, or
+    None if extent is outside the raster
+    """
+    xmin, ymin, xmax, ymax = extent
+    cols = sorted(((xmin - geo_transform[0]) / geo_transform[1],
+                   (xmax - geo_transform[0]) / geo_transform[1]))
+    rows = sorted(((ymax - geo_transform[3]) / geo_transform[5],
+                   (ymin - geo_transform[3]) / geo_transform[5]))
+    xoff = max(0, int(math.floor(cols[0])))
+    yoff = max(0, int(math.floor(rows[0])))
+    xend = min(size[1], int(math.ceil(cols[1])))
+    yend = min(size[0], int(math.ceil(rows[1])))
+    if xend <= xoff or yend <= yoff:
+        return None
+    return (xoff, yoff, xend - xoff, yend - yoff)
 
-    mtl = {}
 
-    # Open filename with context manager
-    with open(filename, 'rb') as f:
-        # Read all lines in file
-        for line in f.readlines():
-            # Split KEY = VALUE entries
-            key_value = line.strip().split(' = ')
+def mtl2dict(filename, to_float=True):
+    """ Reads in filename and returns a dict with MTL metadata
 
-            # Ignore END lines
-            if len(key_value) != 2:
-                continue
+    filename may also be a scene archive (see fmask_io.scene_mtl)
+    """
+    filename = scene_mtl(filename)
+    assert exists(filename), '{f} is not a file'.format(f=filename)
 
-            key = key_value[0].strip()
-            value = key_value[1].strip('"')
+    mtl = {}
 
-            # Try to convert to float
-            if to_float is True:
-                try:
-                    value = float(value)
-                except:
-                    pass
+    # KEY = VALUE entries of file (which may be inside an archive)
+    for key, value in read_mtl(filename).items():
+        # Try to convert to float
+        if to_float is True:
+            try:
+                value = float(value)
+            except:
+                pass
 
-            # Trim and add to dict
-            mtl[key] = value
+        # Trim and add to dict
+        mtl[key] = value
 
     return mtl
 
 
 def temp_raster(raster, geo_transform, projection,
-                prefix='pyfmask_', directory=None):
+                prefix='pyfmask_', directory=None, codes=None,
+                profile='gtiff'):
     """ Creates a temporary file raster dataset (GTiff)
     Arguments:
     'raster'            numpy.ndarray image
@@ -170,6 +405,11 @@ def temp_raster(raster, geo_transform, projection,
     'projection'        str of raster's projection
     'prefix'            prefix of temporary filename
     'directory'         directory for temporary file (default: pwd)
+    'codes'             if given, raster is a packed mask raster and is
+                        written as classes: sequence of (bits, value) as for
+                        fmask_bitmask.classes, 255 outside the scene
+    'profile'           GeoTIFF output profile of fmask_output (default:
+                        uncompressed striped GeoTIFF)
 
     Returns:
     (filename of temporary raster image, temporary file object)
@@ -184,30 +424,17 @@ def temp_raster(raster, geo_transform, projection,
                                             delete=True, dir=directory)
     filename = _tempfile.name
 
-    # Parameterize raster
+    # Bands; class values of a packed mask raster are looked up block by
+    #   block while writing
     if raster.ndim == 2:
-        nband = 1
-        nrow, ncol = raster.shape
-    else:
-        nrow, ncol, nband = raster.shape
-
-    # Get driver
-    driver = gdal.GetDriverByName('GTiff')
-    # Create dataset
-    ds = driver.Create(filename, ncol, nrow, nband,
-                       gdal_array.NumericTypeCodeToGDALTypeCode(
-                           raster.dtype.type))
-
-    # Write file
-    if nband == 1:
-        ds.GetRasterBand(1).WriteArray(raster)
+        bands = [raster]
     else:
-        for b in range(nband):
-            ds.GetRasterBand(b + 1).WriteArray(raster)
+        bands = [raster[:, :, b] for b in range(raster.shape[2])]
+    if codes is not None:
+        table = lookup(codes, outside=255)
+        bands = [(band, table) for band in bands]
 
-    # Write projection / geo-transform
-    ds.SetGeoTransform(geo_transform)
-    ds.SetProjection(projection)
+    write_bands(filename, bands, geo_transform, projection, profile)
 
     return (filename, _tempfile)
 
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+""" Run Fmask computations off the GUI thread with progress & cancellation
+
+FmaskResult.get_plcloud / do_fcssm accept a ``progress`` callable that is
+called with (stage, fraction) as the computation goes. FmaskWorker passes its
+own ``report`` method as that callable, re-emits each call as a Qt signal and
+raises Cancelled from inside the computation once ``cancel`` has been
+called, which unwinds it at the next progress report.
+"""
+import logging
+
+from PyQt4 import QtCore
+
+logger = logging.getLogger(__name__)
+
+
+class Cancelled(Exception):
+    """ Raised inside a running computation when its worker is cancelled """
+    pass
+
+
+class FmaskWorker(QtCore.QObject):
+    """ Runs func(*args, progress=..., **kwargs) when ``run`` is called
+
+    Signals:
+    'progress'      (stage, fraction of stage done)
+    'finished'      result of func
+    'cancelled'     func was cancelled
+    'error'         message of exception raised by func
+    """
+
+    progress = QtCore.pyqtSignal(str, float)
+    finished = QtCore.pyqtSignal(object)
+    cancelled = QtCore.pyqtSignal()
+    error = QtCore.pyqtSignal(str)
+
+    def __init__(self, func, *args, **kwargs):
+        QtCore.QObject.__init__(self)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._cancel = False
+
+    def report(self, stage, fraction=0.0):
+        """ Progress callback handed to func """
+        if self._cancel:
+            raise Cancelled()
+        self.progress.emit(stage, fraction)
+
+    @QtCore.pyqtSlot()
+    def cancel(self):
+        """ Stop func at its next progress report """
+        logger.info('Cancelling Fmask computation')
+        self._cancel = True
+
+    @QtCore.pyqtSlot()
+    def run(self):
+        try:
+            result = self.func(*self.args, progress=self.report,
+                               **self.kwargs)
+        except Cancelled:
+            logger.info('Fmask computation cancelled')
+            self.cancelled.emit()
+        except Exception as e:
+            logger.exception('Fmask computation failed')
+            self.error.emit(str(e))
+        else:
+            self.finished.emit(result)
+
+
+def start_worker(worker):
+    """ Move worker to a new QThread and start it
+
+    The thread quits once the worker finishes, is cancelled or fails. Keep a
+    reference to both returned objects until then.
+
+    Returns:
+    (worker, thread)
+    """
+    thread = QtCore.QThread()
+    worker.moveToThread(thread)
+    thread.started.connect(worker.run)
+    for signal in (worker.finished, worker.cancelled, worker.error):
+        signal.connect(thread.quit)
+    thread.start()
+    return worker, thread